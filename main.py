@@ -12,9 +12,12 @@ import jimit as ji
 
 import time
 
-from models.initialize import logger, threads_status, config
+from models.initialize import logger, threads_status, config, upstream_buffer, instruction_dispatcher, \
+    event_dispatcher, collection_dispatcher, event_coalescer, image_pool
 from models.event_process import EventProcess
 from models.event_loop import vir_event_loop_poll_register, vir_event_loop_poll_run, eventLoop
+from models.guest_agent import guest_agent_dispatcher
+from models.counter import CounterState
 from models import Host
 from models import Utils
 from models import PidFile
@@ -36,6 +39,20 @@ def main():
     signal.signal(signal.SIGTERM, Utils.signal_handle)
     signal.signal(signal.SIGINT, Utils.signal_handle)
 
+    instruction_dispatcher.start()
+    event_dispatcher.start()
+    collection_dispatcher.start()
+    guest_agent_dispatcher.start()
+
+    t_ = threading.Thread(target=upstream_buffer.flush_engine, args=())
+    threads.append(t_)
+
+    t_ = threading.Thread(target=event_coalescer.flush_engine, args=())
+    threads.append(t_)
+
+    t_ = threading.Thread(target=image_pool.refill_engine, args=())
+    threads.append(t_)
+
     t_ = threading.Thread(
         target=Host().guest_creating_progress_report_engine, args=())
     threads.append(t_)
@@ -95,6 +112,18 @@ def main():
     for t in threads:
         t.join()
 
+    # 保存计数器基准值，供重启后沿用
+    try:
+        CounterState.save_all(path=config['counter_state_path'])
+    except:
+        logger.error(traceback.format_exc())
+
+    # 推送子线程退出前产生的上行消息。Redis 不可达时落入本地暂存区
+    try:
+        upstream_buffer.close()
+    except:
+        logger.error(traceback.format_exc())
+
     msg = 'Main say bye-bye!'
     print msg
     logger.info(msg=msg)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import sys
+import time
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models'))
+
+from file_copier import FileCopier
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/08'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+"""
+模板镜像复制基准。在指定目录生成稀疏的模板文件，对比 shutil.copyfile 与 file_copier 的耗时及目标文件的实际占用。
+用法：python misc/bench_copy.py <目录> [文件大小(MiB)] [数据占比] [重复次数]
+可在回环设备上对比不同文件系统，例：
+    truncate -s 20G /tmp/xfs.img && mkfs.xfs -m reflink=1 /tmp/xfs.img && mount -o loop /tmp/xfs.img /mnt/xfs
+    truncate -s 20G /tmp/ext4.img && mkfs.ext4 -F /tmp/ext4.img && mount -o loop /tmp/ext4.img /mnt/ext4
+以 root 运行时，每次复制前清空页缓存。
+"""
+
+
+def make_template(path, size, ratio):
+    # 每 64 MiB 中写入 ratio 比例的数据，其余为空洞，近似于精简过的 qcow2 模板
+    stride = 64 * 1024 * 1024
+    block = os.urandom(1024 * 1024)
+
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+        for offset in range(0, size, stride):
+            f.seek(offset)
+            for _ in range(int(min(stride, size - offset) * ratio / block.__len__())):
+                f.write(block)
+
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def drop_caches():
+    if os.getuid() != 0:
+        return
+
+    os.system('sync')
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3')
+
+
+def bench(name, fn, src, dst, repeat):
+    elapsed = list()
+
+    for _ in range(repeat):
+        if os.path.exists(dst):
+            os.remove(dst)
+
+        drop_caches()
+        begin = time.time()
+        fn(src, dst)
+        # 计入回写时间，避免只比较写入页缓存的速度
+        fd = os.open(dst, os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+        elapsed.append(time.time() - begin)
+
+    allocated = os.stat(dst).st_blocks * 512
+    os.remove(dst)
+
+    print '%-16s best: %8.3f s, avg: %8.3f s, allocated: %d MiB' % (
+        name, min(elapsed), sum(elapsed) / elapsed.__len__(), allocated / 1024 / 1024)
+
+
+def main():
+    if sys.argv.__len__() < 2:
+        print 'usage: python misc/bench_copy.py <directory> [size(MiB)] [data ratio] [repeat]'
+        sys.exit(1)
+
+    directory = sys.argv[1]
+    size = int(sys.argv[2]) * 1024 * 1024 if sys.argv.__len__() > 2 else 2048 * 1024 * 1024
+    ratio = float(sys.argv[3]) if sys.argv.__len__() > 3 else 0.25
+    repeat = int(sys.argv[4]) if sys.argv.__len__() > 4 else 3
+
+    src = os.path.join(directory, 'bench_copy_template.img')
+    dst = os.path.join(directory, 'bench_copy_system.img')
+
+    file_copier = FileCopier()
+    make_template(src, size, ratio)
+
+    try:
+        print 'size: %d MiB, data ratio: %.2f, repeat: %d' % (size / 1024 / 1024, ratio, repeat)
+        bench('shutil', lambda s, d: shutil.copyfile(s, d), src, dst, repeat)
+        bench('file_copier', lambda s, d: file_copier.copy(s, d), src, dst, repeat)
+        print file_copier.stats()
+
+    finally:
+        os.remove(src)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import sys
+import time
+
+# 直接导入事件循环模块，不经 models/__init__.py，无需加载配置文件
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models'))
+
+import libvirt
+from event_loop import VirEventLoopPoll
+
+
+__author__ = 'James Iter'
+__date__ = '2018/10/29'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+"""
+事件循环微基准。注册若干管道句柄及定时器，统计每次唤醒(run_once)的平均耗时。
+用法：python misc/bench_event_loop.py [句柄数] [定时器数] [迭代次数]
+仅依赖 libvirt-python，无需配置 /etc/jimvn.conf。
+"""
+
+
+def main():
+    handles = int(sys.argv[1]) if sys.argv.__len__() > 1 else 1000
+    timers = int(sys.argv[2]) if sys.argv.__len__() > 2 else 1000
+    iterations = int(sys.argv[3]) if sys.argv.__len__() > 3 else 10000
+
+    loop = VirEventLoopPoll()
+    pipes = list()
+    fired = {'handle': 0, 'timer': 0}
+
+    def on_handle(handle_id, fd, events, opaque):
+        os.read(fd, 1)
+        fired['handle'] += 1
+
+    def on_timer(timer_id, opaque):
+        fired['timer'] += 1
+
+    for i in range(handles):
+        rfd, wfd = os.pipe()
+        pipes.append((rfd, wfd))
+        loop.add_handle(rfd, libvirt.VIR_EVENT_HANDLE_READABLE, on_handle, None)
+
+    # 与 libvirtd 连接相似：绝大多数定时器处于禁用状态，少数周期性触发
+    for i in range(timers):
+        loop.add_timer(1000 if i % 100 == 0 else -1, on_timer, None)
+
+    begin = time.time()
+    for i in range(iterations):
+        # 每次唤醒只有一个句柄就绪
+        os.write(pipes[i % handles][1], 'c')
+        loop.run_once()
+
+    elapsed = time.time() - begin
+
+    print 'handles: %d, timers: %d, iterations: %d' % (handles, timers, iterations)
+    print 'handle callbacks: %d, timer callbacks: %d' % (fired['handle'], fired['timer'])
+    print 'per wakeup: %.2f us' % (elapsed / iterations * 1000000)
+    print loop.stats()
+
+
+if __name__ == '__main__':
+    main()
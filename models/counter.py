@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import json
+import threading
+import time
+import numpy as np
+
+from runtime import Runtime
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/05'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class CounterState(object):
+    """
+    一组设备的累计计数器的基准值。计数器存放在以设备 ID 表索引的稠密数组中，一次向量化运算得出全部设备的增量及速率。
+    """
+
+    # name -> CounterState，供心跳上报及持久化
+    counters = dict()
+    counters_lock = threading.Lock()
+    save_lock = threading.Lock()
+
+    def __init__(self, name=None, fields=None, capacity=64):
+        """
+        :param fields: 计数器字段名，决定每行的列顺序。libvirt、sysfs 及 cgroup 的计数器均为 64 位，不考虑回绕，
+                       计数器减小一律视为重置(如 Guest 重启)
+        """
+        self.name = name
+        self.fields = list(fields)
+        self.lock = threading.Lock()
+        # device_id -> 行号
+        self.index = dict()
+        self.free_rows = list(range(capacity - 1, -1, -1))
+        self.values = np.zeros((capacity, self.fields.__len__()), dtype=np.float64)
+        # 基准值的采样时刻，单调时钟
+        self.ts = np.zeros(capacity, dtype=np.float64)
+        self.resets = 0
+
+        with self.counters_lock:
+            self.counters[name] = self
+
+    def grow(self):
+        capacity = self.ts.shape[0]
+        self.values = np.vstack([self.values, np.zeros_like(self.values)])
+        self.ts = np.concatenate([self.ts, np.zeros_like(self.ts)])
+        self.free_rows.extend(range(capacity * 2 - 1, capacity - 1, -1))
+
+    def row(self, device_id):
+        """
+        :return: (行号, 是否为新设备)
+        """
+        if device_id in self.index:
+            return self.index[device_id], False
+
+        if self.free_rows.__len__() < 1:
+            self.grow()
+
+        row = self.free_rows.pop()
+        self.index[device_id] = row
+        return row, True
+
+    def evict(self, device_ids):
+        for device_id in device_ids:
+            self.free_rows.append(self.index.pop(device_id))
+
+    def update(self, samples, now, keep=None):
+        """
+        :param samples: [(device_id, [计数器值, ...]), ...]，须包含当前存在的全部设备
+        :param now: 本次采样时刻，单调时钟
+        :param keep: 本次未采到、但仍存在的设备 ID，保留其基准值。其余未出现的设备立即淘汰
+        :return: [(device_id, 增量数组, 速率数组), ...]。新设备、计数器被重置的设备，以及采样间隔非正的设备不在其中
+        """
+        keep = keep or set()
+
+        with self.lock:
+            present = set([device_id for device_id, _ in samples])
+            self.evict([device_id for device_id in self.index.keys()
+                        if device_id not in present and device_id not in keep])
+
+            if samples.__len__() < 1:
+                return list()
+
+            rows = list()
+            known = list()
+            for device_id, _ in samples:
+                row, new = self.row(device_id)
+                rows.append(row)
+                known.append(not new)
+
+            rows = np.array(rows, dtype=np.intp)
+            known = np.array(known, dtype=np.bool_)
+            current = np.array([counters for _, counters in samples], dtype=np.float64)
+
+            delta = current - self.values[rows]
+            elapsed = now - self.ts[rows]
+
+            reset = ((delta < 0) & known[:, np.newaxis]).any(axis=1)
+            self.resets += int(reset.sum())
+
+            valid = known & ~reset & (elapsed > 0)
+            rate = delta / np.where(elapsed > 0, elapsed, 1)[:, np.newaxis]
+
+            self.values[rows] = current
+            self.ts[rows] = now
+
+            return [(samples[i][0], delta[i], rate[i]) for i in np.flatnonzero(valid)]
+
+    def dump(self):
+        """
+        :return: 可序列化的基准值快照。单调时钟不跨重启，采样时刻转换为墙上时间
+        """
+        offset = time.time() - Runtime.monotonic()
+
+        with self.lock:
+            devices = dict()
+            for device_id, row in self.index.items():
+                devices[device_id] = {'values': self.values[row].tolist(), 'ts': self.ts[row] + offset}
+
+            return {'fields': self.fields, 'devices': devices}
+
+    def load(self, snapshot, max_age):
+        """
+        载入 dump 产生的快照。字段不一致的快照，及早于 max_age 秒的基准值被忽略
+        :return: 载入的设备数
+        """
+        if snapshot is None or snapshot.get('fields') != self.fields:
+            return 0
+
+        now = time.time()
+        offset = now - Runtime.monotonic()
+        n = 0
+
+        with self.lock:
+            for device_id, device in snapshot['devices'].items():
+                # 墙上时间被回拨时，其年龄为负，同样不可信
+                if not 0 < now - device['ts'] <= max_age:
+                    continue
+
+                row, new = self.row(device_id)
+                self.values[row] = device['values']
+                self.ts[row] = device['ts'] - offset
+                n += 1
+
+        return n
+
+    @classmethod
+    def save_all(cls, path):
+        """
+        将全部计数器的基准值写入状态文件。先写临时文件再改名，进程中途退出不会留下残缺的状态文件
+        """
+        with cls.counters_lock:
+            counters = cls.counters.items()
+
+        snapshots = dict([(name, counter.dump()) for name, counter in counters])
+
+        with cls.save_lock:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), 0755)
+
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshots, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(tmp_path, path)
+
+    @staticmethod
+    def load_all(path):
+        """
+        :return: name -> 快照。状态文件不存在或已损坏时返回空字典
+        """
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+
+        except (IOError, ValueError):
+            return dict()
+
+    def stats(self):
+        with self.lock:
+            return {'devices': self.index.__len__(), 'resets': self.resets}
+
+    @classmethod
+    def all_stats(cls):
+        with cls.counters_lock:
+            counters = cls.counters.items()
+
+        return dict([(name, counter.stats()) for name, counter in counters])
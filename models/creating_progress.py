@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from initialize import config, q_creating_guest
+from utils import Utils
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/09'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class CreatingProgress(object):
+    """
+    Guest 创建进度的推送者。作为复制过程的回调，按实际复制的字节数限频推送进度事件至 q_creating_guest；复制之后各阶段的进度亦经由该队列。
+    """
+
+    def __init__(self, uuid, step=None, interval=None):
+        self.uuid = uuid
+        # 单位(百分比)及(秒)
+        self.step = step if step is not None else config['creating_progress_step']
+        self.interval = interval if interval is not None else config['creating_progress_interval']
+        self.begin = Utils.monotonic()
+        self.done = 0
+        self.total = 0
+        self.published_done = 0
+        self.published_ts = self.begin
+
+    def publish(self, finished=False, ok=False):
+        self.published_done = self.done
+        self.published_ts = Utils.monotonic()
+
+        q_creating_guest.put({
+            'uuid': self.uuid,
+            'done': self.done,
+            'total': self.total,
+            'begin': self.begin,
+            'ts': self.published_ts,
+            'finished': finished,
+            'ok': ok
+        })
+
+    def __call__(self, done, total):
+        self.done = done
+        self.total = total
+
+        if total <= 0:
+            return
+
+        if (done - self.published_done) * 100. / total >= self.step or \
+                Utils.monotonic() - self.published_ts >= self.interval:
+            self.publish()
+
+    def stage(self, progress):
+        """
+        复制之后各阶段的进度。与复制进度经由同一队列，由上报引擎按序上报
+        """
+        q_creating_guest.put({'uuid': self.uuid, 'stage': progress})
+
+    def close(self, ok):
+        """
+        复制结束时调用，通知上报引擎移除该任务
+        :param ok: 复制是否成功。失败时由 Guest.create 上报，上报引擎仅将其丢弃
+        """
+        self.publish(finished=True, ok=ok)
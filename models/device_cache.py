@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import threading
+import libvirt
+import xml.etree.ElementTree as ET
+
+
+__author__ = 'James Iter'
+__date__ = '2018/10/31'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class DeviceCache(object):
+    """
+    Guest 设备拓扑(网卡、磁盘)的解析结果缓存。首次访问时解析 XML，由 libvirt 的生命周期及设备增删事件使其失效。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # uuid -> {'interfaces': [...], 'disks': [...]}
+        self.topology_by_uuid = dict()
+        # 每次失效递增。解析期间发生失效的结果不入缓存
+        self.serial = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def parse(xml):
+        root = ET.fromstring(xml)
+        interfaces = list()
+        disks = list()
+
+        for interface in root.findall('devices/interface'):
+            # 未运行的 Guest，其 XML 中没有 target 及 alias
+            target = interface.find('target')
+            alias = interface.find('alias')
+
+            interfaces.append({
+                'dev': target.get('dev') if target is not None else None,
+                'alias': alias.get('name') if alias is not None else None,
+                'mac': interface.find('mac').get('address')
+            })
+
+        for disk in root.findall('devices/disk'):
+            source = disk.find('source')
+            # 本地磁盘为文件路径；gluster 等网络磁盘为 卷名/路径。未插入介质的光驱无 source
+            path = None
+            protocol = None
+
+            if source is not None:
+                path = source.get('file')
+                if path is None:
+                    path = source.get('name')
+                    protocol = source.get('protocol')
+
+            disks.append({
+                'target': disk.find('target').get('dev'),
+                'path': path,
+                'protocol': protocol,
+                'uuid': path.split('/')[-1].split('.')[0] if path is not None else None
+            })
+
+        return {'interfaces': interfaces, 'disks': disks}
+
+    def get(self, dom):
+        assert isinstance(dom, libvirt.virDomain)
+        uuid = dom.UUIDString()
+
+        with self.lock:
+            topology = self.topology_by_uuid.get(uuid)
+            serial = self.serial
+
+            if topology is not None:
+                self.hits += 1
+                return topology
+
+            self.misses += 1
+
+        topology = self.parse(dom.XMLDesc())
+
+        with self.lock:
+            if serial == self.serial:
+                self.topology_by_uuid[uuid] = topology
+
+        return topology
+
+    def interfaces(self, dom):
+        return self.get(dom)['interfaces']
+
+    def disks(self, dom):
+        return self.get(dom)['disks']
+
+    def invalidate(self, uuid):
+        with self.lock:
+            self.serial += 1
+            self.topology_by_uuid.pop(uuid, None)
+
+    def stats(self):
+        with self.lock:
+            return {'domains': self.topology_by_uuid.__len__(), 'hits': self.hits, 'misses': self.misses}
+
+
+device_cache = DeviceCache()
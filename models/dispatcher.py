@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import collections
+import threading
+import time
+import traceback
+
+from runtime import Runtime
+
+
+__author__ = 'James Iter'
+__date__ = '2018/10/18'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class Dispatcher(object):
+    """
+    有界工作线程池。同一 lane(如 Guest UUID) 的任务按提交顺序串行执行，不同 lane 的任务并行执行。
+    """
+
+    def __init__(self, name=None, workers=8, max_pending=1024):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.cond = threading.Condition(threading.Lock())
+        # lane -> 等待执行的任务队列。lane 存在于该字典中，表示其正在执行或等待执行
+        self.lanes = dict()
+        # 待调度的 lane
+        self.ready = collections.deque()
+        self.threads = list()
+        self.pending = 0
+        self.busy = 0
+        self.processed = 0
+        self.rejected = 0
+        # gather 中未按时完成的任务数，及因同一 lane 上批任务未结束而跳过的任务数
+        self.late = 0
+        self.skipped = 0
+        self.anonymous_serial = 0
+        # 任务排队等待时间的指数移动平均值及最大值，单位(秒)
+        self.wait_avg = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self.worker, name='-'.join([self.name, 'worker', str(i)]))
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, lane, fn, *args, **kwargs):
+        """
+        :param lane: 串行通道标识，为 None 时任务与其它任何任务并行
+        :return: 任务被接纳时返回 True，进程退出时返回 False
+        """
+        return self.enqueue(lane=lane, fn=fn, args=args, kwargs=kwargs, block=True)
+
+    def offer(self, lane, fn, *args, **kwargs):
+        """
+        同 submit，但从不阻塞。待执行任务达到上限时丢弃该任务并返回 False。供不可阻塞的调用者(如事件循环)使用
+        """
+        return self.enqueue(lane=lane, fn=fn, args=args, kwargs=kwargs, block=False)
+
+    def enqueue(self, lane, fn, args, kwargs, block=True):
+        with self.cond:
+            # 待执行任务达到上限时阻塞提交者，形成背压
+            while self.pending >= self.max_pending:
+                if Runtime.exit_flag:
+                    return False
+
+                if not block:
+                    self.rejected += 1
+                    return False
+
+                self.cond.wait(1)
+
+            if lane is None:
+                self.anonymous_serial += 1
+                lane = ('anonymous', self.anonymous_serial)
+
+            if lane not in self.lanes:
+                self.lanes[lane] = collections.deque()
+                self.ready.append(lane)
+                self.cond.notify_all()
+
+            self.lanes[lane].append((time.time(), fn, args, kwargs))
+            self.pending += 1
+
+        return True
+
+    def gather(self, calls, timeout):
+        """
+        并发执行一批任务，至多等待 timeout 秒。某个 lane 卡住时，不影响其它任务按时返回
+        :param calls: key -> (lane, fn, args)
+        :return: key -> 返回值。仅包含按时完成的任务，逾时完成的结果被丢弃
+        """
+        batch = {'cond': threading.Condition(threading.Lock()), 'results': dict(), 'done': 0, 'closed': False}
+        deadline = time.time() + timeout
+        submitted = 0
+
+        for key, (lane, fn, args) in calls.items():
+            with self.cond:
+                if lane in self.lanes:
+                    # 该 lane 上一批次的任务仍未结束，不再为其堆积任务
+                    self.skipped += 1
+                    continue
+
+            if self.offer(lane, self.gather_task, batch, key, fn, args):
+                submitted += 1
+
+        with batch['cond']:
+            while batch['done'] < submitted:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                batch['cond'].wait(remaining)
+
+            batch['closed'] = True
+            late = submitted - batch['done']
+
+        with self.cond:
+            self.late += late
+
+        return batch['results']
+
+    @staticmethod
+    def gather_task(batch, key, fn, args):
+        ret = None
+
+        try:
+            ret = fn(*args)
+
+        finally:
+            with batch['cond']:
+                if not batch['closed']:
+                    batch['done'] += 1
+                    batch['results'][key] = ret
+                    batch['cond'].notify()
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    if Runtime.exit_flag:
+                        return
+
+                    self.cond.wait(1)
+
+                lane = self.ready.popleft()
+                enqueue_ts, fn, args, kwargs = self.lanes[lane].popleft()
+                self.pending -= 1
+                self.busy += 1
+
+                wait = time.time() - enqueue_ts
+                self.wait_avg = self.wait_avg * 0.9 + wait * 0.1
+                self.wait_max = max(self.wait_max, wait)
+
+                # 唤醒因队列满而阻塞的提交者
+                self.cond.notify_all()
+
+            try:
+                fn(*args, **kwargs)
+
+            except:
+                # 延迟导入，使本模块无需加载配置文件即可导入
+                from initialize import log_emit
+                log_emit.error(traceback.format_exc())
+
+            finally:
+                with self.cond:
+                    self.busy -= 1
+                    self.processed += 1
+
+                    if self.lanes[lane].__len__() > 0:
+                        # 放到队尾，让其它 lane 有机会被调度
+                        self.ready.append(lane)
+                        self.cond.notify()
+
+                    else:
+                        del self.lanes[lane]
+
+    def stats(self):
+        now = time.time()
+
+        with self.cond:
+            lanes = dict()
+            for lane, tasks in self.lanes.items():
+                if isinstance(lane, tuple) or tasks.__len__() < 1:
+                    continue
+
+                lanes[lane] = {'depth': tasks.__len__(), 'wait': round(now - tasks[0][0], 3)}
+
+            ret = {
+                'workers': self.workers,
+                'busy': self.busy,
+                'queue_depth': self.pending,
+                'processed': self.processed,
+                'rejected': self.rejected,
+                'late': self.late,
+                'skipped': self.skipped,
+                'wait_avg': round(self.wait_avg, 3),
+                'wait_max': round(self.wait_max, 3),
+                'lanes': lanes
+            }
+
+            # 最大等待时间按上报周期统计
+            self.wait_max = 0.0
+
+        return ret
+
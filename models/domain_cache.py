@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import threading
+import time
+import libvirt
+
+
+__author__ = 'James Iter'
+__date__ = '2018/10/20'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class DomainCache(object):
+    """
+    进程内共享的 Guest 索引。由 libvirt 的 DEFINED/UNDEFINED 事件维护，并定期与 libvirtd 对账。
+    """
+
+    def __init__(self, reconcile_interval=60):
+        self.conn = None
+        self.lock = threading.Lock()
+        self.reconcile_lock = threading.Lock()
+        self.dom_mapping_by_uuid = dict()
+        self.reconcile_interval = reconcile_interval
+        # 0 表示从未对账，首次访问时触发全量加载
+        self.last_reconcile = 0
+
+    def check_conn(self):
+        """
+        libvirtd 重启后旧连接失效，经其查得的 virDomain 亦随之失效，须整体丢弃
+        """
+        if self.conn is None:
+            return
+
+        try:
+            alive = self.conn.isAlive()
+
+        except libvirt.libvirtError:
+            alive = False
+
+        if not alive:
+            self.invalidate()
+
+    def init_conn(self):
+        self.check_conn()
+
+        if self.conn is None:
+            self.conn = libvirt.open()
+
+        return self.conn
+
+    def invalidate(self):
+        """
+        丢弃连接及索引，下次访问时重新连接并全量加载
+        """
+        with self.lock:
+            self.dom_mapping_by_uuid = dict()
+
+        self.conn = None
+        self.last_reconcile = 0
+
+    def reconcile(self):
+        """
+        以 listAllDomains 的结果为准，重建索引
+        """
+        # 已有线程在对账时，直接使用当前索引
+        if not self.reconcile_lock.acquire(False):
+            return
+
+        try:
+            mapping = dict()
+            for dom in self.init_conn().listAllDomains():
+                mapping[dom.UUIDString()] = dom
+
+            with self.lock:
+                self.dom_mapping_by_uuid = mapping
+
+            self.last_reconcile = time.time()
+
+        except libvirt.libvirtError as e:
+            # 延迟导入，使本模块无需加载配置文件即可导入
+            from initialize import logger
+            # 尝试重连 Libvirtd
+            logger.warn(e.message)
+            logger.warn(libvirt.virGetLastErrorMessage())
+            self.invalidate()
+
+        finally:
+            self.reconcile_lock.release()
+
+    def reconcile_if_expired(self):
+        self.check_conn()
+
+        if time.time() - self.last_reconcile >= self.reconcile_interval:
+            self.reconcile()
+
+    def add(self, dom):
+        assert isinstance(dom, libvirt.virDomain)
+
+        with self.lock:
+            self.dom_mapping_by_uuid[dom.UUIDString()] = dom
+
+    def remove(self, uuid):
+        with self.lock:
+            self.dom_mapping_by_uuid.pop(uuid, None)
+
+    def get(self, uuid):
+        """
+        :return: 对应 uuid 的 virDomain。找不到时抛出 KeyError
+        """
+        self.reconcile_if_expired()
+
+        with self.lock:
+            dom = self.dom_mapping_by_uuid.get(uuid)
+
+        if dom is not None:
+            return dom
+
+        # 事件可能尚未送达，退回到单次查询
+        try:
+            dom = self.init_conn().lookupByUUIDString(uuidstr=uuid)
+
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                from initialize import logger
+                logger.warn(e.message)
+
+            raise KeyError(uuid)
+
+        self.add(dom)
+        return dom
+
+    def mapping(self):
+        """
+        :return: uuid -> virDomain 的快照副本，调用者可随意遍历
+        """
+        self.reconcile_if_expired()
+
+        with self.lock:
+            return self.dom_mapping_by_uuid.copy()
+
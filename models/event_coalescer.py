@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import threading
+import time
+import jimit as ji
+
+from runtime import Runtime
+
+
+__author__ = 'James Iter'
+__date__ = '2018/10/30'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class EventCoalescer(object):
+    """
+    按 Guest UUID 合并短时间内连续到达的 libvirt 事件。一次重启或迁移所触发的一串事件，只产生一次状态上报及一次 XML 更新。
+    """
+
+    def __init__(self, dispatcher=None, window=0.5, max_delay=2):
+        self.dispatcher = dispatcher
+        # 最后一个事件之后静默 window 秒即上报；持续有事件时，最迟于首个事件之后 max_delay 秒上报，单位(秒)
+        self.window = window
+        self.max_delay = max_delay
+        self.cond = threading.Condition(threading.Lock())
+        # uuid -> {'dom', 'state', 'xml', 'first_ts', 'last_ts'}
+        self.pending = dict()
+        self.received = 0
+        self.absorbed = 0
+        self.flushed = 0
+
+    def touch(self, dom, state=False, xml=False):
+        """
+        登记一个事件。运行于事件循环线程，从不阻塞
+        :param state: 是否需要上报状态
+        :param xml: 是否需要更新 XML
+        """
+        uuid = dom.UUIDString()
+        now = time.time()
+
+        with self.cond:
+            self.received += 1
+            entry = self.pending.get(uuid)
+
+            if entry is None:
+                self.pending[uuid] = {'dom': dom, 'state': state, 'xml': xml, 'first_ts': now, 'last_ts': now}
+                self.cond.notify()
+                return
+
+            self.absorbed += 1
+            entry['dom'] = dom
+            entry['state'] = entry['state'] or state
+            entry['xml'] = entry['xml'] or xml
+            entry['last_ts'] = now
+
+    def deadline(self, entry):
+        return min(entry['last_ts'] + self.window, entry['first_ts'] + self.max_delay)
+
+    def expired(self, now):
+        """
+        :return: 已到期的条目，及距下一个到期的时间。处于合并中的 Guest 数量很少，直接遍历
+        """
+        ret = list()
+        timeout = 1
+
+        for uuid, entry in self.pending.items():
+            deadline = self.deadline(entry)
+
+            if deadline <= now:
+                ret.append(self.pending.pop(uuid))
+
+            else:
+                timeout = min(timeout, deadline - now)
+
+        return ret, timeout
+
+    @staticmethod
+    def report(dom, state=False, xml=False):
+        from guest import Guest
+
+        if state:
+            Guest.guest_state_report(dom=dom)
+
+        if xml:
+            Guest.update_xml(dom=dom)
+
+    def flush_engine(self):
+        # 延迟导入，使本模块无需加载配置文件即可导入
+        from initialize import logger, threads_status
+
+        while True:
+            threads_status['event_coalesce_engine'] = {'timestamp': ji.Common.ts()}
+
+            if Runtime.exit_flag:
+                msg = 'Thread event_coalesce_engine say bye-bye'
+                print msg
+                logger.info(msg=msg)
+                return
+
+            with self.cond:
+                entries, timeout = self.expired(time.time())
+
+                if entries.__len__() < 1:
+                    self.cond.wait(timeout)
+                    continue
+
+            for entry in entries:
+                self.flushed += 1
+                self.dispatcher.offer(entry['dom'].UUIDString(), self.report, dom=entry['dom'], state=entry['state'],
+                                      xml=entry['xml'])
+
+    def stats(self):
+        with self.cond:
+            return {
+                'received': self.received,
+                'absorbed': self.absorbed,
+                'flushed': self.flushed,
+                'pending': self.pending.__len__()
+            }
+
@@ -3,14 +3,13 @@
 
 
 import os
+import heapq
 import libvirt
 import select
 import errno
-import time
 import threading
 
-from models import Utils
-from models.initialize import logger
+from runtime import Runtime
 
 
 __author__ = 'James Iter'
@@ -26,7 +25,11 @@ event_impl = "poll"
 # I/O and errors events, as well as scheduling repeatable timers with
 # a fixed interval.
 #
-# It is a pure python implementation based around the poll() API
+# It is a pure python implementation based around the epoll() API,
+# falling back to poll() where epoll() is unavailable. File handles
+# are looked up through dicts keyed by fd and handle id, and timer
+# deadlines are kept in a min-heap on the monotonic clock, so a wakeup
+# costs O(events + fired timers) rather than O(handles + timers).
 #
 
 
@@ -68,6 +71,9 @@ class VirEventLoopPoll(object):
             self.cb = cb
             self.opaque = opaque
             self.lastfired = 0
+            # Bumped whenever the timer is rescheduled, so that stale
+            # heap entries can be recognised and skipped lazily
+            self.generation = 0
 
         def get_id(self):
             return self.timer
@@ -89,15 +95,31 @@ class VirEventLoopPoll(object):
                     self.opaque)
 
     def __init__(self):
-        self.poll = select.poll()
+        if hasattr(select, 'epoll'):
+            self.poll = select.epoll()
+            self.epoll = True
+        else:
+            self.poll = select.poll()
+            self.epoll = False
+
         self.pipetrick = os.pipe()
         self.pendingWakeup = False
         self.runningPoll = False
         self.nextHandleID = 1
         self.nextTimerID = 1
-        self.handles = []
-        self.timers = []
+        # handle id -> handle, fd -> handle
+        self.handles = dict()
+        self.handles_by_fd = dict()
+        # timer id -> timer, and a heap of (deadline, timer id, generation)
+        self.timers = dict()
+        self.timer_heap = []
         self.cleanup = []
+        # Guards the structures above, which other threads modify while
+        # this one sleeps in poll(). Callbacks are invoked without it.
+        self.lock = threading.RLock()
+        # Time spent in callbacks per iteration, in seconds
+        self.dispatch_time_avg = 0.0
+        self.dispatch_time_max = 0.0
 
         # The event loop can be used from multiple threads at once.
         # Specifically while the main thread is sleeping in poll()
@@ -114,34 +136,72 @@ class VirEventLoopPoll(object):
         # single byte of data to the other end of the pipe.
         self.poll.register(self.pipetrick[0], select.POLLIN)
 
+    # (Re)arm a timer relative to when it last fired. Disabled
+    # timers (negative interval) are not put on the heap at all.
+    def schedule_timer(self, t):
+        t.generation += 1
+        if t.get_interval() < 0:
+            return
+
+        deadline = t.get_last_fired() + t.get_interval() / 1000.0
+        heapq.heappush(self.timer_heap, (deadline, t.get_id(), t.generation))
+
+    # Drop heap entries belonging to removed or rescheduled timers
+    # and return the earliest live entry, or None
+    def peek_timer(self):
+        while self.timer_heap:
+            deadline, timer_id, generation = self.timer_heap[0]
+            t = self.timers.get(timer_id)
+            if t is not None and t.generation == generation:
+                return self.timer_heap[0]
+
+            heapq.heappop(self.timer_heap)
+
+        return None
+
     # Calculate when the next timeout is due to occur, returning
-    # the absolute timestamp for the next timeout, or 0 if there is
-    # no timeout due
+    # the absolute monotonic timestamp for the next timeout, or None
+    # if there is no timeout due. A zero interval timer that has never
+    # fired is due at 0, which must not be mistaken for "no timeout"
     def next_timeout(self):
-        _next = 0
-        for t in self.timers:
-            last = t.get_last_fired()
-            interval = t.get_interval()
-            if interval < 0:
-                continue
-            if _next == 0 or (last + interval) < _next:
-                _next = last + interval
+        with self.lock:
+            entry = self.peek_timer()
 
-        return _next
+        if entry is None:
+            return None
+
+        return entry[0]
 
     # Lookup a virEventLoopPollHandle object based on file descriptor
     def get_handle_by_fd(self, fd):
-        for h in self.handles:
-            if h.get_fd() == fd:
-                return h
-        return None
+        return self.handles_by_fd.get(fd)
 
     # Lookup a virEventLoopPollHandle object based on its event loop ID
     def get_handle_by_id(self, handle_id):
-        for h in self.handles:
-            if h.get_id() == handle_id:
-                return h
-        return None
+        return self.handles.get(handle_id)
+
+    # Pop every timer due at 'now' and rearm it for its next interval.
+    # Timers are collected before any of them is dispatched, so a zero
+    # interval timer fires once per iteration rather than forever.
+    def due_timers(self, now):
+        due = []
+
+        with self.lock:
+            while True:
+                entry = self.peek_timer()
+                # Deduct 20ms, since scheduler timeslice
+                # means we could be ever so slightly early
+                if entry is None or entry[0] > now + 0.02:
+                    break
+
+                heapq.heappop(self.timer_heap)
+                due.append(self.timers[entry[1]])
+
+            for t in due:
+                t.set_last_fired(now)
+                self.schedule_timer(t)
+
+        return due
 
     # This is the heart of the event loop, performing one single
     # iteration. It asks when the next timeout is due, and then
@@ -166,20 +226,29 @@ class VirEventLoopPoll(object):
         sleep = -1
         self.runningPoll = True
 
-        for opaque in self.cleanup:
+        with self.lock:
+            cleanup = self.cleanup
+            self.cleanup = []
+
+        for opaque in cleanup:
             libvirt.virEventInvokeFreeCallback(opaque)
-        self.cleanup = []
 
         try:
             _next = self.next_timeout()
-            if _next > 0:
-                now = int(time.time() * 1000)
+            if _next is not None:
+                now = Runtime.monotonic()
                 if now >= _next:
                     sleep = 0
                 else:
-                    sleep = (_next - now) / 1000.0
+                    sleep = _next - now
 
-            events = self.poll.poll(sleep)
+            # epoll() takes seconds, poll() takes milliseconds
+            if self.epoll:
+                events = self.poll.poll(sleep)
+            else:
+                events = self.poll.poll(sleep if sleep < 0 else sleep * 1000)
+
+            begin = Runtime.monotonic()
 
             # Dispatch any file handle events that occurred
             for (fd, revents) in events:
@@ -195,20 +264,14 @@ class VirEventLoopPoll(object):
                 if h:
                     h.dispatch(self.events_from_poll(revents))
 
-            now = int(time.time() * 1000)
-            for t in self.timers:
-                interval = t.get_interval()
-                if interval < 0:
-                    continue
+            for t in self.due_timers(Runtime.monotonic()):
+                t.dispatch()
 
-                want = t.get_last_fired() + interval
-                # Deduct 20ms, since scheduler timeslice
-                # means we could be ever so slightly early
-                if now >= (want-20):
-                    t.set_last_fired(now)
-                    t.dispatch()
+            elapsed = Runtime.monotonic() - begin
+            self.dispatch_time_avg = self.dispatch_time_avg * 0.99 + elapsed * 0.01
+            self.dispatch_time_max = max(self.dispatch_time_max, elapsed)
 
-        except (os.error, select.error) as e:
+        except (os.error, select.error, IOError) as e:
             if e.args[0] != errno.EINTR:
                 raise
         finally:
@@ -217,7 +280,10 @@ class VirEventLoopPoll(object):
     # Actually run the event loop forever
     def run_loop(self):
         while True:
-            if Utils.exit_flag:
+            if Runtime.exit_flag:
+                # 延迟导入，使本模块无需加载配置文件即可导入
+                from initialize import logger
+
                 msg = 'Thread vir_event_loop_poll_run say bye-bye'
                 print msg
                 logger.info(msg=msg)
@@ -230,18 +296,57 @@ class VirEventLoopPoll(object):
             self.pendingWakeup = True
             os.write(self.pipetrick[1], 'c'.encode("UTF-8"))
 
+    # Register 'fd' with the poller. libvirt may close an fd without
+    # removing its handle first, and the number can then be reused by
+    # the next add_handle while epoll still holds the old registration
+    # (EEXIST); in that case just replace the mask.
+    def poll_register(self, fd, mask):
+        try:
+            self.poll.register(fd, mask)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+            self.poll.modify(fd, mask)
+
+    # Change the mask of 'fd'. If the fd was closed, epoll has already
+    # dropped it: a reused number is registered afresh (ENOENT), a
+    # number that is no longer open is left to remove_handle (EBADF).
+    def poll_modify(self, fd, mask):
+        try:
+            self.poll.modify(fd, mask)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                self.poll_register(fd, mask)
+            elif e.errno != errno.EBADF:
+                raise
+
+    # Stop polling 'fd', tolerating an fd that was already closed
+    def poll_unregister(self, fd):
+        try:
+            self.poll.unregister(fd)
+        except KeyError:
+            # poll() raises KeyError for fds it does not know about
+            pass
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.ENOENT, errno.EBADF):
+                raise
+
     # Registers a new file handle 'fd', monitoring  for 'events' (libvirt
     # event constants), firing the callback  cb() when an event occurs.
     # Returns a unique integer identier for this handle, that should be
     # used to later update/remove it
     def add_handle(self, fd, events, cb, opaque):
-        handle_id = self.nextHandleID + 1
-        self.nextHandleID = self.nextHandleID + 1
+        with self.lock:
+            handle_id = self.nextHandleID + 1
+            self.nextHandleID = self.nextHandleID + 1
+
+            h = self.VirEventLoopPollHandle(handle_id, fd, events, cb, opaque)
+            self.handles[handle_id] = h
+            self.handles_by_fd[fd] = h
 
-        h = self.VirEventLoopPollHandle(handle_id, fd, events, cb, opaque)
-        self.handles.append(h)
+            self.poll_register(fd, self.events_to_poll(events))
 
-        self.poll.register(fd, self.events_to_poll(events))
         self.interrupt()
 
         return handle_id
@@ -252,56 +357,78 @@ class VirEventLoopPoll(object):
     # Returns a unique integer identier for this handle, that should be
     # used to later update/remove it
     def add_timer(self, interval, cb, opaque):
-        timer_id = self.nextTimerID + 1
-        self.nextTimerID = self.nextTimerID + 1
+        with self.lock:
+            timer_id = self.nextTimerID + 1
+            self.nextTimerID = self.nextTimerID + 1
+
+            h = self.VirEventLoopPollTimer(timer_id, interval, cb, opaque)
+            self.timers[timer_id] = h
+            self.schedule_timer(h)
 
-        h = self.VirEventLoopPollTimer(timer_id, interval, cb, opaque)
-        self.timers.append(h)
         self.interrupt()
 
         return timer_id
 
     # Change the set of events to be monitored on the file handle
     def update_handle(self, handle_id, events):
-        h = self.get_handle_by_id(handle_id)
+        with self.lock:
+            h = self.get_handle_by_id(handle_id)
+            if h:
+                h.set_events(events)
+                self.poll_modify(h.get_fd(), self.events_to_poll(events))
+
         if h:
-            h.set_events(events)
-            self.poll.unregister(h.get_fd())
-            self.poll.register(h.get_fd(), self.events_to_poll(events))
             self.interrupt()
 
     # Change the periodic frequency of the timer
     def update_timer(self, timer_id, interval):
-        for h in self.timers:
-            if h.get_id() == timer_id:
+        with self.lock:
+            h = self.timers.get(timer_id)
+            if h:
                 h.set_interval(interval)
-                self.interrupt()
+                self.schedule_timer(h)
 
-                break
+        if h:
+            self.interrupt()
 
     # Stop monitoring for events on the file handle
     def remove_handle(self, handle_id):
-        handles = []
-        for h in self.handles:
-            if h.get_id() == handle_id:
-                self.poll.unregister(h.get_fd())
+        with self.lock:
+            h = self.handles.pop(handle_id, None)
+            if h:
+                if self.handles_by_fd.get(h.get_fd()) is h:
+                    del self.handles_by_fd[h.get_fd()]
+
+                self.poll_unregister(h.get_fd())
                 self.cleanup.append(h.opaque)
-            else:
-                handles.append(h)
-        self.handles = handles
+
         self.interrupt()
 
     # Stop firing the periodic timer
     def remove_timer(self, timer_id):
-        timers = []
-        for h in self.timers:
-            if h.get_id() != timer_id:
-                timers.append(h)
-            else:
+        with self.lock:
+            h = self.timers.pop(timer_id, None)
+            if h:
+                # Its heap entry is now stale and will be skipped
+                h.generation += 1
                 self.cleanup.append(h.opaque)
-        self.timers = timers
+
         self.interrupt()
 
+    def stats(self):
+        ret = {
+            'impl': 'epoll' if self.epoll else 'poll',
+            'handles': self.handles.__len__(),
+            'timers': self.timers.__len__(),
+            'dispatch_time_avg': round(self.dispatch_time_avg, 6),
+            'dispatch_time_max': round(self.dispatch_time_max, 6)
+        }
+
+        # 最大耗时按上报周期统计
+        self.dispatch_time_max = 0.0
+
+        return ret
+
     # Convert from libvirt event constants, to poll() events constants
     @staticmethod
     def events_to_poll(events):
@@ -4,8 +4,11 @@
 
 import libvirt
 
-from models.initialize import guest_event_emit
-from models import Guest
+from models.initialize import guest_event_emit, event_dispatcher, event_coalescer, domain_cache
+from models.guest_agent import guest_agent_liveness
+from models.device_cache import device_cache
+from models.guest_counters import guest_counter_reader
+from models.guest import Guest
 
 
 __author__ = 'James Iter'
@@ -31,11 +34,28 @@ class EventProcess(object):
             # 跳过已经不再本宿主机的 guest
             return
 
+        # 生命周期变化会改变运行时 XML(如 target dev、alias)，设备拓扑需重新解析
+        device_cache.invalidate(dom.UUIDString())
+        # 重启后 qemu 进程及其 cgroup 随之改变
+        guest_counter_reader.invalidate(dom.UUIDString())
+
+        # 维护 Guest 索引
+        if event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
+            domain_cache.add(dom)
+
+        elif event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            domain_cache.remove(dom.UUIDString())
+            guest_agent_liveness.remove(dom.UUIDString())
+
+        elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            guest_agent_liveness.set(dom.UUIDString(), False)
+
         if event == libvirt.VIR_DOMAIN_EVENT_STOPPED and detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_MIGRATED:
             # Guest 从本宿主机迁出完成后不做状态通知
             return
 
-        Guest.guest_state_report(dom=dom)
+        # 该回调运行于事件循环线程，仅登记，不做任何阻塞调用。连续的事件合并为一次状态上报
+        event_coalescer.touch(dom, state=True)
 
         if event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
             if detail == libvirt.VIR_DOMAIN_EVENT_DEFINED_ADDED:
@@ -185,8 +205,12 @@ class EventProcess(object):
         else:
             pass
 
+    @classmethod
+    def guest_event_migration_iteration_callback(cls, conn, dom, iteration, opaque):
+        event_dispatcher.offer(dom.UUIDString(), cls.guest_migration_report, dom=dom)
+
     @staticmethod
-    def guest_event_migration_iteration_callback(conn, dom, iteration, opaque):
+    def guest_migration_report(dom=None):
         try:
             migrate_info = dict()
             migrate_info['type'], migrate_info['time_elapsed'], migrate_info['time_remaining'], \
@@ -200,13 +224,32 @@ class EventProcess(object):
         except libvirt.libvirtError as e:
             pass
 
+    @staticmethod
+    def guest_event_block_job_callback(conn, dom, disk, _type, status, opaque):
+        # 参考地址：https://libvirt.org/html/libvirt-libvirt-domain.html#virConnectDomainEventBlockJobCallback
+        if _type != libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_PULL or disk != 'vda':
+            return
+
+        event_dispatcher.offer(dom.UUIDString(), Guest.flatten_finished, dom=dom, status=status)
+
     @staticmethod
     def guest_event_device_added_callback(conn, dom, dev, opaque):
-        Guest.update_xml(dom=dom)
+        device_cache.invalidate(dom.UUIDString())
+        event_coalescer.touch(dom, xml=True)
 
     @staticmethod
     def guest_event_device_removed_callback(conn, dom, dev, opaque):
-        Guest.update_xml(dom=dom)
+        device_cache.invalidate(dom.UUIDString())
+        event_coalescer.touch(dom, xml=True)
+
+    @staticmethod
+    def guest_event_agent_lifecycle_callback(conn, dom, state, reason, opaque):
+        # 参考地址：https://libvirt.org/html/libvirt-libvirt-domain.html#virConnectDomainEventAgentLifecycleState
+        alive = state == libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED
+        guest_agent_liveness.set(dom.UUIDString(), alive)
+
+        # agent 的连通与否决定了 Guest 处于 Booting 还是 Running
+        event_coalescer.touch(dom, state=True)
 
     @classmethod
     def guest_event_register(cls):
@@ -218,6 +261,11 @@ class EventProcess(object):
             None, libvirt.VIR_DOMAIN_EVENT_ID_MIGRATION_ITERATION,
             cls.guest_event_migration_iteration_callback, None))
 
+        # BLOCK_JOB_2 以 target 名(如 vda)标识磁盘
+        cls.guest_callbacks.append(cls.conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2,
+            cls.guest_event_block_job_callback, None))
+
         cls.guest_callbacks.append(cls.conn.domainEventRegisterAny(
             None, libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
             cls.guest_event_device_added_callback, None))
@@ -226,6 +274,10 @@ class EventProcess(object):
             None, libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED,
             cls.guest_event_device_removed_callback, None))
 
+        cls.guest_callbacks.append(cls.conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE,
+            cls.guest_event_agent_lifecycle_callback, None))
+
     @classmethod
     def guest_event_deregister(cls):
         cls.conn.domainEventDeregister(cls.guest_event_callback)
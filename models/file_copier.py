@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import errno
+import fcntl
+import ctypes
+import platform
+import threading
+
+from runtime import Runtime
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/08'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class FileCopier(object):
+    """
+    本地文件复制引擎。优先以 reflink(FICLONE) 共享数据块；不支持时按数据区段经 copy_file_range 或 sendfile 在内核内复制，
+    跳过稀疏文件的空洞。
+    """
+
+    # 参考地址：http://man7.org/linux/man-pages/man2/ioctl_ficlone.2.html
+    FICLONE = 0x40049409
+    # 参考地址：http://man7.org/linux/man-pages/man2/lseek.2.html
+    SEEK_DATA = 3
+    SEEK_HOLE = 4
+
+    # glibc 2.27 以前无 copy_file_range 的封装，经系统调用号调用
+    copy_file_range_syscall = {'x86_64': 326, 'aarch64': 285, 'ppc64le': 379}
+
+    # 表示该方式在当前内核或文件系统上不可用的错误码
+    unsupported_errnos = (errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL)
+
+    def __init__(self, chunk_size=64 * 1024 * 1024):
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        # 按复制方式统计的文件数
+        self.methods = {'reflink': 0, 'copy_file_range': 0, 'sendfile': 0}
+        self.bytes_copied = 0
+        self.bytes_skipped = 0
+
+        libc = Runtime.libc
+        self.sendfile = libc.sendfile
+        self.sendfile.restype = ctypes.c_ssize_t
+        self.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+
+        self.copy_file_range = None
+        if hasattr(libc, 'copy_file_range'):
+            self.copy_file_range = libc.copy_file_range
+            self.copy_file_range.restype = ctypes.c_ssize_t
+            self.copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+                                             ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]
+
+        elif platform.machine() in self.copy_file_range_syscall:
+            syscall = libc.syscall
+            syscall.restype = ctypes.c_long
+            number = self.copy_file_range_syscall[platform.machine()]
+
+            def copy_file_range(fd_in, off_in, fd_out, off_out, length, flags):
+                return syscall(ctypes.c_long(number), ctypes.c_int(fd_in), off_in, ctypes.c_int(fd_out), off_out,
+                               ctypes.c_size_t(length), ctypes.c_uint(flags))
+
+            self.copy_file_range = copy_file_range
+
+    @staticmethod
+    def raise_errno():
+        _errno = ctypes.get_errno()
+        raise OSError(_errno, os.strerror(_errno))
+
+    def reflink(self, src_fd, dst_fd):
+        try:
+            fcntl.ioctl(dst_fd, self.FICLONE, src_fd)
+            return True
+
+        except IOError as e:
+            if e.errno in self.unsupported_errnos:
+                return False
+
+            raise
+
+    @classmethod
+    def extents(cls, fd, size):
+        """
+        :return: 数据区段 [(起始偏移, 长度), ...]。文件系统不支持 SEEK_DATA 时，整个文件视为一个区段
+        """
+        ret = list()
+        offset = 0
+
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, cls.SEEK_DATA)
+
+            except OSError as e:
+                # ENXIO: offset 之后再无数据
+                if e.errno == errno.ENXIO:
+                    break
+
+                if e.errno == errno.EINVAL and offset == 0:
+                    return [(0, size)]
+
+                raise
+
+            end = min(os.lseek(fd, start, cls.SEEK_HOLE), size)
+            ret.append((start, end - start))
+            offset = end
+
+        return ret
+
+    def copy_range_by_copy_file_range(self, src_fd, dst_fd, offset, length):
+        off_in = ctypes.c_int64(offset)
+        off_out = ctypes.c_int64(offset)
+
+        n = self.copy_file_range(src_fd, ctypes.byref(off_in), dst_fd, ctypes.byref(off_out), length, 0)
+        if n < 0:
+            self.raise_errno()
+
+        return n
+
+    def copy_range_by_sendfile(self, src_fd, dst_fd, offset, length):
+        # sendfile 写入目标文件的当前位置
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        off_in = ctypes.c_int64(offset)
+
+        n = self.sendfile(dst_fd, src_fd, ctypes.byref(off_in), length)
+        if n < 0:
+            self.raise_errno()
+
+        return n
+
+    def copy(self, src, dst, callback=None):
+        """
+        :param callback: callback(done, total)。done 为已处理的字节数，跳过的空洞计入其中；total 为源文件大小
+        :return: 所用的复制方式
+        """
+        src_fd = os.open(src, os.O_RDONLY)
+
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+
+            try:
+                size = os.fstat(src_fd).st_size
+
+                if self.reflink(src_fd=src_fd, dst_fd=dst_fd):
+                    method = 'reflink'
+                    done = size
+
+                    if callback is not None:
+                        callback(size, size)
+
+                else:
+                    method, done = self.copy_extents(src_fd=src_fd, dst_fd=dst_fd, size=size, callback=callback)
+
+            finally:
+                os.close(dst_fd)
+
+        finally:
+            os.close(src_fd)
+
+        with self.lock:
+            self.methods[method] += 1
+            if method != 'reflink':
+                self.bytes_copied += done
+                self.bytes_skipped += size - done
+
+        return method
+
+    def copy_extents(self, src_fd, dst_fd, size, callback=None):
+        """
+        :return: (所用的复制方式, 实际复制的字节数)
+        """
+        # 先确定目标文件大小，未写入的区段即为空洞
+        os.ftruncate(dst_fd, size)
+
+        method = 'copy_file_range' if self.copy_file_range is not None else 'sendfile'
+        copied = 0
+
+        for start, length in self.extents(src_fd, size):
+            offset = start
+            end = start + length
+
+            while offset < end:
+                count = min(self.chunk_size, end - offset)
+
+                if method == 'copy_file_range':
+                    try:
+                        n = self.copy_range_by_copy_file_range(src_fd, dst_fd, offset, count)
+
+                    except OSError as e:
+                        # 内核低于 4.5，或 5.3 以前的跨文件系统复制
+                        if e.errno not in self.unsupported_errnos:
+                            raise
+
+                        method = 'sendfile'
+                        continue
+
+                else:
+                    n = self.copy_range_by_sendfile(src_fd, dst_fd, offset, count)
+
+                # 源文件在复制期间被截断
+                if n == 0:
+                    raise IOError(errno.EIO, os.strerror(errno.EIO), 'source file truncated while copying')
+
+                offset += n
+
+                if callback is not None:
+                    callback(offset, size)
+
+            copied += length
+
+        if callback is not None:
+            callback(size, size)
+
+        return method, copied
+
+    def stats(self):
+        with self.lock:
+            return {'methods': self.methods.copy(), 'bytes_copied': self.bytes_copied,
+                    'bytes_skipped': self.bytes_skipped}
+
@@ -10,6 +10,7 @@ import signal
 import time
 import re
 import fcntl
+import threading
 
 import guestfs
 import libvirt
@@ -18,11 +19,14 @@ import libvirt_qemu
 import json
 import base64
 
-from initialize import log_emit, guest_event_emit, q_creating_guest, response_emit
+from initialize import log_emit, guest_event_emit, response_emit, image_pool
 from models.jimvn_exception import CommandExecFailed
-from models.status import OSTemplateInitializeOperateKind, StorageMode
+from models.status import OSTemplateInitializeOperateKind, StorageMode, GuestProvisioningMode
 from models.utils import Utils
 from models.storage import Storage
+from models.guest_agent import guest_agent_liveness
+from models.device_cache import device_cache
+from models.creating_progress import CreatingProgress
 from models import GuestState
 
 
@@ -33,14 +37,19 @@ __copyright__ = '(c) 2017 by James Iter.'
 
 
 class Guest(object):
+    # uuid -> 进行中的块拉取作业 {'msg', 'respond'}。由块作业事件结束，见 flatten_finished
+    flatten_jobs = dict()
+    flatten_jobs_lock = threading.Lock()
+
     def __init__(self, **kwargs):
         self.uuid = kwargs.get('uuid', None)
         self.name = kwargs.get('name', None)
         self.password = kwargs.get('password', None)
         # 模板镜像路径
         self.template_path = kwargs.get('template_path', None)
-        # 不提供链接克隆(完整克隆，后期可以在模板目录，直接删除模板文件。从理论上讲，基于完整克隆的 Guest 读写速度、快照都应该快于链接克隆。)
-        # self.clone = True
+        # 默认完整克隆(后期可以在模板目录，直接删除模板文件。从理论上讲，基于完整克隆的 Guest 读写速度、快照都应该快于链接克隆。)
+        # 链接克隆仅创建以模板镜像为后端的增量磁盘，秒级完成。在其被合并(flatten)前，模板镜像不可删除或修改
+        self.provisioning_mode = kwargs.get('provisioning_mode', GuestProvisioningMode.full.value)
         # Guest 系统盘及数据磁盘
         self.disk = kwargs.get('disk', None)
         self.xml = kwargs.get('xml', None)
@@ -49,8 +58,15 @@ class Guest(object):
         self.g = guestfs.GuestFS(python_return_dict=True)
         self.storage = Storage(storage_mode=kwargs.get('storage_mode', None), dfs_volume=kwargs.get('dfs_volume', None))
 
-    def generate_system_image(self):
-        self.storage.copy_file(src=self.template_path, dst=self.system_image_path)
+    def generate_system_image(self, callback=None):
+        """
+        :param callback: callback(done, total)，完整克隆时的复制进度
+        """
+        if self.provisioning_mode == GuestProvisioningMode.linked.value:
+            self.storage.make_overlay(backing_path=self.template_path, path=self.system_image_path)
+
+        else:
+            self.storage.copy_file(src=self.template_path, dst=self.system_image_path, callback=callback)
 
     def define_by_xml(self, conn=None):
         return conn.defineXML(xml=self.xml)
@@ -127,25 +143,6 @@ class Guest(object):
 
     @staticmethod
     def get_state(dom=None):
-        def is_running(_dom=None):
-            running = False
-
-            try:
-                exec_ret = libvirt_qemu.qemuAgentCommand(_dom, json.dumps({
-                                'execute': 'guest-ping',
-                                'arguments': {
-                                }
-                            }),
-                            3,
-                            libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT)
-
-                running = True
-
-            except:
-                pass
-
-            return running
-
         assert isinstance(dom, libvirt.virDomain)
 
         _uuid = dom.UUIDString()
@@ -156,7 +153,10 @@ class Guest(object):
 
         if state == libvirt.VIR_DOMAIN_RUNNING:
 
-            if is_running(_dom=dom):
+            # 读取 agent 存活表，不在此等待 agent。过期的结论由后台刷新
+            guest_agent_liveness.probe(dom=dom)
+
+            if guest_agent_liveness.alive(uuid=_uuid):
                 state = GuestState.running.value
 
             else:
@@ -250,17 +250,31 @@ class Guest(object):
     def create(conn, msg):
         try:
             guest = Guest(uuid=msg['uuid'], name=msg['name'], template_path=msg['template_path'], disk=msg['disks'][0],
-                          xml=msg['xml'], storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume'])
+                          xml=msg['xml'], storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume'],
+                          provisioning_mode=msg.get('provisioning_mode', GuestProvisioningMode.full.value))
 
-            q_creating_guest.put({
-                'storage_mode': guest.storage.storage_mode,
-                'dfs_volume': guest.storage.dfs_volume,
-                'uuid': guest.uuid,
-                'template_path': guest.template_path,
-                'system_image_path': guest.system_image_path
-            })
+            # 创建过程中的全部进度均经由创建进度上报引擎按序上报，保证只增不减
+            progress = CreatingProgress(uuid=guest.uuid)
 
-            guest.generate_system_image()
+            # 链接克隆无复制过程
+            if guest.provisioning_mode == GuestProvisioningMode.linked.value:
+                guest.generate_system_image()
+                progress.stage(90)
+
+            # 备用镜像池中有该模板的镜像时，直接改名，免去复制
+            elif image_pool.take(storage_mode=guest.storage.storage_mode, dfs_volume=guest.storage.dfs_volume,
+                                 template_path=guest.template_path, system_image_path=guest.system_image_path):
+                progress.stage(90)
+
+            else:
+                try:
+                    guest.generate_system_image(callback=progress)
+
+                except:
+                    progress.close(ok=False)
+                    raise
+
+                progress.close(ok=True)
 
             dom = guest.define_by_xml(conn=conn)
             assert isinstance(dom, libvirt.virDomain)
@@ -268,7 +282,7 @@ class Guest(object):
             log = u' '.join([u'域', guest.name, u', UUID', guest.uuid, u'定义成功.'])
             log_emit.info(msg=log)
 
-            guest_event_emit.creating(uuid=guest.uuid, progress=92)
+            progress.stage(92)
 
             disk_info = guest.storage.image_info(path=guest.system_image_path)
 
@@ -280,7 +294,7 @@ class Guest(object):
             extend_data = dict()
             extend_data.update({'disk_info': disk_info})
 
-            guest_event_emit.creating(uuid=guest.uuid, progress=97)
+            progress.stage(97)
 
             dom.create()
             log = u' '.join([u'域', guest.name, u', UUID', guest.uuid, u'启动成功.'])
@@ -288,6 +302,10 @@ class Guest(object):
 
             Guest.quota(dom=dom, msg=msg)
 
+            # 可选，在后台将模板镜像的数据并入增量磁盘，使 Guest 脱离模板镜像。创建的结果不等待合并完成
+            if guest.provisioning_mode == GuestProvisioningMode.linked.value and msg.get('flatten', False):
+                Guest.flatten(dom=dom, msg=msg, respond=False)
+
             response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg['uuid'],
                                   data=extend_data, passback_parameters=msg.get('passback_parameters'))
 
@@ -352,7 +370,7 @@ class Guest(object):
         assert isinstance(dom, libvirt.virDomain)
         assert isinstance(msg, dict)
 
-        root = ET.fromstring(dom.XMLDesc())
+        disks = device_cache.disks(dom)
 
         if dom.isActive():
             dom.destroy()
@@ -363,23 +381,156 @@ class Guest(object):
         dfs_volume = None
         path = None
 
-        for _disk in root.findall('devices/disk'):
-            if 'vda' == _disk.find('target').get('dev'):
+        for _disk in disks:
+            if 'vda' == _disk['target']:
                 system_image = _disk
 
         if msg['storage_mode'] in [StorageMode.ceph.value, StorageMode.glusterfs.value]:
             # 签出系统镜像路径
-            path_list = system_image.find('source').attrib['name'].split('/')
+            path_list = system_image['path'].split('/')
 
             if msg['storage_mode'] == StorageMode.glusterfs.value:
                 dfs_volume = path_list[0]
                 path = '/'.join(path_list[1:])
 
         elif msg['storage_mode'] in [StorageMode.local.value, StorageMode.shared_mount.value]:
-            path = system_image.find('source').attrib['file']
+            path = system_image['path']
 
         Storage(storage_mode=msg['storage_mode'], dfs_volume=dfs_volume).delete_image(path=path)
 
+    @staticmethod
+    def system_image(dom=None, storage_mode=None):
+        """
+        :return: (dfs 卷标, 系统盘路径)。路径不包含 dfs 卷标
+        """
+        system_image = None
+        dfs_volume = None
+        path = None
+
+        for _disk in device_cache.disks(dom):
+            if 'vda' == _disk['target']:
+                system_image = _disk
+
+        if storage_mode in [StorageMode.ceph.value, StorageMode.glusterfs.value]:
+            path_list = system_image['path'].split('/')
+
+            if storage_mode == StorageMode.glusterfs.value:
+                dfs_volume = path_list[0]
+                path = '/'.join(path_list[1:])
+
+        elif storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            path = system_image['path']
+
+        return dfs_volume, path
+
+    @classmethod
+    def backing_file(cls, dom=None, storage_mode=None):
+        """
+        :return: 系统盘的后端文件路径，不包含 dfs 卷标。非链接克隆或已合并时返回 None
+        """
+        assert isinstance(dom, libvirt.virDomain)
+
+        if dom.isActive():
+            # 运行中的 Guest 由 libvirt 跟踪其后端链，磁盘正被 qemu 锁定，不经 qemu-img 读取
+            for disk in ET.fromstring(dom.XMLDesc()).findall('devices/disk'):
+                target = disk.find('target')
+                if target is None or target.get('dev') != 'vda':
+                    continue
+
+                source = disk.find('backingStore/source')
+                if source is None:
+                    return None
+
+                if source.get('file') is not None:
+                    return source.get('file')
+
+                # 网络磁盘，形如 <source protocol='gluster' name='卷标/路径'>
+                return '/'.join(source.get('name', '').split('/')[1:]) or None
+
+            return None
+
+        dfs_volume, path = cls.system_image(dom=dom, storage_mode=storage_mode)
+        info = Storage(storage_mode=storage_mode, dfs_volume=dfs_volume).image_info(path=path)
+        backing_path = info.get('full-backing-filename', info.get('backing-filename'))
+
+        if backing_path is not None and backing_path.startswith('gluster://'):
+            # 形如 gluster://127.0.0.1/卷标/路径
+            backing_path = '/'.join(backing_path.split('/')[4:])
+
+        return backing_path
+
+    @classmethod
+    def flatten(cls, dom=None, msg=None, respond=True):
+        """
+        合并链接克隆的系统盘。未运行的 Guest 经 qemu-img 离线合并，完成后返回。
+        运行中的 Guest 由 libvirt 在后台拉取，启动块作业后即返回，作业结束时由 flatten_finished 上报结果
+        :param respond: 块作业结束时是否上报 msg 的执行结果
+        :return: 是否已转入后台
+        """
+        assert isinstance(dom, libvirt.virDomain)
+        assert isinstance(msg, dict)
+
+        if not dom.isActive():
+            dfs_volume, path = cls.system_image(dom=dom, storage_mode=msg['storage_mode'])
+            Storage(storage_mode=msg['storage_mode'], dfs_volume=dfs_volume).flatten_image(path=path)
+            return False
+
+        with cls.flatten_jobs_lock:
+            cls.flatten_jobs[dom.UUIDString()] = {'msg': msg, 'respond': respond}
+
+        try:
+            # https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainBlockPull
+            dom.blockPull(disk='vda', bandwidth=0, flags=0)
+
+        except:
+            with cls.flatten_jobs_lock:
+                cls.flatten_jobs.pop(dom.UUIDString(), None)
+
+            raise
+
+        return True
+
+    @classmethod
+    def flatten_finished(cls, dom=None, status=None):
+        """
+        块拉取作业结束(完成、失败或被取消)时，于事件派发器的工作线程中调用
+        """
+        assert isinstance(dom, libvirt.virDomain)
+
+        with cls.flatten_jobs_lock:
+            job = cls.flatten_jobs.pop(dom.UUIDString(), None)
+
+        if job is None:
+            return
+
+        msg = job['msg']
+        # 合并后运行时 XML 中的后端链已改变
+        device_cache.invalidate(dom.UUIDString())
+
+        try:
+            if status != libvirt.VIR_DOMAIN_BLOCK_JOB_COMPLETED:
+                raise CommandExecFailed(u' '.join([u'域', dom.name(), u'合并链接克隆磁盘的块作业未完成，状态：',
+                                                   str(status)]))
+
+            # 以后端链是否已断开为准
+            if dom.isActive() and cls.backing_file(dom=dom, storage_mode=msg['storage_mode']) is not None:
+                raise CommandExecFailed(u' '.join([u'域', dom.name(), u'合并链接克隆磁盘后，仍存在后端文件']))
+
+            log_emit.info(msg=u' '.join([u'域', dom.name(), u'已合并链接克隆磁盘，脱离模板镜像']))
+
+        except:
+            log_emit.error(traceback.format_exc())
+
+            if job['respond']:
+                response_emit.failure(_object=msg['_object'], action=msg['action'], uuid=msg.get('uuid'),
+                                      passback_parameters=msg.get('passback_parameters'))
+
+            return
+
+        if job['respond']:
+            response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg.get('uuid'),
+                                  passback_parameters=msg.get('passback_parameters'))
+
     @classmethod
     def reset_password(cls, dom=None, msg=None):
         assert isinstance(dom, libvirt.virDomain)
@@ -456,19 +607,7 @@ class Guest(object):
 
         from utils import QGA
 
-        libvirt_qemu.qemuAgentCommand(dom, json.dumps({
-                'execute': 'guest-exec',
-                'arguments': {
-                    'path': 'mkdir',
-                    'capture-output': False,
-                    'arg': [
-                        '-p',
-                        '/root/.ssh'
-                    ]
-                }
-            }),
-            3,
-            libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT)
+        QGA.guest_exec(dom=dom, path='mkdir', args=['-p', '/root/.ssh'], capture_output=False)
 
         redirection_symbol = '>'
 
@@ -478,25 +617,14 @@ class Guest(object):
             if i > 0:
                 redirection_symbol = '>>'
 
-            exec_ret = libvirt_qemu.qemuAgentCommand(dom, json.dumps({
-                    'execute': 'guest-exec',
-                    'arguments': {
-                        'path': '/bin/sh',
-                        'capture-output': True,
-                        'arg': [
-                            '-c',
-                            ' '.join(['echo', '"' + ssh_key + '"', redirection_symbol, '/root/.ssh/authorized_keys'])
-                        ]
-                    }
-                }),
-                3,
-                libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT)
+            ret = QGA.guest_exec(dom=dom, path='/bin/sh', args=[
+                '-c', ' '.join(['echo', '"' + ssh_key + '"', redirection_symbol, '/root/.ssh/authorized_keys'])])
+
+            if ret['exitcode'] != 0:
+                log_emit.warn(u' '.join([u'域', dom.name(), u'写入 SSH-KEY 失败：', ret['stderr'].decode('utf-8', 'replace'),
+                                         u'超时' if ret['timeout'] else u'']))
 
-            exec_ret = json.loads(exec_ret)
-            status_ret = QGA.get_guest_exec_status(dom=dom, pid=exec_ret['return']['pid'])
-            # exec_ret_str = base64.b64decode(json.loads(status_ret)['return']['out-data'])
-            # ret_s.append(json.loads(exec_ret_str))
-            ret_s.append(status_ret)
+            ret_s.append(ret)
 
         return ret_s
 
@@ -672,7 +800,7 @@ class Guest(object):
             assert isinstance(msg, dict)
 
             bandwidth = msg['bandwidth'] / 1000 / 8
-            mac = ET.fromstring(dom.XMLDesc()).findall('devices/interface')[0].find('mac').attrib['address']
+            mac = device_cache.interfaces(dom)[0]['mac']
 
             interface_bandwidth = dom.interfaceParameters(mac, 0)
             interface_bandwidth['inbound.average'] = bandwidth
@@ -749,7 +877,7 @@ class Guest(object):
             libvirt.VIR_MIGRATE_PEER2PEER | \
             libvirt.VIR_MIGRATE_AUTO_CONVERGE
 
-        root = ET.fromstring(dom.XMLDesc())
+        disks = device_cache.disks(dom)
 
         if msg['storage_mode'] == StorageMode.local.value:
             # 需要把磁盘存放路径加入到两边宿主机的存储池中
@@ -764,8 +892,8 @@ class Guest(object):
 
             ssh_client = Utils.ssh_client(hostname=msg['duri'].split('/')[2], user='root')
 
-            for _disk in root.findall('devices/disk'):
-                _file_path = _disk.find('source').get('file')
+            for _disk in disks:
+                _file_path = _disk['path']
                 disk_info = Storage.image_info_by_local(path=_file_path)
                 disk_size = disk_info['virtual-size']
                 stdin, stdout, stderr = ssh_client.exec_command(
@@ -789,8 +917,8 @@ class Guest(object):
         # duri like qemu+ssh://destination_host/system
         if dom.migrateToURI(duri=msg['duri'], flags=flags) == 0:
             if msg['storage_mode'] == StorageMode.local.value:
-                for _disk in root.findall('devices/disk'):
-                    _file_path = _disk.find('source').get('file')
+                for _disk in disks:
+                    _file_path = _disk['path']
                     if _file_path is not None:
                         os.remove(_file_path)
 
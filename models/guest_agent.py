@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import json
+import threading
+import time
+import libvirt
+import libvirt_qemu
+
+from initialize import config
+from dispatcher import Dispatcher
+
+
+__author__ = 'James Iter'
+__date__ = '2018/10/27'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class GuestAgentLiveness(object):
+    """
+    Guest 内 qemu-guest-agent 的存活表。由 AGENT_LIFECYCLE 事件及后台并发的 guest-ping 维护，读取方从不等待 agent。
+    """
+
+    def __init__(self, dispatcher=None, ping_interval=10, ping_timeout=3):
+        self.dispatcher = dispatcher
+        # 存活结论的有效期，过期后由后台重新 ping，单位(秒)
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.lock = threading.Lock()
+        # uuid -> {'alive': bool, 'ts': 更新时间, 'pinging': 是否有 ping 在途}
+        self.table = dict()
+
+    def set(self, uuid, alive):
+        with self.lock:
+            entry = self.table.setdefault(uuid, {'alive': False, 'ts': 0, 'pinging': False})
+            entry['alive'] = alive
+            entry['ts'] = time.time()
+
+    def remove(self, uuid):
+        with self.lock:
+            self.table.pop(uuid, None)
+
+    def alive(self, uuid):
+        with self.lock:
+            entry = self.table.get(uuid)
+            return entry is not None and entry['alive']
+
+    def probe(self, dom):
+        """
+        存活结论过期时，提交一次异步 ping。同一 Guest 至多一个 ping 在途
+        """
+        uuid = dom.UUIDString()
+
+        with self.lock:
+            entry = self.table.setdefault(uuid, {'alive': False, 'ts': 0, 'pinging': False})
+            if entry['pinging'] or time.time() - entry['ts'] < self.ping_interval:
+                return
+
+            entry['pinging'] = True
+
+        self.dispatcher.submit(uuid, self.ping, dom)
+
+    def ping(self, dom):
+        uuid = dom.UUIDString()
+        alive = False
+
+        try:
+            libvirt_qemu.qemuAgentCommand(dom, json.dumps({
+                    'execute': 'guest-ping',
+                    'arguments': {
+                    }
+                }),
+                self.ping_timeout,
+                libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT)
+
+            alive = True
+
+        except libvirt.libvirtError:
+            pass
+
+        finally:
+            with self.lock:
+                # 等待期间 Guest 可能已被删除
+                entry = self.table.get(uuid)
+                if entry is not None:
+                    entry['alive'] = alive
+                    entry['ts'] = time.time()
+                    entry['pinging'] = False
+
+
+# 每个 Guest 至多一个 ping 在途，待执行任务数不会超过 Guest 数
+guest_agent_dispatcher = Dispatcher(name='guest_agent', workers=config['guest_agent_ping_workers'])
+
+guest_agent_liveness = GuestAgentLiveness(dispatcher=guest_agent_dispatcher,
+                                          ping_interval=config['guest_agent_ping_interval'],
+                                          ping_timeout=config['guest_agent_ping_timeout'])
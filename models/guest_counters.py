@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import threading
+import libvirt
+
+from device_cache import device_cache
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/07'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class GuestCounterReader(object):
+    """
+    直接从 sysfs 及 cgroup 读取 Guest 的网卡及 CPU 计数器，免去 libvirt 调用。输出与 getAllDomainStats 的字段格式一致。
+    """
+
+    sys_class_net = '/sys/class/net'
+    sys_fs_cgroup = '/sys/fs/cgroup'
+    qemu_pid_path = '/var/run/libvirt/qemu'
+    proc = '/proc'
+
+    # tap 设备的计数器以宿主机视角计，方向与 Guest 视角相反。Guest 的接收即 tap 的发送
+    net_fields = [('rx.bytes', 'tx_bytes'), ('rx.pkts', 'tx_packets'), ('rx.errs', 'tx_errors'),
+                  ('rx.drop', 'tx_dropped'), ('tx.bytes', 'rx_bytes'), ('tx.pkts', 'rx_packets'),
+                  ('tx.errs', 'rx_errors'), ('tx.drop', 'rx_dropped')]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # uuid -> cpuacct.usage 文件路径。找不到时为 None，该 Guest 的 CPU 计数退回到 libvirt
+        self.cpuacct_by_uuid = dict()
+        self.fallbacks = 0
+
+    @staticmethod
+    def read_int(path):
+        fd = os.open(path, os.O_RDONLY)
+
+        try:
+            return int(os.read(fd, 64))
+
+        finally:
+            os.close(fd)
+
+    def cpuacct_path(self, dom):
+        """
+        经 qemu 进程的 /proc/<pid>/cgroup 定位 Guest 所在的 cpuacct cgroup
+        """
+        pid = open(os.path.join(self.qemu_pid_path, dom.name() + '.pid')).read().strip()
+
+        for line in open(os.path.join(self.proc, pid, 'cgroup')):
+            # 形如 4:cpuacct,cpu:/machine.slice/machine-qemu\x2d1\x2dname.scope/emulator
+            _, controllers, path = line.strip().split(':', 2)
+
+            if 'cpuacct' not in controllers.split(','):
+                continue
+
+            # libvirt 将 qemu 主线程置于 <scope>/emulator，vCPU 线程置于 <scope>/vcpuN。
+            # 主线程所在的 cgroup 只计 emulator 线程，须取其上一级的 scope，方含全部 vCPU 线程
+            path = path.rstrip('/')
+            if path.endswith('/emulator'):
+                path = path[:-len('/emulator')]
+
+            for name in [controllers, 'cpu,cpuacct', 'cpuacct']:
+                usage_path = os.path.join(self.sys_fs_cgroup, name, path.lstrip('/'), 'cpuacct.usage')
+                if os.path.exists(usage_path):
+                    return usage_path
+
+        return None
+
+    def read_cpu(self, dom, stats):
+        uuid = dom.UUIDString()
+
+        with self.lock:
+            mapped = uuid in self.cpuacct_by_uuid
+            usage_path = self.cpuacct_by_uuid.get(uuid)
+
+        if not mapped:
+            try:
+                usage_path = self.cpuacct_path(dom)
+
+            except (IOError, OSError, ValueError):
+                usage_path = None
+
+            with self.lock:
+                self.cpuacct_by_uuid[uuid] = usage_path
+
+        if usage_path is not None:
+            try:
+                # scope 的 cpuacct.usage 含其下 emulator、vcpuN 等全部子 cgroup 的累计 CPU 时间，单位(纳秒)
+                stats['cpu.time'] = self.read_int(usage_path)
+                return
+
+            except (IOError, OSError, ValueError):
+                self.invalidate(uuid)
+
+        self.fallbacks += 1
+        stats['cpu.time'] = dom.getCPUStats(True)[0]['cpu_time']
+
+    def read_interfaces(self, dom, stats):
+        devs = [interface['dev'] for interface in device_cache.interfaces(dom) if interface['dev'] is not None]
+        stats['net.count'] = devs.__len__()
+
+        for i, dev in enumerate(devs):
+            prefix = 'net.' + i.__str__() + '.'
+            stats[prefix + 'name'] = dev
+            statistics = os.path.join(self.sys_class_net, dev, 'statistics')
+
+            try:
+                for field, name in self.net_fields:
+                    stats[prefix + field] = self.read_int(os.path.join(statistics, name))
+
+            except (IOError, OSError, ValueError):
+                # 非 tap 类网卡或设备已消失
+                self.fallbacks += 1
+                rx_bytes, rx_pkts, rx_errs, rx_drop, tx_bytes, tx_pkts, tx_errs, tx_drop = dom.interfaceStats(dev)
+                stats.update({prefix + 'rx.bytes': rx_bytes, prefix + 'rx.pkts': rx_pkts,
+                              prefix + 'rx.errs': rx_errs, prefix + 'rx.drop': rx_drop,
+                              prefix + 'tx.bytes': tx_bytes, prefix + 'tx.pkts': tx_pkts,
+                              prefix + 'tx.errs': tx_errs, prefix + 'tx.drop': tx_drop})
+
+    def read(self, dom):
+        """
+        :return: CPU 及网卡计数器，字段格式与 getAllDomainStats 一致。两类计数器分别读取，一类失败不影响另一类
+        """
+        stats = dict()
+
+        for fn in [self.read_cpu, self.read_interfaces]:
+            try:
+                fn(dom=dom, stats=stats)
+
+            except libvirt.libvirtError as e:
+                # 延迟导入，使本模块无需加载配置文件即可导入
+                from initialize import logger
+                logger.warn(e.message)
+
+        return stats
+
+    def invalidate(self, uuid):
+        with self.lock:
+            self.cpuacct_by_uuid.pop(uuid, None)
+
+    def stats(self):
+        with self.lock:
+            return {'mapped': self.cpuacct_by_uuid.__len__(), 'fallbacks': self.fallbacks}
+
+
+guest_counter_reader = GuestCounterReader()
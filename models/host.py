@@ -10,18 +10,27 @@ import libvirt
 import json
 import subprocess
 import jimit as ji
-import xml.etree.ElementTree as ET
 
 import psutil
 import cpuinfo
 import dmidecode
-import threading
 
 from initialize import config, logger, r, log_emit, response_emit, host_event_emit, guest_collection_performance_emit, \
-    threads_status, host_collection_performance_emit, guest_event_emit, q_creating_guest
+    threads_status, host_collection_performance_emit, guest_event_emit, q_creating_guest, upstream_buffer, \
+    instruction_dispatcher, event_dispatcher, collection_dispatcher, event_coalescer, timeseries, image_pool, \
+    domain_cache
 from guest import Guest
 from storage import Storage
+from scheduler import Scheduler
+from counter import CounterState
+from guest_agent import guest_agent_liveness
+from event_loop import eventLoop
+from device_cache import device_cache
+from guest_counters import guest_counter_reader
+from instruction_stream import InstructionStream
 from utils import Utils, QGA
+from jimvn_exception import AlreadyUsed
+from status import StorageMode
 
 
 __author__ = 'James Iter'
@@ -31,13 +40,31 @@ __copyright__ = '(c) 2017 by James Iter.'
 
 
 class Host(object):
+    # 由 JimV-C 的 resend_host_facts 指令置位，下一次心跳携带完整的节点信息
+    host_facts_resend = False
+
     def __init__(self):
         self.conn = None
         self.dom = None
         self.dom_mapping_by_uuid = dict()
+        # uuid -> (virDomain, getAllDomainStats 的统计数据)
+        self.guest_stats = dict()
+        # guest_stats 的采集时刻，单调时钟
+        self.guest_stats_ts = 0
+        # uuid -> 需逐 Guest 调用才能取得的采样(可用内存)。未按时完成采样的 Guest 不在其中
+        self.guest_samples = dict()
         self.hostname = ji.Common.get_hostname()
         # 根据 hostname 生成的 node_id
         self.node_id = Utils.get_node_id()
+        # 本节点专属的指令频道，共享频道仅承载全局指令
+        self.instruction_channel = ':'.join([config['instruction_channel'], self.node_id.__str__()])
+        self.keepalive_key = ':'.join([config['node_keepalive_key_prefix'], self.node_id.__str__()])
+        self.keepalive_ts = 0
+        self.instruction_stream = InstructionStream(
+            r=r, stream=':'.join([config['instruction_stream'], self.node_id.__str__()]),
+            group=config['instruction_stream_group'], consumer=self.hostname, batch=config['instruction_stream_batch'],
+            block=config['engine_cycle_interval'], claim_idle=config['instruction_stream_claim_idle'],
+            accept=self.instruction_accept, submit=self.instruction_stream_submit, buffer=upstream_buffer)
         self.cpu = psutil.cpu_count()
         self.cpuinfo = cpuinfo.get_cpu_info()
         self.memory = psutil.virtual_memory().total
@@ -45,13 +72,16 @@ class Host(object):
         self.dmidecode = dmidecode.QuerySection('all')
         self.interfaces = dict()
         self.disks = dict()
-        # host, guest 性能收集统计周期，单位(秒)
-        self.interval = 60
-        self.last_host_traffic = dict()
-        self.last_host_disk_io = dict()
-        self.last_guest_cpu_time = dict()
-        self.last_guest_traffic = dict()
-        self.last_guest_disk_io = dict()
+        # 挂载点 -> 已用、可用空间。每 heartbeat_stats_interval 秒随心跳发送，不计入节点信息的版本
+        self.disks_usage = dict()
+        # 各类累计计数器的基准值，由对应的采集引擎创建。速率由其增量及实际采样间隔得出
+        self.host_traffic_counter = None
+        self.host_disk_io_counter = None
+        self.guest_cpu_counter = None
+        self.guest_traffic_counter = None
+        self.guest_disk_io_counter = None
+        # uuid -> 最近一次为其开启 balloon 内存统计的时间
+        self.memory_stats_period_ts = dict()
         self.ts = ji.Common.ts()
         self.version = config['version']
 
@@ -65,22 +95,124 @@ class Host(object):
                 logger.error(e.message)
 
     def refresh_dom_mapping(self):
-        # 调用该方法的函数，都为单独的对象实例。即不存在多线程共用该方法，故而不用加多线程锁
-        self.dom_mapping_by_uuid.clear()
+        # 取自进程内共享的 Guest 索引，不再每次调用 listAllDomains
+        self.dom_mapping_by_uuid = domain_cache.mapping()
+
+    @staticmethod
+    def lookup_dom(uuid):
+        return domain_cache.get(uuid)
+
+    @staticmethod
+    def linked_guests(template_path=None, storage_mode=None):
+        """
+        :return: 以 template_path 为后端文件的 Guest 名称列表
+        """
+        template_path = os.path.normpath(template_path)
+        linked = list()
+
+        for dom in domain_cache.mapping().values():
+            try:
+                backing_path = Guest.backing_file(dom=dom, storage_mode=storage_mode)
+
+            except:
+                # 无法确认时按仍在使用处理
+                log_emit.warn(u' '.join([u'域', dom.name(), u'读取后端文件失败：', traceback.format_exc()]))
+                linked.append(dom.name())
+                continue
+
+            if backing_path is not None and os.path.normpath(backing_path) == template_path:
+                linked.append(dom.name())
+
+        return linked
+
+    @staticmethod
+    def instruction_lane(msg):
+        """
+        同一 Guest 的指令串行执行，不同 Guest 的指令并行执行
+        """
+        if msg['_object'] in ['guest', 'snapshot']:
+            return msg.get('uuid')
+
+        elif msg['_object'] == 'disk':
+            if msg.get('guest_uuid', '').__len__() == 36:
+                return msg['guest_uuid']
+
+            return msg.get('uuid')
+
+        return None
+
+    def keepalive(self):
+        # 以带 TTL 的键声明本节点存活，代替向共享频道广播 pong
+        r.setex(self.keepalive_key, config['node_keepalive_ttl'], ji.Common.ts())
+        self.keepalive_ts = ji.Common.ts()
+
+    def instruction_accept(self, data):
+        """
+        解析一条指令
+        :return: 需要处理的指令；无需处理时返回 None
+        """
         try:
-            for dom in self.conn.listAllDomains():
-                self.dom_mapping_by_uuid[dom.UUIDString()] = dom
-        except libvirt.libvirtError as e:
-            # 尝试重连 Libvirtd
-            logger.warn(e.message)
-            logger.warn(libvirt.virGetLastErrorMessage())
-            self.init_conn()
+            msg = json.loads(data)
+
+            # 兼容旧版本节点在共享频道上广播的 pong
+            if msg['action'] == 'pong':
+                return None
+
+            if msg['action'] == 'ping':
+                # 通过 ping 来刷存在感。因为经过实际测试发现，当订阅频道长时间没有数据来往，那么订阅者会被自动退出。
+                # 应答不再广播，仅刷新本节点的存活键
+                self.keepalive()
+                return None
+
+        except ValueError as e:
+            log_emit.error(e.message)
+            return None
+
+        if 'node_id' in msg and int(msg['node_id']) != self.node_id:
+            return None
+
+        # 下列语句繁琐写法如 <code>if '_object' not in msg or 'action' not in msg:</code>
+        if not all([key in msg for key in ['_object', 'action']]):
+            return None
+
+        logger.info(msg=msg)
+        return msg
+
+    def instruction_stream_submit(self, msg, entry_id):
+        instruction_dispatcher.submit(self.instruction_lane(msg), self.instruction_process, msg, entry_id=entry_id)
+
+    def instruction_pubsub_dispatch(self, message):
+        """
+        :return: 是否取到了订阅消息。为 False 时频道中已无消息
+        """
+        if message is None:
+            return False
+
+        if 'data' not in message or not isinstance(message['data'], basestring):
+            return True
+
+        msg = self.instruction_accept(message['data'])
+        if msg is None:
+            return True
+
+        # 订阅线程只负责解析与派发，指令交由派发器的工作线程执行
+        instruction_dispatcher.submit(self.instruction_lane(msg), self.instruction_process, msg)
+        return True
 
     # 使用时，创建独立的实例来避开 多线程 的问题
     def instruction_process_engine(self):
 
+        stream_mode = config['instruction_intake_mode'] == 'stream'
+        stream_ready = False
+        # 待确认的指令仅于启动时重新派发一次
+        stream_replayed = False
+
         ps = r.pubsub(ignore_subscribe_messages=False)
-        ps.subscribe(config['instruction_channel'])
+        if stream_mode:
+            # 发给本节点的指令经由指令流送达，共享频道仅承载全局指令
+            ps.subscribe(config['instruction_channel'])
+        else:
+            ps.subscribe(config['instruction_channel'], self.instruction_channel)
 
         while True:
             if Utils.exit_flag:
@@ -91,226 +223,240 @@ class Host(object):
 
             threads_status['instruction_process_engine'] = {'timestamp': ji.Common.ts()}
 
-            msg = dict()
-            extend_data = dict()
-
             try:
-                msg = ps.get_message(timeout=config['engine_cycle_interval'])
-
-                if msg is None or 'data' not in msg or not isinstance(msg['data'], basestring):
-                    continue
-
-                try:
-                    msg = json.loads(msg['data'])
-
-                    if msg['action'] == 'pong':
-                        continue
-
-                    if msg['action'] == 'ping':
-                        # 通过 ping pong 来刷存在感。因为经过实际测试发现，当订阅频道长时间没有数据来往，那么订阅者会被自动退出。
-                        r.publish(config['instruction_channel'], message=json.dumps({'action': 'pong'}))
-                        continue
-
-                except ValueError as e:
-                    log_emit.error(e.message)
-                    continue
-
-                if 'node_id' in msg and int(msg['node_id']) != self.node_id:
-                    continue
+                if ji.Common.ts() - self.keepalive_ts >= config['node_keepalive_interval']:
+                    self.keepalive()
 
-                # 下列语句繁琐写法如 <code>if '_object' not in msg or 'action' not in msg:</code>
-                if not all([key in msg for key in ['_object', 'action']]):
-                    continue
+                if stream_mode:
+                    if not stream_ready:
+                        self.instruction_stream.init(replay=not stream_replayed)
+                        stream_ready = True
+                        stream_replayed = True
 
-                logger.info(msg=msg)
-                if msg['_object'] == 'guest':
+                    # 阻塞等待已在 XREADGROUP 中完成
+                    self.instruction_stream.read()
 
-                    self.refresh_dom_mapping()
-                    if msg['action'] not in ['create']:
-                        self.dom = self.dom_mapping_by_uuid[msg['uuid']]
-                        assert isinstance(self.dom, libvirt.virDomain)
+                    # 共享频道上的全局指令不阻塞地取尽，不积压于指令流的批次之后
+                    while self.instruction_pubsub_dispatch(ps.get_message(timeout=0)):
+                        pass
 
-                    if msg['action'] == 'create':
-                        t = threading.Thread(target=Guest.create, args=(self.conn, msg))
-                        t.setDaemon(False)
-                        t.start()
-                        continue
-
-                    elif msg['action'] == 'reboot':
-                        Guest.reboot(dom=self.dom)
-
-                    elif msg['action'] == 'force_reboot':
-                        Guest.force_reboot(dom=self.dom, msg=msg)
+                else:
+                    self.instruction_pubsub_dispatch(ps.get_message(timeout=config['engine_cycle_interval']))
 
-                    elif msg['action'] == 'shutdown':
-                        Guest.shutdown(dom=self.dom)
+            except:
+                # 指令流可能已被删除，下一轮重新建组。不再重放待确认的指令，以免重复执行仍在进行中的指令
+                stream_ready = False
+                # 防止循环线程，在redis连接断开时，混水写入日志
+                time.sleep(5)
+                log_emit.error(traceback.format_exc())
 
-                    elif msg['action'] == 'force_shutdown':
-                        Guest.force_shutdown(dom=self.dom)
+    def instruction_process(self, msg, entry_id=None):
+        """
+        运行于派发器的工作线程中
+        :param entry_id: 指令来自指令流时，其条目 ID。执行结果送达后确认消费
+        """
+        extend_data = dict()
 
-                    elif msg['action'] == 'boot':
-                        Guest.boot(dom=self.dom, msg=msg)
+        try:
+            if msg['_object'] == 'guest':
 
-                    elif msg['action'] == 'suspend':
-                        Guest.suspend(dom=self.dom)
+                dom = None
+                if msg['action'] not in ['create']:
+                    dom = self.lookup_dom(msg['uuid'])
+                    assert isinstance(dom, libvirt.virDomain)
 
-                    elif msg['action'] == 'resume':
-                        Guest.resume(dom=self.dom)
+                if msg['action'] == 'create':
+                    # 自行上报执行结果
+                    Guest.create(self.conn, msg)
+                    return
 
-                    elif msg['action'] == 'delete':
-                        Guest.delete(dom=self.dom, msg=msg)
+                elif msg['action'] == 'reboot':
+                    Guest.reboot(dom=dom)
 
-                    elif msg['action'] == 'reset_password':
-                        Guest.reset_password(dom=self.dom, msg=msg)
+                elif msg['action'] == 'force_reboot':
+                    Guest.force_reboot(dom=dom, msg=msg)
 
-                    elif msg['action'] == 'attach_disk':
-                        Guest.attach_disk(dom=self.dom, msg=msg)
+                elif msg['action'] == 'shutdown':
+                    Guest.shutdown(dom=dom)
 
-                    elif msg['action'] == 'detach_disk':
-                        Guest.detach_disk(dom=self.dom, msg=msg)
+                elif msg['action'] == 'force_shutdown':
+                    Guest.force_shutdown(dom=dom)
 
-                    elif msg['action'] == 'update_ssh_key':
-                        Guest.update_ssh_key(dom=self.dom, msg=msg)
+                elif msg['action'] == 'boot':
+                    Guest.boot(dom=dom, msg=msg)
 
-                    elif msg['action'] == 'allocate_bandwidth':
-                        t = threading.Thread(target=Guest.allocate_bandwidth, args=(self.dom, msg))
-                        t.setDaemon(False)
-                        t.start()
-                        continue
+                elif msg['action'] == 'suspend':
+                    Guest.suspend(dom=dom)
 
-                    elif msg['action'] == 'adjust_ability':
-                        t = threading.Thread(target=Guest.adjust_ability, args=(self.dom, msg))
-                        t.setDaemon(False)
-                        t.start()
-                        continue
+                elif msg['action'] == 'resume':
+                    Guest.resume(dom=dom)
 
-                    elif msg['action'] == 'migrate':
-                        Guest().migrate(dom=self.dom, msg=msg)
+                elif msg['action'] == 'delete':
+                    Guest.delete(dom=dom, msg=msg)
 
-                elif msg['_object'] == 'disk':
+                elif msg['action'] == 'reset_password':
+                    Guest.reset_password(dom=dom, msg=msg)
 
-                    if msg['action'] == 'create':
-                        Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume']).make_image(
-                            path=msg['image_path'], size=msg['size'])
+                elif msg['action'] == 'flatten':
+                    # 运行中的 Guest 于块作业结束后自行上报执行结果
+                    if Guest.flatten(dom=dom, msg=msg):
+                        return
 
-                    elif msg['action'] == 'delete':
-                        Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume']).delete_image(
-                            path=msg['image_path'])
+                elif msg['action'] == 'attach_disk':
+                    Guest.attach_disk(dom=dom, msg=msg)
 
-                    elif msg['action'] == 'resize':
-                        mounted = True if msg['guest_uuid'].__len__() == 36 else False
+                elif msg['action'] == 'detach_disk':
+                    Guest.detach_disk(dom=dom, msg=msg)
 
-                        if mounted:
-                            self.refresh_dom_mapping()
-                            self.dom = self.dom_mapping_by_uuid[msg['guest_uuid']]
+                elif msg['action'] == 'update_ssh_key':
+                    Guest.update_ssh_key(dom=dom, msg=msg)
 
-                        # 在线磁盘扩容
-                        if mounted and self.dom.isActive():
-                            # 磁盘大小默认单位为KB，乘以两个 1024，使其单位达到 GiB
-                            msg['size'] = int(msg['size']) * 1024 * 1024
+                elif msg['action'] == 'allocate_bandwidth':
+                    Guest.allocate_bandwidth(dom, msg)
+                    return
 
-                            # https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainBlockResize
-                            self.dom.blockResize(disk=msg['device_node'], size=msg['size'])
-                            Guest.quota(dom=self.dom, msg=msg)
+                elif msg['action'] == 'adjust_ability':
+                    Guest.adjust_ability(dom, msg)
+                    return
 
-                        # 离线磁盘扩容
-                        else:
-                            Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume']).resize_image(
-                                path=msg['image_path'], size=msg['size'])
+                elif msg['action'] == 'migrate':
+                    Guest().migrate(dom=dom, msg=msg)
 
-                    elif msg['action'] == 'quota':
-                        self.refresh_dom_mapping()
-                        self.dom = self.dom_mapping_by_uuid[msg['guest_uuid']]
-                        Guest.quota(dom=self.dom, msg=msg)
+            elif msg['_object'] == 'disk':
 
-                elif msg['_object'] == 'snapshot':
+                if msg['action'] == 'create':
+                    Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume']).make_image(
+                        path=msg['image_path'], size=msg['size'])
 
-                    self.refresh_dom_mapping()
-                    self.dom = self.dom_mapping_by_uuid[msg['uuid']]
+                elif msg['action'] == 'delete':
+                    Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume']).delete_image(
+                        path=msg['image_path'])
 
-                    if msg['action'] == 'create':
-                        t = threading.Thread(target=Guest.create_snapshot, args=(self.dom, msg))
-                        t.setDaemon(False)
-                        t.start()
-                        continue
+                elif msg['action'] == 'resize':
+                    mounted = True if msg['guest_uuid'].__len__() == 36 else False
 
-                    elif msg['action'] == 'delete':
-                        t = threading.Thread(target=Guest.delete_snapshot, args=(self.dom, msg))
-                        t.setDaemon(False)
-                        t.start()
-                        continue
+                    dom = None
+                    if mounted:
+                        dom = self.lookup_dom(msg['guest_uuid'])
 
-                    elif msg['action'] == 'revert':
-                        t = threading.Thread(target=Guest.revert_snapshot, args=(self.dom, msg))
-                        t.setDaemon(False)
-                        t.start()
-                        continue
+                    # 在线磁盘扩容
+                    if mounted and dom.isActive():
+                        # 磁盘大小默认单位为KB，乘以两个 1024，使其单位达到 GiB
+                        msg['size'] = int(msg['size']) * 1024 * 1024
 
-                    elif msg['action'] == 'convert':
-                        t = threading.Thread(target=Guest.convert_snapshot, args=(msg,))
-                        t.setDaemon(False)
-                        t.start()
-                        continue
+                        # https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainBlockResize
+                        dom.blockResize(disk=msg['device_node'], size=msg['size'])
+                        Guest.quota(dom=dom, msg=msg)
 
-                elif msg['_object'] == 'os_template_image':
-                    if msg['action'] == 'delete':
-                        Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume']).delete_image(
-                            path=msg['template_path'])
+                    # 离线磁盘扩容
+                    else:
+                        Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume']).resize_image(
+                            path=msg['image_path'], size=msg['size'])
 
-                elif msg['_object'] == 'global':
-                    if msg['action'] == 'refresh_guest_state':
-                        t = threading.Thread(target=Host().refresh_guest_state, args=())
-                        t.setDaemon(False)
-                        t.start()
-                        continue
+                elif msg['action'] == 'quota':
+                    dom = self.lookup_dom(msg['guest_uuid'])
+                    Guest.quota(dom=dom, msg=msg)
+
+            elif msg['_object'] == 'snapshot':
+
+                dom = self.lookup_dom(msg['uuid'])
+
+                # 以下操作均自行上报执行结果
+                if msg['action'] == 'create':
+                    Guest.create_snapshot(dom, msg)
+                    return
+
+                elif msg['action'] == 'delete':
+                    Guest.delete_snapshot(dom, msg)
+                    return
+
+                elif msg['action'] == 'revert':
+                    Guest.revert_snapshot(dom, msg)
+                    return
+
+                elif msg['action'] == 'convert':
+                    Guest.convert_snapshot(msg)
+                    return
+
+            elif msg['_object'] == 'os_template_image':
+                if msg['action'] == 'delete':
+                    # 链接克隆的 Guest 依赖模板镜像作为后端文件，删除将使其无法启动
+                    linked = self.linked_guests(template_path=msg['template_path'],
+                                                storage_mode=msg['storage_mode'])
+                    if linked.__len__() > 0:
+                        raise AlreadyUsed(u' '.join([u'模板', msg['template_path'], u'仍被链接克隆使用：',
+                                                     u', '.join(linked)]))
+
+                    # 共享存储上的模板亦可能被其它节点的链接克隆使用，本节点无从得知。须由掌握全部 Guest 的 JimV-C
+                    # 确认其已无链接克隆后，于指令中携带 no_linked_clones 方可删除
+                    if msg['storage_mode'] != StorageMode.local.value and not msg.get('no_linked_clones', False):
+                        raise AlreadyUsed(u' '.join([u'模板', msg['template_path'],
+                                                     u'位于共享存储，未经 JimV-C 确认无链接克隆使用，拒绝删除']))
+
+                    image_pool.purge(template_path=msg['template_path'])
+                    Storage(storage_mode=msg['storage_mode'], dfs_volume=msg['dfs_volume']).delete_image(
+                        path=msg['template_path'])
+
+            elif msg['_object'] == 'global':
+                if msg['action'] == 'refresh_guest_state':
+                    Host().refresh_guest_state()
+                    return
+
+                if msg['action'] == 'resend_host_facts':
+                    Host.host_facts_resend = True
+
+                if msg['action'] == 'query_metrics':
+                    # 例：prefix 为 guest:<uuid>:disk: 时，返回该 Guest 所有磁盘的数据。step 为 0 时返回原始样本
+                    extend_data['metrics'] = timeseries.query(
+                        prefix=msg['prefix'], since=msg.get('since', 0), until=msg.get('until', time.time()),
+                        step=msg.get('step', 0), limit=msg.get('limit'))
+
+                if msg['action'] == 'upgrade':
+                    try:
+                        log = self.upgrade(msg['url'])
+                        log_emit.info(msg=log)
 
-                    if msg['action'] == 'upgrade':
-                        try:
-                            log = self.upgrade(msg['url'])
-                            log_emit.info(msg=log)
+                    except subprocess.CalledProcessError as e:
+                        log_emit.warn(e.output)
+                        self.rollback()
+                        return
 
-                        except subprocess.CalledProcessError as e:
-                            log_emit.warn(e.output)
-                            self.rollback()
-                            continue
+                    log = self.restart()
+                    log_emit.info(msg=log)
 
-                        log = self.restart()
-                        log_emit.info(msg=log)
+                if msg['action'] == 'restart':
+                    log = self.restart()
+                    log_emit.info(msg=log)
 
-                    if msg['action'] == 'restart':
-                        log = self.restart()
-                        log_emit.info(msg=log)
+            else:
+                err = u'未支持的 _object：' + msg['_object']
+                log_emit.error(err)
 
-                else:
-                    err = u'未支持的 _object：' + msg['_object']
-                    log_emit.error(err)
+            response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg.get('uuid'),
+                                  data=extend_data, passback_parameters=msg.get('passback_parameters'))
 
-                response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg['uuid'],
-                                      data=extend_data, passback_parameters=msg.get('passback_parameters'))
+        except KeyError as e:
+            log_emit.warn(e.message)
+            if msg['_object'] == 'guest':
+                if msg['action'] == 'delete':
+                    response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg['uuid'],
+                                          data=extend_data, passback_parameters=msg.get('passback_parameters'))
 
-            except KeyError as e:
-                log_emit.warn(e.message)
-                if msg['_object'] == 'guest':
-                    if msg['action'] == 'delete':
-                        response_emit.success(_object=msg['_object'], action=msg['action'], uuid=msg['uuid'],
-                                              data=extend_data, passback_parameters=msg.get('passback_parameters'))
+        except:
+            log_emit.error(traceback.format_exc())
+            response_emit.failure(_object=msg['_object'], action=msg.get('action'), uuid=msg.get('uuid'),
+                                  passback_parameters=msg.get('passback_parameters'))
 
-            except:
-                # 防止循环线程，在redis连接断开时，混水写入日志
-                time.sleep(5)
-                log_emit.error(traceback.format_exc())
-                response_emit.failure(_object=msg['_object'], action=msg.get('action'), uuid=msg.get('uuid'),
-                                      passback_parameters=msg.get('passback_parameters'))
+        finally:
+            if entry_id is not None:
+                self.instruction_stream.ack_after_delivery(entry_id=entry_id)
 
     @staticmethod
     def guest_creating_progress_report_engine():
         """
-        Guest 创建进度上报引擎
+        Guest 创建进度上报引擎。消费复制过程推送的进度事件，每次唤醒时每个 Guest 至多上报一次
         """
 
-        list_creating_guest = list()
-        template_size = dict()
-
         while True:
             if Utils.exit_flag:
                 msg = 'Thread guest_creating_progress_report_engine say bye-bye'
@@ -319,34 +465,49 @@ class Host(object):
                 return
 
             try:
+                # uuid -> 最新的进度事件
+                events = dict()
+
                 try:
-                    payload = q_creating_guest.get(timeout=config['engine_cycle_interval'])
-                    list_creating_guest.append(payload)
-                    q_creating_guest.task_done()
+                    event = q_creating_guest.get(timeout=config['engine_cycle_interval'])
+
+                    while True:
+                        events[event['uuid']] = event
+                        q_creating_guest.task_done()
+                        event = q_creating_guest.get_nowait()
+
                 except Queue.Empty as e:
                     pass
 
-                # 当有 Guest 被创建时，略微等待一下，避免复制模板的动作还没开始，就开始计算进度。这样会产生找不到镜像路径的异常。
-                time.sleep(1)
-
                 threads_status['guest_creating_progress_report_engine'] = {'timestamp': ji.Common.ts()}
 
-                for i, guest in enumerate(list_creating_guest):
+                for uuid, event in events.items():
+                    if 'stage' in event:
+                        guest_event_emit.creating(uuid=uuid, progress=event['stage'])
+                        continue
 
-                    template_path = guest['template_path']
+                    # 复制失败的任务，由 Guest.create 上报失败，此处仅将其丢弃
+                    if event['finished'] and not event['ok']:
+                        continue
 
-                    storage = Storage(storage_mode=guest['storage_mode'], dfs_volume=guest['dfs_volume'])
+                    elapsed = event['ts'] - event['begin']
+                    speed = int(event['done'] / elapsed) if elapsed > 0 else None
+                    eta = None
 
-                    if template_path not in template_size:
-                        template_size[template_path] = float(storage.getsize(path=template_path))
+                    if event['finished']:
+                        progress = 90
+                        eta = 0
 
-                    system_image_size = storage.getsize(path=guest['system_image_path'])
-                    progress = system_image_size / template_size[template_path]
+                    elif event['total'] <= 0:
+                        continue
 
-                    guest_event_emit.creating(uuid=guest['uuid'], progress=int(progress * 90))
+                    else:
+                        # 完成与否以 close 为准，复制过程中的进度不到 90
+                        progress = min(int(event['done'] * 90 / event['total']), 89)
+                        if speed:
+                            eta = (event['total'] - event['done']) / speed
 
-                    if progress >= 1:
-                        del list_creating_guest[i]
+                    guest_event_emit.creating(uuid=uuid, progress=progress, speed=speed, eta=eta)
 
             except:
                 log_emit.warn(traceback.format_exc())
@@ -366,11 +527,13 @@ class Host(object):
 
     def update_disks(self):
         self.disks.clear()
+        self.disks_usage.clear()
         for disk in psutil.disk_partitions(all=False):
             disk_usage = psutil.disk_usage(disk.mountpoint)
             self.disks[disk.mountpoint] = {'device': disk.device, 'real_device': disk.device, 'fstype': disk.fstype,
-                                           'opts': disk.opts, 'total': disk_usage.total, 'used': disk_usage.used,
-                                           'free': disk_usage.free, 'percent': disk_usage.percent}
+                                           'opts': disk.opts, 'total': disk_usage.total}
+            self.disks_usage[disk.mountpoint] = {'used': disk_usage.used, 'free': disk_usage.free,
+                                                 'percent': disk_usage.percent}
 
             if os.path.islink(disk.device):
                 self.disks[disk.mountpoint]['real_device'] = os.path.realpath(disk.device)
@@ -407,7 +570,29 @@ class Host(object):
             except:
                 log_emit.warn(traceback.format_exc())
 
+    def host_facts(self, boot_time=None):
+        """
+        几乎不变的节点信息，仅在启动、内容变化或 JimV-C 要求时随心跳完整发送
+        """
+        return {'cpu': self.cpu, 'cpuinfo': self.cpuinfo, 'memory': self.memory, 'dmidecode': self.dmidecode,
+                'interfaces': self.interfaces, 'disks': self.disks, 'boot_time': boot_time, 'version': self.version}
+
     # 使用时，创建独立的实例来避开 多线程 的问题
+    @staticmethod
+    def subsystem_stats():
+        return {'instruction_dispatcher': instruction_dispatcher.stats(),
+                'event_dispatcher': event_dispatcher.stats(),
+                'collection_dispatcher': collection_dispatcher.stats(),
+                'event_loop': eventLoop.stats(),
+                'event_coalescer': event_coalescer.stats(),
+                'device_cache': device_cache.stats(),
+                'guest_counter_reader': guest_counter_reader.stats(),
+                'upstream_buffer': upstream_buffer.stats(),
+                'schedulers': Scheduler.all_stats(),
+                'counters': CounterState.all_stats(),
+                'timeseries': timeseries.stats(),
+                'image_pool': image_pool.stats()}
+
     def host_state_report_engine(self):
         """
         计算节点状态上报引擎
@@ -417,6 +602,12 @@ class Host(object):
         self.update_interfaces()
         self.update_disks()
         boot_time = ji.Common.ts()
+        facts = self.host_facts(boot_time=boot_time)
+        # 节点信息仅在刷新后重新计算摘要
+        version = Utils.md5(json.dumps(facts, sort_keys=True))
+        facts_version = None
+        facts_ts = 0
+        stats_ts = 0
 
         while True:
             if Utils.exit_flag:
@@ -434,13 +625,29 @@ class Host(object):
                 if ji.Common.ts() % 60 == 0:
                     self.update_interfaces()
                     self.update_disks()
-
-                host_event_emit.heartbeat(message={'node_id': self.node_id, 'cpu': self.cpu, 'cpuinfo': self.cpuinfo,
-                                                   'memory': self.memory, 'dmidecode': self.dmidecode,
-                                                   'interfaces': self.interfaces, 'disks': self.disks,
-                                                   'system_load': os.getloadavg(), 'boot_time': boot_time,
-                                                   'memory_available': psutil.virtual_memory().available,
-                                                   'threads_status': threads_status, 'version': self.version})
+                    facts = self.host_facts(boot_time=boot_time)
+                    version = Utils.md5(json.dumps(facts, sort_keys=True))
+
+                message = {'node_id': self.node_id, 'facts_version': version, 'full': False,
+                           'system_load': os.getloadavg(), 'memory_available': psutil.virtual_memory().available,
+                           'threads_status': threads_status}
+
+                # 磁盘用量及各子系统的统计变化缓慢，不随每秒的心跳发送
+                if ji.Common.ts() - stats_ts >= config['heartbeat_stats_interval']:
+                    stats_ts = ji.Common.ts()
+                    message['disks_usage'] = self.disks_usage
+                    message.update(self.subsystem_stats())
+
+                # 节点信息变化、JimV-C 要求重发，或距上次完整发送过久时，携带完整的节点信息
+                if version != facts_version or Host.host_facts_resend or \
+                        ji.Common.ts() - facts_ts >= config['heartbeat_full_interval']:
+                    Host.host_facts_resend = False
+                    facts_version = version
+                    facts_ts = ji.Common.ts()
+                    message.update(facts)
+                    message['full'] = True
+
+                host_event_emit.heartbeat(message=message)
 
             except:
                 log_emit.warn(traceback.format_exc())
@@ -455,175 +662,274 @@ class Host(object):
         except:
             log_emit.warn(traceback.format_exc())
 
-    def guest_cpu_memory_performance_report(self):
+    def refresh_guest_stats(self):
+        """
+        一次 getAllDomainStats 调用取得全部运行中 Guest 的统计数据，供各性能报告共用
+        """
+        self.guest_stats.clear()
+        self.guest_samples = dict()
 
-        data = list()
+        # 磁盘计数器始终取自 libvirt。blkio cgroup 只有整个 Guest 的合计，没有逐块磁盘的数据
+        stats_flags = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_BALLOON | \
+            libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BLOCK
 
-        for _uuid, dom in self.dom_mapping_by_uuid.items():
+        if config['guest_counter_source'] != 'sysfs':
+            stats_flags |= libvirt.VIR_DOMAIN_STATS_CPU_TOTAL | libvirt.VIR_DOMAIN_STATS_INTERFACE
 
-            if not dom.isActive():
-                continue
+        try:
+            # https://libvirt.org/html/libvirt-libvirt-domain.html#virConnectGetAllDomainStats
+            # NOWAIT: 某个 Guest 的监视器正忙(如磁盘卡在失联的 gluster brick 上)时，跳过需要监视器的统计项，而非等待
+            for dom, stats in self.conn.getAllDomainStats(
+                    stats=stats_flags,
+                    flags=libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE |
+                    libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_NOWAIT):
+                self.guest_stats[dom.UUIDString()] = (dom, stats)
 
-            _, _, _, cpu_count, _ = dom.info()
-            cpu_time2 = dom.getCPUStats(True)[0]['cpu_time']
+            self.guest_stats_ts = Utils.monotonic()
 
-            cpu_memory = dict()
+            if config['guest_counter_source'] == 'sysfs':
+                self.refresh_guest_counters()
 
-            if _uuid in self.last_guest_cpu_time:
-                cpu_load = (cpu_time2 - self.last_guest_cpu_time[_uuid]['cpu_time']) / self.interval / 1000 ** 3. \
-                           * 100 / cpu_count
-                # 计算 cpu_load 的公式：
-                # (cpu_time2 - cpu_time1) / interval_N / 1000**3.(nanoseconds to seconds) * 100(percent) /
-                # cpu_count
-                # cpu_time == user_time + system_time + guest_time
-                #
-                # 参考链接：
-                # https://libvirt.org/html/libvirt-libvirt-domain.html#VIR_DOMAIN_STATS_CPU_TOTAL
-                # https://stackoverflow.com/questions/40468370/what-does-cpu-time-represent-exactly-in-libvirt
+            # 已关机或已删除的 Guest。再次启动后 balloon 的统计周期复位，须重新开启
+            for _uuid in set(self.memory_stats_period_ts) - set(self.guest_stats):
+                del self.memory_stats_period_ts[_uuid]
 
-                memory_info = QGA.get_guest_memory_info(dom=dom)
+        except libvirt.libvirtError as e:
+            # 尝试重连 Libvirtd
+            logger.warn(e.message)
+            logger.warn(libvirt.virGetLastErrorMessage())
+            self.conn = None
+            self.init_conn()
 
-                memory_total = dom.maxMemory()
-                memory_available = 0
-                memory_rate = 0
+    def refresh_guest_counters(self):
+        """
+        并发读取各 Guest 的 CPU 及网卡计数器，且有统一的时限。未按时读完的 Guest 缺少这些字段，本周期不产生其 CPU 及流量数据
+        """
+        calls = dict()
+        for _uuid, (dom, stats) in self.guest_stats.items():
+            calls[_uuid] = (_uuid, guest_counter_reader.read, (dom,))
 
-                if memory_info.__len__() > 0:
-                    memory_available = memory_info.get('MemAvailable', None)
+        # 结果按时返回后才并入 stats，逾时的读取不会在报告生成期间修改 stats
+        for _uuid, counters in collection_dispatcher.gather(
+                calls=calls, timeout=config['guest_collection_deadline']).items():
+            if counters is not None:
+                self.guest_stats[_uuid][1].update(counters)
 
-                    if memory_available is not None:
-                        memory_available = memory_available.get('value', 0)
-                        memory_rate = int((1 - float(memory_available) / memory_total) * 100)
+    @staticmethod
+    def record_sample(name, sample):
+        # 仅记录数值字段，标识类字段(如 guest_uuid、name)已体现在实体名中
+        timeseries.record(name=name, ts=time.time(), data=dict(
+            [(k, v) for k, v in sample.items() if isinstance(v, (int, long, float)) and not isinstance(v, bool)]))
 
-                cpu_memory = {
-                    'guest_uuid': _uuid,
-                    'cpu_load': cpu_load if cpu_load <= 100 else 100,
-                    'memory_available': memory_available,
-                    'memory_rate': memory_rate
-                }
+    def guest_memory_available(self, _uuid, dom, stats):
+        """
+        优先使用 virtio-balloon 上报的内存统计；Guest 没有 balloon 驱动，或驱动不上报 usable 时，才经 qemu-guest-agent 读取 /proc/meminfo
+        :return: 可用内存，单位(KiB)。无法获取时返回 None
+        """
+        # 参考地址：https://libvirt.org/html/libvirt-libvirt-domain.html#VIR_DOMAIN_STATS_BALLOON
+        if 'balloon.usable' in stats:
+            return stats['balloon.usable']
 
-            else:
-                self.last_guest_cpu_time[_uuid] = dict()
+        # 不支持 usable 的旧版驱动只上报 unused，其不含可回收的页缓存，远小于实际可用内存，故不采用
+        # 统计周期默认为 0，即 balloon 驱动不上报。对每个 Guest 至多每 10 分钟尝试开启一次
+        if config['guest_memory_stats_period'] > 0 and 'balloon.last-update' not in stats and \
+                self.ts - self.memory_stats_period_ts.get(_uuid, 0) >= 600:
+            self.memory_stats_period_ts[_uuid] = self.ts
 
-            self.last_guest_cpu_time[_uuid]['cpu_time'] = cpu_time2
-            self.last_guest_cpu_time[_uuid]['timestamp'] = self.ts
+            try:
+                dom.setMemoryStatsPeriod(config['guest_memory_stats_period'], libvirt.VIR_DOMAIN_AFFECT_LIVE)
 
-            if cpu_memory.__len__() > 0:
-                data.append(cpu_memory)
+            except libvirt.libvirtError as e:
+                logger.debug(e.message)
 
-        if data.__len__() > 0:
-            guest_collection_performance_emit.cpu_memory(data=data)
+        if not guest_agent_liveness.alive(_uuid):
+            return None
 
-    def guest_traffic_performance_report(self):
+        memory_info = QGA.get_guest_memory_info(dom=dom)
+        memory_available = memory_info.get('MemAvailable', None)
 
-        data = list()
+        if memory_available is None:
+            return None
 
-        for _uuid, dom in self.dom_mapping_by_uuid.items():
+        return int(memory_available.get('value', 0))
 
-            if not dom.isActive():
-                continue
+    def guest_sample(self, _uuid, dom, stats):
+        return {
+            'memory_available': self.guest_memory_available(_uuid=_uuid, dom=dom, stats=stats)
+        }
 
-            root = ET.fromstring(dom.XMLDesc())
+    def refresh_guest_samples(self):
+        """
+        逐 Guest 的采样并发执行，且有统一的时限。个别 Guest 的 agent 或 libvirtd 调用卡住，不会拖延其它 Guest 及整个采样周期
+        """
+        calls = dict()
+        for _uuid, (dom, stats) in self.guest_stats.items():
+            calls[_uuid] = (_uuid, self.guest_sample, (_uuid, dom, stats))
 
-            for interface in root.findall('devices/interface'):
-                dev = interface.find('target').get('dev')
-                name = interface.find('alias').get('name')
-                interface_state = dom.interfaceStats(dev)
+        self.guest_samples = collection_dispatcher.gather(calls=calls, timeout=config['guest_collection_deadline'])
 
-                interface_id = '_'.join([_uuid, dev])
+    def guest_cpu_memory_performance_report(self):
 
-                traffic = dict()
-
-                if interface_id in self.last_guest_traffic:
-
-                    traffic = {
-                        'guest_uuid': _uuid,
-                        'name': name,
-                        'rx_bytes':
-                            (interface_state[0] - self.last_guest_traffic[interface_id]['rx_bytes']) / self.interval,
-                        'rx_packets':
-                            (interface_state[1] - self.last_guest_traffic[interface_id]['rx_packets']) / self.interval,
-                        'rx_errs': interface_state[2],
-                        'rx_drop': interface_state[3],
-                        'tx_bytes':
-                            (interface_state[4] - self.last_guest_traffic[interface_id]['tx_bytes']) / self.interval,
-                        'tx_packets':
-                            (interface_state[5] - self.last_guest_traffic[interface_id]['tx_packets']) / self.interval,
-                        'tx_errs': interface_state[6],
-                        'tx_drop': interface_state[7]
-                    }
+        data = list()
+        samples = list()
+
+        for _uuid, (dom, stats) in self.guest_stats.items():
+            if 'cpu.time' in stats:
+                samples.append((_uuid, [stats['cpu.time']]))
+
+        # 以两次采样的实际间隔计算，而非名义上的采集周期
+        for _uuid, delta, rate in self.guest_cpu_counter.update(samples=samples, now=self.guest_stats_ts):
+            dom, stats = self.guest_stats[_uuid]
+            cpu_count = stats['vcpu.current']
+
+            cpu_load = rate[0] / 1000 ** 3. * 100 / cpu_count
+            # 计算 cpu_load 的公式：
+            # (cpu_time2 - cpu_time1) / elapsed / 1000**3.(nanoseconds to seconds) * 100(percent) /
+            # cpu_count
+            # cpu_time == user_time + system_time + guest_time
+            #
+            # 参考链接：
+            # https://libvirt.org/html/libvirt-libvirt-domain.html#VIR_DOMAIN_STATS_CPU_TOTAL
+            # https://stackoverflow.com/questions/40468370/what-does-cpu-time-represent-exactly-in-libvirt
+
+            memory_total = stats['balloon.maximum']
+            memory_available = (self.guest_samples.get(_uuid) or dict()).get('memory_available')
+            memory_rate = 0
+
+            if memory_available is None:
+                memory_available = 0
 
-                else:
-                    self.last_guest_traffic[interface_id] = dict()
+            else:
+                memory_rate = int((1 - float(memory_available) / memory_total) * 100)
 
-                self.last_guest_traffic[interface_id]['rx_bytes'] = interface_state[0]
-                self.last_guest_traffic[interface_id]['rx_packets'] = interface_state[1]
-                self.last_guest_traffic[interface_id]['tx_bytes'] = interface_state[4]
-                self.last_guest_traffic[interface_id]['tx_packets'] = interface_state[5]
-                self.last_guest_traffic[interface_id]['timestamp'] = self.ts
+            cpu_memory = {
+                'guest_uuid': _uuid,
+                'cpu_load': cpu_load if cpu_load <= 100 else 100,
+                'memory_available': memory_available,
+                'memory_rate': memory_rate
+            }
 
-                if traffic.__len__() > 0:
-                    data.append(traffic)
+            self.record_sample(name=':'.join(['guest', _uuid, 'cpu_memory']), sample=cpu_memory)
+            data.append(cpu_memory)
 
         if data.__len__() > 0:
-            guest_collection_performance_emit.traffic(data=data)
+            guest_collection_performance_emit.cpu_memory(data=data)
 
-    def guest_disk_io_performance_report(self):
+    def guest_traffic_performance_report(self):
 
         data = list()
+        samples = list()
+        interfaces = dict()
+        aliases = dict()
 
-        for _uuid, dom in self.dom_mapping_by_uuid.items():
+        for _uuid, (dom, stats) in self.guest_stats.items():
 
-            if not dom.isActive():
-                continue
+            for i in range(stats.get('net.count', 0)):
+                prefix = 'net.' + i.__str__() + '.'
+                dev = stats[prefix + 'name']
+                interface_id = '_'.join([_uuid, dev])
 
-            root = ET.fromstring(dom.XMLDesc())
+                interfaces[interface_id] = (_uuid, dev, prefix)
+                samples.append((interface_id,
+                                [stats.get(prefix + key, 0) for key in self.guest_traffic_counter.fields]))
+
+        for interface_id, delta, rate in self.guest_traffic_counter.update(samples=samples, now=self.guest_stats_ts):
+            _uuid, dev, prefix = interfaces[interface_id]
+            dom, stats = self.guest_stats[_uuid]
+
+            if _uuid not in aliases:
+                # 统计数据中仅有 target dev，别名取自设备拓扑缓存
+                aliases[_uuid] = dict([(interface['dev'], interface['alias'])
+                                       for interface in device_cache.interfaces(dom)])
+
+            traffic = {
+                'guest_uuid': _uuid,
+                'name': aliases[_uuid].get(dev),
+                'rx_bytes': rate[0],
+                'rx_packets': rate[1],
+                'rx_errs': stats.get(prefix + 'rx.errs', 0),
+                'rx_drop': stats.get(prefix + 'rx.drop', 0),
+                'tx_bytes': rate[2],
+                'tx_packets': rate[3],
+                'tx_errs': stats.get(prefix + 'tx.errs', 0),
+                'tx_drop': stats.get(prefix + 'tx.drop', 0)
+            }
+
+            self.record_sample(name=':'.join(['guest', _uuid, 'interface', dev]), sample=traffic)
+            data.append(traffic)
 
-            for disk in root.findall('devices/disk'):
-                dev = disk.find('target').get('dev')
-                protocol = disk.find('source').get('protocol')
+        if data.__len__() > 0:
+            guest_collection_performance_emit.traffic(data=data)
 
-                dev_path = None
+    def guest_disk_io_performance_report(self):
 
-                if protocol in [None, 'file']:
-                    dev_path = disk.find('source').get('file')
+        data = list()
+        samples = list()
+        disks = dict()
+        keep = set()
 
-                elif protocol == 'gluster':
-                    dev_path = disk.find('source').get('name')
+        for _uuid, (dom, stats) in self.guest_stats.items():
+
+            for i in range(stats.get('block.count', 0)):
+                prefix = 'block.' + i.__str__() + '.'
+                # 本地磁盘为文件路径；gluster 磁盘为 卷名/路径。未插入介质的光驱等无该字段
+                dev_path = stats.get(prefix + 'path')
 
                 if dev_path is None:
                     continue
 
                 disk_uuid = dev_path.split('/')[-1].split('.')[0]
-                disk_state = dom.blockStats(dev)
-
-                disk_io = dict()
-
-                if disk_uuid in self.last_guest_disk_io:
 
-                    disk_io = {
-                        'disk_uuid': disk_uuid,
-                        'rd_req': (disk_state[0] - self.last_guest_disk_io[disk_uuid]['rd_req']) / self.interval,
-                        'rd_bytes': (disk_state[1] - self.last_guest_disk_io[disk_uuid]['rd_bytes']) / self.interval,
-                        'wr_req': (disk_state[2] - self.last_guest_disk_io[disk_uuid]['wr_req']) / self.interval,
-                        'wr_bytes': (disk_state[3] - self.last_guest_disk_io[disk_uuid]['wr_bytes']) / self.interval
-                    }
+                # NOWAIT 模式下，监视器正忙的 Guest 缺少计数字段，保留原基准值
+                if prefix + 'rd.reqs' not in stats:
+                    keep.add(disk_uuid)
+                    continue
 
-                else:
-                    self.last_guest_disk_io[disk_uuid] = dict()
+                disks[disk_uuid] = _uuid
+                samples.append((disk_uuid, [stats.get(prefix + key, 0) for key in self.guest_disk_io_counter.fields]))
 
-                self.last_guest_disk_io[disk_uuid]['rd_req'] = disk_state[0]
-                self.last_guest_disk_io[disk_uuid]['rd_bytes'] = disk_state[1]
-                self.last_guest_disk_io[disk_uuid]['wr_req'] = disk_state[2]
-                self.last_guest_disk_io[disk_uuid]['wr_bytes'] = disk_state[3]
-                self.last_guest_disk_io[disk_uuid]['timestamp'] = self.ts
+        for disk_uuid, delta, rate in self.guest_disk_io_counter.update(samples=samples, now=self.guest_stats_ts,
+                                                                        keep=keep):
+            disk_io = {
+                'disk_uuid': disk_uuid,
+                'rd_req': rate[0],
+                'rd_bytes': rate[1],
+                'wr_req': rate[2],
+                'wr_bytes': rate[3]
+            }
 
-                if disk_io.__len__() > 0:
-                    data.append(disk_io)
+            self.record_sample(name=':'.join(['guest', disks[disk_uuid], 'disk', disk_uuid]), sample=disk_io)
+            data.append(disk_io)
 
         if data.__len__() > 0:
             guest_collection_performance_emit.disk_io(data=data)
 
+    @staticmethod
+    def load_counter_states(counters):
+        # 沿用重启前的基准值，重启后的首次采样即可得出速率
+        snapshots = CounterState.load_all(path=config['counter_state_path'])
+
+        for counter in counters:
+            n = counter.load(snapshot=snapshots.get(counter.name), max_age=config['counter_state_max_age'])
+            logger.info(msg=' '.join(['Loaded', str(n), 'baselines of', counter.name]))
+
+    def guest_performance_gc(self):
+        # 计数器基准值随设备消失即时淘汰，此处只清理本地时序存储
+        timeseries.gc(before=time.time() - config['performance_gc_interval'])
+
     def guest_performance_collection_engine(self):
+        self.guest_cpu_counter = CounterState(name='guest_cpu', fields=['cpu.time'])
+        self.guest_traffic_counter = CounterState(
+            name='guest_traffic', fields=['rx.bytes', 'rx.pkts', 'tx.bytes', 'tx.pkts'])
+        self.guest_disk_io_counter = CounterState(
+            name='guest_disk_io', fields=['rd.reqs', 'rd.bytes', 'wr.reqs', 'wr.bytes'])
+        self.load_counter_states([self.guest_cpu_counter, self.guest_traffic_counter, self.guest_disk_io_counter])
+
+        scheduler = Scheduler(name='guest_performance_collection')
+        scheduler.add('cpu_memory', config['guest_cpu_memory_interval'])
+        scheduler.add('traffic', config['guest_traffic_interval'])
+        scheduler.add('disk_io', config['guest_disk_io_interval'])
+        scheduler.add('gc', config['performance_gc_interval'])
 
         while True:
             if Utils.exit_flag:
@@ -633,32 +939,31 @@ class Host(object):
                 return
 
             try:
-                time.sleep(config['engine_cycle_interval'])
+                time.sleep(min(scheduler.timeout(), config['engine_cycle_interval']))
                 threads_status['guest_performance_collection_engine'] = {'timestamp': ji.Common.ts()}
                 self.ts = ji.Common.ts()
 
-                if self.ts % self.interval != 0:
-                    continue
+                due = scheduler.due()
 
-                if self.ts % 3600 == 0:
-                    # 一小时做一次 垃圾回收 操作
-                    for k, v in self.last_guest_cpu_time.items():
-                        if (self.ts - v['timestamp']) > self.interval * 2:
-                            del self.last_guest_cpu_time[k]
+                if 'gc' in due:
+                    due.remove('gc')
+                    self.guest_performance_gc()
 
-                    for k, v in self.last_guest_traffic.items():
-                        if (self.ts - v['timestamp']) > self.interval * 2:
-                            del self.last_guest_traffic[k]
+                if due.__len__() < 1:
+                    continue
 
-                    for k, v in self.last_guest_disk_io.items():
-                        if (self.ts - v['timestamp']) > self.interval * 2:
-                            del self.last_guest_disk_io[k]
+                self.refresh_guest_stats()
 
-                self.refresh_dom_mapping()
+                if 'cpu_memory' in due:
+                    # 逐 Guest 的采样(含 agent 调用)仅供 CPU、内存报告使用
+                    self.refresh_guest_samples()
+                    self.guest_cpu_memory_performance_report()
+
+                if 'traffic' in due:
+                    self.guest_traffic_performance_report()
 
-                self.guest_cpu_memory_performance_report()
-                self.guest_traffic_performance_report()
-                self.guest_disk_io_performance_report()
+                if 'disk_io' in due:
+                    self.guest_disk_io_performance_report()
 
             except:
                 log_emit.warn(traceback.format_exc())
@@ -671,42 +976,38 @@ class Host(object):
             'memory_available': psutil.virtual_memory().available,
         }
 
+        self.record_sample(name='host:cpu_memory', sample=cpu_memory)
         host_collection_performance_emit.cpu_memory(data=cpu_memory)
 
     def host_traffic_performance_report(self):
 
         data = list()
         net_io = psutil.net_io_counters(pernic=True)
+        samples = list()
 
         for nic_name in self.interfaces.keys():
             nic = net_io.get(nic_name, None)
             if nic is None:
                 continue
 
-            traffic = list()
-
-            if nic_name in self.last_host_traffic:
-                traffic = {
-                    'node_id': self.node_id,
-                    'name': nic_name,
-                    'rx_bytes': (nic.bytes_recv - self.last_host_traffic[nic_name].bytes_recv) / self.interval,
-                    'rx_packets':
-                        (nic.packets_recv - self.last_host_traffic[nic_name].packets_recv) / self.interval,
-                    'rx_errs': (nic.errin - self.last_host_traffic[nic_name].errin),
-                    'rx_drop': (nic.dropin - self.last_host_traffic[nic_name].dropin),
-                    'tx_bytes': (nic.bytes_sent - self.last_host_traffic[nic_name].bytes_sent) / self.interval,
-                    'tx_packets':
-                        (nic.packets_sent - self.last_host_traffic[nic_name].packets_sent) / self.interval,
-                    'tx_errs': (nic.errout - self.last_host_traffic[nic_name].errout),
-                    'tx_drop': (nic.dropout - self.last_host_traffic[nic_name].dropout)
-                }
-            elif not isinstance(self.last_host_disk_io, dict):
-                self.last_host_traffic = dict()
-
-            self.last_host_traffic[nic_name] = nic
-
-            if traffic.__len__() > 0:
-                data.append(traffic)
+            samples.append((nic_name, [getattr(nic, field) for field in self.host_traffic_counter.fields]))
+
+        for nic_name, delta, rate in self.host_traffic_counter.update(samples=samples, now=Utils.monotonic()):
+            traffic = {
+                'node_id': self.node_id,
+                'name': nic_name,
+                'rx_bytes': rate[0],
+                'rx_packets': rate[1],
+                'rx_errs': delta[2],
+                'rx_drop': delta[3],
+                'tx_bytes': rate[4],
+                'tx_packets': rate[5],
+                'tx_errs': delta[6],
+                'tx_drop': delta[7]
+            }
+
+            self.record_sample(name=':'.join(['host', 'interface', nic_name]), sample=traffic)
+            data.append(traffic)
 
         if data.__len__() > 0:
             host_collection_performance_emit.traffic(data=data)
@@ -715,37 +1016,49 @@ class Host(object):
 
         data = list()
         disk_io_counters = psutil.disk_io_counters(perdisk=True)
+        samples = list()
 
         for mountpoint, disk in self.disks.items():
             dev = os.path.basename(disk['real_device'])
-            disk_usage_io = list()
-            if dev in self.last_host_disk_io:
-                disk_usage_io = {
-                    'node_id': self.node_id,
-                    'mountpoint': mountpoint,
-                    'used': psutil.disk_usage(mountpoint).used,
-                    'rd_req':
-                        (disk_io_counters[dev].read_count - self.last_host_disk_io[dev].read_count) / self.interval,
-                    'rd_bytes':
-                        (disk_io_counters[dev].read_bytes - self.last_host_disk_io[dev].read_bytes) / self.interval,
-                    'wr_req':
-                        (disk_io_counters[dev].write_count - self.last_host_disk_io[dev].write_count) / self.interval,
-                    'wr_bytes':
-                        (disk_io_counters[dev].write_bytes - self.last_host_disk_io[dev].write_bytes) / self.interval
-                }
-
-            elif not isinstance(self.last_host_disk_io, dict):
-                self.last_host_disk_io = dict()
-
-            self.last_host_disk_io[dev] = disk_io_counters[dev]
-
-            if disk_usage_io.__len__() > 0:
-                data.append(disk_usage_io)
+            if dev not in disk_io_counters:
+                continue
+
+            samples.append((mountpoint, [getattr(disk_io_counters[dev], field)
+                                         for field in self.host_disk_io_counter.fields]))
+
+        for mountpoint, delta, rate in self.host_disk_io_counter.update(samples=samples, now=Utils.monotonic()):
+            disk_usage_io = {
+                'node_id': self.node_id,
+                'mountpoint': mountpoint,
+                'used': psutil.disk_usage(mountpoint).used,
+                'rd_req': rate[0],
+                'rd_bytes': rate[1],
+                'wr_req': rate[2],
+                'wr_bytes': rate[3]
+            }
+
+            self.record_sample(name=':'.join(['host', 'disk', mountpoint]), sample=disk_usage_io)
+            data.append(disk_usage_io)
 
         if data.__len__() > 0:
             host_collection_performance_emit.disk_usage_io(data=data)
 
     def host_performance_collection_engine(self):
+        self.host_traffic_counter = CounterState(
+            name='host_traffic', fields=['bytes_recv', 'packets_recv', 'errin', 'dropin',
+                                         'bytes_sent', 'packets_sent', 'errout', 'dropout'])
+        self.host_disk_io_counter = CounterState(
+            name='host_disk_io', fields=['read_count', 'read_bytes', 'write_count', 'write_bytes'])
+        self.load_counter_states([self.host_traffic_counter, self.host_disk_io_counter])
+
+        scheduler = Scheduler(name='host_performance_collection')
+        scheduler.add('cpu_memory', config['host_cpu_memory_interval'])
+        scheduler.add('traffic', config['host_traffic_interval'])
+        scheduler.add('disk_usage_io', config['host_disk_usage_io_interval'])
+        # 保存全部计数器(含 Guest 的)的基准值。推迟首次保存，以免在 Guest 采集引擎载入前覆盖其基准值
+        scheduler.add('save_counter_states', config['counter_state_save_interval'],
+                      delay=config['counter_state_save_interval'])
+
         while True:
             if Utils.exit_flag:
                 msg = 'Thread host_performance_collection_engine say bye-bye'
@@ -754,18 +1067,25 @@ class Host(object):
                 return
 
             try:
-                time.sleep(config['engine_cycle_interval'])
+                time.sleep(min(scheduler.timeout(), config['engine_cycle_interval']))
                 threads_status['host_performance_collection_engine'] = {'timestamp': ji.Common.ts()}
                 self.ts = ji.Common.ts()
 
-                if self.ts % self.interval != 0:
-                    continue
+                due = scheduler.due()
+
+                if 'cpu_memory' in due:
+                    self.host_cpu_memory_performance_report()
+
+                if 'traffic' in due:
+                    self.update_interfaces()
+                    self.host_traffic_performance_report()
+
+                if 'disk_usage_io' in due:
+                    self.update_disks()
+                    self.host_disk_usage_io_performance_report()
 
-                self.update_interfaces()
-                self.update_disks()
-                self.host_cpu_memory_performance_report()
-                self.host_traffic_performance_report()
-                self.host_disk_usage_io_performance_report()
+                if 'save_counter_states' in due:
+                    CounterState.save_all(path=config['counter_state_path'])
 
             except:
                 log_emit.warn(traceback.format_exc())
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import hashlib
+import threading
+import time
+import traceback
+import uuid
+import jimit as ji
+import psutil
+
+from runtime import Runtime
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/10'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class ImagePool(object):
+    """
+    常用模板的备用系统镜像池。空闲时在后台预先复制模板，创建 Guest 时直接将备用镜像改名为其系统镜像，免去复制。
+    备用镜像按系统镜像所在目录分别存放于其下的 .pool 目录，以保证改名在同一文件系统内完成。
+    """
+
+    def __init__(self, node_id='', depth=0, min_requests=2, max_templates=4, idle_delay=30, max_iowait=5,
+                 refill_interval=5):
+        """
+        :param node_id: 共享挂载时多个节点共用同一目录，备用镜像的文件名以节点 ID 区分
+        :param min_requests: 被请求达到该次数的模板视为常用，至多 max_templates 个
+        :param idle_delay: 距最近一次创建不足该秒数时不补充
+        :param max_iowait: iowait 高于该百分比时不补充
+        """
+        self.node_id = node_id
+        self.depth = depth
+        self.min_requests = min_requests
+        self.max_templates = max_templates
+        self.idle_delay = idle_delay
+        self.max_iowait = max_iowait
+        self.refill_interval = refill_interval
+        self.lock = threading.Lock()
+        # (storage_mode, dfs_volume, template_path, 系统镜像目录) -> {'dir', 'ready', 'requests', 'template_stat', 'scanned'}
+        self.templates = dict()
+        self.last_request = 0
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.stale = 0
+        self.no_space = 0
+
+    @staticmethod
+    def storage(key):
+        # 延迟导入，使本模块无需加载配置文件即可导入
+        from storage import Storage
+        return Storage(storage_mode=key[0], dfs_volume=key[1])
+
+    def file_prefix(self, template_path, template_stat=None):
+        """
+        :param template_stat: 模板的 (大小, 修改时间, inode)。为 None 时返回该模板所有版本共用的前缀
+        """
+        prefix = '_'.join([self.node_id, hashlib.md5(template_path).hexdigest()[:16]]) + '_'
+
+        if template_stat is None:
+            return prefix
+
+        return prefix + hashlib.md5(repr(template_stat)).hexdigest()[:8] + '_'
+
+    def take(self, storage_mode=None, dfs_volume=None, template_path=None, system_image_path=None):
+        """
+        :return: 是否已将备用镜像改名为 system_image_path。为 False 时，调用者须自行复制模板
+        """
+        if self.depth < 1:
+            return False
+
+        directory = os.path.dirname(system_image_path)
+        key = (storage_mode, dfs_volume, template_path, directory)
+
+        with self.lock:
+            self.last_request = time.time()
+            template = self.templates.get(key)
+
+            if template is None:
+                template = {'dir': os.path.join(directory, '.pool'), 'ready': list(), 'requests': 0,
+                            'template_stat': None, 'scanned': False}
+                self.templates[key] = template
+
+            template['requests'] += 1
+
+            if template['ready'].__len__() < 1:
+                self.misses += 1
+                return False
+
+        storage = self.storage(key)
+
+        # 模板被原地替换时，已有的备用镜像作废
+        if not self.validate(key, template, storage.stat(path=template_path)):
+            with self.lock:
+                self.misses += 1
+
+            return False
+
+        with self.lock:
+            if template['ready'].__len__() < 1:
+                self.misses += 1
+                return False
+
+            path = template['ready'].pop()
+
+        try:
+            storage.rename_image(src=path, dst=system_image_path)
+
+        except:
+            from initialize import log_emit
+            log_emit.warn(traceback.format_exc())
+            self.remove(key, [path])
+
+            with self.lock:
+                self.misses += 1
+
+            return False
+
+        with self.lock:
+            self.hits += 1
+
+        return True
+
+    def validate(self, key, template, template_stat):
+        """
+        :return: 备用镜像是否复制自当前版本的模板。否则将其清空，并以 template_stat 作为当前版本
+        """
+        with self.lock:
+            if template['template_stat'] == template_stat:
+                return True
+
+            stale = template['ready']
+            template['ready'] = list()
+            template['template_stat'] = template_stat
+            self.stale += stale.__len__()
+
+        self.remove(key, stale)
+        return False
+
+    def popular(self):
+        """
+        :return: 须保持备用镜像的模板
+        """
+        keys = [key for key, template in self.templates.items() if template['requests'] >= self.min_requests]
+        keys.sort(key=lambda k: self.templates[k]['requests'], reverse=True)
+        return set(keys[:self.max_templates])
+
+    def remove(self, key, paths):
+        storage = self.storage(key)
+
+        for path in paths:
+            try:
+                storage.delete_image(path=path)
+
+            except:
+                from initialize import log_emit
+                log_emit.warn(traceback.format_exc())
+
+    def scan(self, key, template):
+        """
+        收养上次运行遗留的、复制自当前版本模板的备用镜像，删除未复制完成的临时文件及复制自旧版本模板的镜像
+        """
+        storage = self.storage(key)
+        template_stat = storage.stat(path=key[2])
+        file_prefix = self.file_prefix(key[2])
+        current_prefix = self.file_prefix(key[2], template_stat)
+        ready = list()
+        obsolete = list()
+
+        for name in storage.listdir(path=template['dir']):
+            if not name.startswith(file_prefix):
+                continue
+
+            if name.endswith('.tmp') or not name.startswith(current_prefix):
+                obsolete.append(os.path.join(template['dir'], name))
+
+            else:
+                ready.append(os.path.join(template['dir'], name))
+
+        self.remove(key, obsolete)
+
+        with self.lock:
+            template['ready'].extend(ready)
+            template['scanned'] = True
+            template['template_stat'] = template_stat
+
+    def purge(self, template_path):
+        """
+        模板被删除时，删除其全部备用镜像
+        """
+        with self.lock:
+            keys = [key for key in self.templates.keys() if key[2] == template_path]
+            templates = [(key, self.templates.pop(key)) for key in keys]
+
+        for key, template in templates:
+            self.remove(key, template['ready'])
+
+    def idle(self):
+        if time.time() - self.last_request < self.idle_delay:
+            return False
+
+        # 自上次调用以来的 CPU 时间占比
+        return psutil.cpu_times_percent(interval=None).iowait <= self.max_iowait
+
+    def next_template(self):
+        """
+        :return: (key, template)，下一个须补充备用镜像的模板。顺带清空已不再常用的模板的备用镜像
+        """
+        with self.lock:
+            popular = self.popular()
+            drained = list()
+
+            for key, template in self.templates.items():
+                if key not in popular and template['ready'].__len__() > 0:
+                    drained.append((key, template['ready']))
+                    template['ready'] = list()
+
+        for key, paths in drained:
+            self.remove(key, paths)
+
+        with self.lock:
+            templates = [(key, self.templates[key]) for key in popular]
+
+        for key, template in templates:
+            if not template['scanned']:
+                self.scan(key, template)
+
+        with self.lock:
+            wanting = [(key, template) for key, template in templates
+                       if template['ready'].__len__() < self.depth]
+
+        if wanting.__len__() < 1:
+            return None
+
+        return min(wanting, key=lambda item: item[1]['ready'].__len__())
+
+    def refill(self, key, template):
+        """
+        :return: 是否已补充一个备用镜像
+        """
+        storage = self.storage(key)
+        template_stat = storage.stat(path=key[2])
+        self.validate(key, template, template_stat)
+
+        # 以模板的大小估算，不使复制占满系统镜像所在的文件系统
+        if storage.free_space(path=key[3]) < template_stat[0]:
+            with self.lock:
+                self.no_space += 1
+
+            return False
+
+        path = os.path.join(template['dir'], self.file_prefix(key[2], template_stat) + uuid.uuid4().hex + '.qcow2')
+        tmp_path = path + '.tmp'
+
+        def on_progress(done, total):
+            from initialize import threads_status
+            # 大模板的复制可能超过看门狗的时限
+            threads_status['image_pool_refill_engine'] = {'timestamp': ji.Common.ts()}
+
+        try:
+            storage.copy_file(src=key[2], dst=tmp_path, callback=on_progress)
+            storage.rename_image(src=tmp_path, dst=path)
+
+        except:
+            self.remove(key, [tmp_path])
+            raise
+
+        with self.lock:
+            # 复制期间模板被删除或被替换
+            orphaned = self.templates.get(key) is not template or template['template_stat'] != template_stat
+
+            if not orphaned:
+                template['ready'].append(path)
+                self.refills += 1
+
+        if orphaned:
+            self.remove(key, [path])
+            return False
+
+        return True
+
+    def refill_engine(self):
+        from initialize import logger, log_emit, threads_status
+
+        while True:
+            threads_status['image_pool_refill_engine'] = {'timestamp': ji.Common.ts()}
+
+            if Runtime.exit_flag:
+                msg = 'Thread image_pool_refill_engine say bye-bye'
+                print msg
+                logger.info(msg=msg)
+                return
+
+            time.sleep(self.refill_interval)
+
+            if self.depth < 1:
+                continue
+
+            try:
+                item = self.next_template()
+
+                if item is not None and self.idle():
+                    self.refill(*item)
+
+            except:
+                log_emit.warn(traceback.format_exc())
+
+    def stats(self):
+        with self.lock:
+            templates = dict()
+
+            for key, template in self.templates.items():
+                if template['ready'].__len__() > 0:
+                    templates[key[2]] = templates.get(key[2], 0) + template['ready'].__len__()
+
+            return {
+                'depth': self.depth,
+                'templates': templates,
+                'hits': self.hits,
+                'misses': self.misses,
+                'refills': self.refills,
+                'stale': self.stale,
+                'no_space': self.no_space
+            }
@@ -15,7 +15,15 @@ import Queue
 import errno
 
 from jimvn_exception import PathNotExist
-from utils import LogEmit, GuestEventEmit, ResponseEmit, HostEventEmit
+from spool import Spool
+from dispatcher import Dispatcher
+from event_coalescer import EventCoalescer
+from timeseries import TimeSeriesStore
+from file_copier import FileCopier
+from image_pool import ImagePool
+from domain_cache import DomainCache
+from upstream_buffer import UpstreamBuffer
+from utils import Utils, LogEmit, GuestEventEmit, ResponseEmit, HostEventEmit
 from utils import GuestCollectionPerformanceEmit, HostCollectionPerformanceEmit
 
 
@@ -30,13 +38,95 @@ class Init(object):
     config = {
         'config_file': '/etc/jimvn.conf',
         'log_cycle': 'D',
+        # 共享指令频道，仅用于全局指令。各节点另订阅 <instruction_channel>:<node_id> 接收发给自己的指令
         'instruction_channel': 'C:Instruction',
+        # 节点存活键 <node_keepalive_key_prefix>:<node_id>
+        'node_keepalive_key_prefix': 'K:NodeKeepalive',
+        'node_keepalive_interval': 10,
+        'node_keepalive_ttl': 30,
+        # 指令接收方式。pubsub: 订阅频道；stream: 经由 Redis Stream 消费组，确认后才算送达
+        'instruction_intake_mode': 'pubsub',
+        # 本节点指令流 <instruction_stream>:<node_id>
+        'instruction_stream': 'S:Instruction',
+        'instruction_stream_group': 'JimV-N',
+        'instruction_stream_batch': 32,
+        # 其它消费者的待确认指令闲置超过该时长(毫秒)后被认领
+        'instruction_stream_claim_idle': 60000,
         'downstream_queue': 'Q:Downstream',
         'upstream_queue': 'Q:Upstream',
+        # 上行消息缓冲区容量、单个 RPUSH 携带的消息数，及消息在缓冲区中的最长停留时间(秒)
+        'upstream_buffer_size': 10000,
+        'upstream_batch_size': 500,
+        'upstream_flush_interval': 0.2,
+        # Redis 不可达时，上行消息的本地暂存区。分段大小、总容量上限(字节)，及批量 fsync 的间隔(秒)
+        'spool_path': '/var/spool/jimvn',
+        'spool_segment_size': 16 * 1024 ** 2,
+        'spool_max_size': 1024 ** 3,
+        'spool_fsync_interval': 1,
+        # Redis 不可达后，重新尝试推送的间隔(秒)
+        'upstream_retry_interval': 5,
         'DEBUG': False,
         'daemon': False,
         'pidfile': '/run/jimv/jimvn.pid',
         'engine_cycle_interval': 1,
+        # 心跳携带完整节点信息的最长间隔，单位(秒)。其余心跳仅携带易变字段及节点信息版本
+        'heartbeat_full_interval': 600,
+        # 心跳携带磁盘用量及各子系统统计的间隔，单位(秒)
+        'heartbeat_stats_interval': 60,
+        # 指令处理工作线程数，及待处理指令的上限
+        'instruction_workers': 8,
+        'instruction_max_pending': 1024,
+        # libvirt 事件处理工作线程数，及待处理事件的上限。超出上限的事件被丢弃并计数
+        'event_workers': 4,
+        'event_max_pending': 4096,
+        # 同一 Guest 的连续事件合并上报。静默该时长后上报，持续有事件时最迟延后 max_delay，单位(秒)
+        'event_coalesce_window': 0.5,
+        'event_coalesce_max_delay': 2,
+        # Guest 索引与 libvirtd 对账的周期，单位(秒)
+        'domain_cache_reconcile_interval': 60,
+        # guest-ping 工作线程数、存活结论的有效期(秒)，及单次 ping 的超时(秒)
+        'guest_agent_ping_workers': 4,
+        'guest_agent_ping_interval': 10,
+        'guest_agent_ping_timeout': 3,
+        # virtio-balloon 驱动上报 Guest 内存统计的周期，单位(秒)。0 表示不开启
+        'guest_memory_stats_period': 10,
+        # 逐 Guest 采样(如经 agent 读取内存信息)的并发数，及每个采样周期等待采样结果的时限，单位(秒)
+        'guest_collection_workers': 8,
+        'guest_collection_deadline': 10,
+        # 各类性能数据的采集周期，最小为 1，单位(秒)
+        'guest_cpu_memory_interval': 60,
+        'guest_traffic_interval': 60,
+        'guest_disk_io_interval': 60,
+        'host_cpu_memory_interval': 60,
+        'host_traffic_interval': 60,
+        'host_disk_usage_io_interval': 60,
+        # 清理已消失 Guest 的计数器基准值的周期，单位(秒)
+        'performance_gc_interval': 3600,
+        # 本地时序存储中每个实体保留的样本数，及实体数量上限。每个字段每个样本占 8 字节
+        'timeseries_capacity': 600,
+        'timeseries_max_tables': 4096,
+        # query_metrics 指令单次返回的实体数量上限
+        'timeseries_query_max_tables': 256,
+        # 计数器基准值的状态文件、保存周期(秒)，及重启后仍可沿用的最大年龄(秒)
+        'counter_state_path': '/var/lib/jimvn/counter_state.json',
+        'counter_state_save_interval': 60,
+        'counter_state_max_age': 300,
+        # Guest 网卡及 CPU 计数器的来源。sysfs: 直接读取 tap 设备及 cgroup 的计数器，读取失败时退回 libvirt；libvirt: 全部经 libvirt 获取
+        'guest_counter_source': 'libvirt',
+        # 本地模板镜像复制的单次块大小(字节)，须为 4096 的整数倍
+        'copy_chunk_size': 64 * 1024 * 1024,
+        # 系统镜像复制进度的推送粒度。进度增长达到该百分比，或距上次推送达到该秒数时推送
+        'creating_progress_step': 1,
+        'creating_progress_interval': 1,
+        # 每个常用模板预先复制备用的系统镜像数量，0 表示不启用。被请求达到 image_pool_min_requests 次的模板视为常用，
+        # 至多 image_pool_max_templates 个
+        'image_pool_depth': 0,
+        'image_pool_min_requests': 2,
+        'image_pool_max_templates': 4,
+        # 补充备用镜像的检查周期(秒)。距最近一次创建不足 image_pool_idle_delay 秒，或 iowait 高于 image_pool_max_iowait(%)时不补充
+        'image_pool_refill_interval': 5,
+        'image_pool_idle_delay': 30,
+        'image_pool_max_iowait': 5,
         'version': '0.7',
         'jimvn_path': '/usr/local/JimV-N'
     }
@@ -152,30 +242,68 @@ q_creating_guest = Queue.Queue()
 
 host_cpu_count = multiprocessing.cpu_count()
 
+spool = Spool(path=config['spool_path'], segment_size=config['spool_segment_size'], max_size=config['spool_max_size'],
+              fsync_interval=config['spool_fsync_interval'])
+
+upstream_buffer = UpstreamBuffer(r=r, upstream_queue=config['upstream_queue'], max_size=config['upstream_buffer_size'],
+                                 batch_size=config['upstream_batch_size'],
+                                 flush_interval=config['upstream_flush_interval'], spool=spool,
+                                 retry_interval=config['upstream_retry_interval'])
+
 # 创建 JimV-N 向 JimV-C 推送事件消息的发射器
 log_emit = LogEmit()
 log_emit.upstream_queue = config['upstream_queue']
 log_emit.r = r
+log_emit.buffer = upstream_buffer
 
 guest_event_emit = GuestEventEmit()
 guest_event_emit.upstream_queue = config['upstream_queue']
 guest_event_emit.r = r
+guest_event_emit.buffer = upstream_buffer
 
 host_event_emit = HostEventEmit()
 host_event_emit.upstream_queue = config['upstream_queue']
 host_event_emit.r = r
+host_event_emit.buffer = upstream_buffer
 
 response_emit = ResponseEmit()
 response_emit.upstream_queue = config['upstream_queue']
 response_emit.r = r
+response_emit.buffer = upstream_buffer
 
 guest_collection_performance_emit = GuestCollectionPerformanceEmit()
 guest_collection_performance_emit.upstream_queue = config['upstream_queue']
 guest_collection_performance_emit.r = r
+guest_collection_performance_emit.buffer = upstream_buffer
 
 host_collection_performance_emit = HostCollectionPerformanceEmit()
 host_collection_performance_emit.upstream_queue = config['upstream_queue']
 host_collection_performance_emit.r = r
+host_collection_performance_emit.buffer = upstream_buffer
 
 threads_status = dict()
 
+
+instruction_dispatcher = Dispatcher(name='instruction', workers=config['instruction_workers'],
+                                    max_pending=config['instruction_max_pending'])
+
+# libvirt 事件回调只负责投递，耗时的上报由该派发器的工作线程完成。同一 Guest 的事件按序处理
+event_dispatcher = Dispatcher(name='event', workers=config['event_workers'], max_pending=config['event_max_pending'])
+
+# 逐 Guest 的性能采样。同一 Guest 至多一个采样在途，待执行任务数不会超过 Guest 数
+collection_dispatcher = Dispatcher(name='collection', workers=config['guest_collection_workers'])
+
+event_coalescer = EventCoalescer(dispatcher=event_dispatcher, window=config['event_coalesce_window'],
+                                 max_delay=config['event_coalesce_max_delay'])
+
+timeseries = TimeSeriesStore(capacity=config['timeseries_capacity'], max_tables=config['timeseries_max_tables'],
+                             query_max_tables=config['timeseries_query_max_tables'])
+
+file_copier = FileCopier(chunk_size=config['copy_chunk_size'])
+
+image_pool = ImagePool(node_id=Utils.get_node_id().__str__(), depth=config['image_pool_depth'],
+                       min_requests=config['image_pool_min_requests'], max_templates=config['image_pool_max_templates'],
+                       idle_delay=config['image_pool_idle_delay'], max_iowait=config['image_pool_max_iowait'],
+                       refill_interval=config['image_pool_refill_interval'])
+
+domain_cache = DomainCache(reconcile_interval=config['domain_cache_reconcile_interval'])
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import redis
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class InstructionStream(object):
+    """
+    本节点的指令流(Redis Stream)。以消费组读取指令，执行结果送达后再确认，确认前进程退出的指令于下次启动时重新派发。
+    """
+
+    def __init__(self, r=None, stream=None, group=None, consumer=None, batch=32, block=1, claim_idle=60000,
+                 accept=None, submit=None, buffer=None):
+        """
+        :param block: XREADGROUP 的最长阻塞时间，单位(秒)
+        :param claim_idle: 其它消费者遗留的指令，未确认超过该时长才予以认领，单位(毫秒)
+        :param accept: accept(data)，解析一条指令，无需处理时返回 None
+        :param submit: submit(msg, entry_id)，派发一条指令。指令执行完毕后须调用 ack_after_delivery
+        :param buffer: 上行消息缓冲区，确认于其中先于确认入队的应答送达后进行
+        """
+        self.r = r
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer
+        self.batch = batch
+        self.block = block
+        self.claim_idle = claim_idle
+        self.accept = accept
+        self.submit = submit
+        self.buffer = buffer
+
+    def init(self, replay=True):
+        """
+        创建本节点指令流的消费组，并认领启动前未确认的指令
+        :param replay: 是否重新派发待确认的指令。仅于启动时进行，运行中待确认的指令可能仍在执行或等待应答送达
+        """
+        try:
+            # 从流的起始位置建组，避免遗漏建组前已写入的指令
+            self.r.execute_command('XGROUP', 'CREATE', self.stream, self.group, '0', 'MKSTREAM')
+
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in e.message:
+                raise
+
+        if not replay:
+            return
+
+        # 本消费者此前已读取但未确认的指令。其确认是异步的，故须按条目 ID 向后翻页
+        entries = self.read(last_id='0')
+        while entries.__len__() > 0:
+            entries = self.read(last_id=entries[-1][0])
+
+        # 其它消费者(如更名前的本节点)遗留且超时未确认的指令
+        start = '-'
+        while True:
+            pending = self.r.execute_command('XPENDING', self.stream, self.group, start, '+', self.batch) or list()
+
+            for entry_id, consumer, idle, deliveries in pending:
+                if consumer == self.consumer or idle < self.claim_idle:
+                    continue
+
+                entries = self.r.execute_command('XCLAIM', self.stream, self.group, self.consumer, self.claim_idle,
+                                                 entry_id)
+                self.dispatch(entries=entries)
+
+            if pending.__len__() < self.batch:
+                break
+
+            start = self.next_id(pending[-1][0])
+
+    @staticmethod
+    def next_id(entry_id):
+        """
+        :return: 紧随 entry_id 之后的条目 ID。XPENDING 的区间为闭区间，翻页时以此跳过上一页的最后一条
+        """
+        ms, seq = entry_id.split('-')
+        return '-'.join([ms, (int(seq) + 1).__str__()])
+
+    def read(self, last_id='>'):
+        """
+        :param last_id: '>' 读取新指令；其它值时读取本消费者 ID 大于 last_id 的待确认指令
+        :return: 本次读取的条目
+        """
+        ret = self.r.execute_command('XREADGROUP', 'GROUP', self.group, self.consumer, 'COUNT', self.batch,
+                                     'BLOCK', int(self.block * 1000), 'STREAMS', self.stream, last_id)
+
+        if not ret:
+            return list()
+
+        _, entries = ret[0]
+        self.dispatch(entries=entries)
+        return entries
+
+    def dispatch(self, entries=None):
+        for entry_id, fields in entries or list():
+            # 已被删除的条目，其字段为空
+            fields = dict(zip(fields[::2], fields[1::2])) if fields else dict()
+            msg = self.accept(fields['data']) if 'data' in fields else None
+
+            if msg is None:
+                self.ack(entry_id=entry_id)
+                continue
+
+            self.submit(msg, entry_id)
+
+    def ack(self, entry_id):
+        self.r.execute_command('XACK', self.stream, self.group, entry_id)
+
+    def ack_after_delivery(self, entry_id):
+        """
+        应答经缓冲区异步推送，待其送达后再确认
+        """
+        self.buffer.call_after_delivery(lambda: self.ack(entry_id=entry_id))
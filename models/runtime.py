@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import ctypes
+import ctypes.util
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+class Runtime(object):
+    """
+    进程级的运行状态。仅依赖标准库，派发器等组件无需加载配置文件即可导入及测试。Utils 继承于此。
+    """
+
+    # 收到退出信号后置位，各工作线程据此退出
+    exit_flag = False
+
+    # 参考地址：http://man7.org/linux/man-pages/man2/clock_gettime.2.html
+    CLOCK_MONOTONIC = 1
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    @classmethod
+    def monotonic(cls):
+        """
+        :return: 单调时钟，单位(秒)。不受系统时间调整的影响，仅适用于计算时间间隔
+        """
+        ts = Timespec()
+        if cls.libc.clock_gettime(cls.CLOCK_MONOTONIC, ctypes.pointer(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        return ts.tv_sec + ts.tv_nsec * 1e-9
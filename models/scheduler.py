@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import threading
+
+from runtime import Runtime
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/02'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class Scheduler(object):
+    """
+    基于单调时钟的周期任务调度器。任务按各自的截止时间触发，不因单次执行超时或 sleep 漂移而整周期丢失；错过的截止时间计入统计。
+    """
+
+    # name -> Scheduler，供心跳上报
+    schedulers = dict()
+    schedulers_lock = threading.Lock()
+
+    def __init__(self, name=None):
+        self.name = name
+        self.lock = threading.Lock()
+        # job name -> {'interval', 'deadline', 'runs', 'missed', 'lag_max'}
+        self.jobs = dict()
+
+        with self.schedulers_lock:
+            self.schedulers[name] = self
+
+    def add(self, name, interval, delay=0):
+        """
+        :param interval: 触发周期，单位(秒)
+        :param delay: 首次触发距添加时的延迟，单位(秒)。默认添加后立即触发
+        """
+        with self.lock:
+            self.jobs[name] = {'interval': interval, 'deadline': Runtime.monotonic() + delay, 'runs': 0, 'missed': 0,
+                               'lag_max': 0.0}
+
+    def due(self):
+        """
+        :return: 已到截止时间的任务名。每个任务每次至多返回一次，积压的周期不补做，只计数
+        """
+        now = Runtime.monotonic()
+        ret = list()
+
+        with self.lock:
+            for name, job in self.jobs.items():
+                if job['deadline'] > now:
+                    continue
+
+                lag = now - job['deadline']
+                missed = int(lag / job['interval'])
+
+                job['runs'] += 1
+                job['missed'] += missed
+                job['lag_max'] = max(job['lag_max'], lag)
+                # 保持与首次截止时间对齐，避免误差累积
+                job['deadline'] += (missed + 1) * job['interval']
+
+                ret.append(name)
+
+        return ret
+
+    def timeout(self):
+        """
+        :return: 距最近一个截止时间的秒数
+        """
+        now = Runtime.monotonic()
+
+        with self.lock:
+            if self.jobs.__len__() < 1:
+                return 1
+
+            return max(0, min([job['deadline'] for job in self.jobs.values()]) - now)
+
+    def stats(self):
+        ret = dict()
+
+        with self.lock:
+            for name, job in self.jobs.items():
+                ret[name] = {'interval': job['interval'], 'runs': job['runs'], 'missed': job['missed'],
+                             'lag_max': round(job['lag_max'], 3)}
+
+                # 最大延迟按上报周期统计
+                job['lag_max'] = 0.0
+
+        return ret
+
+    @classmethod
+    def all_stats(cls):
+        with cls.schedulers_lock:
+            schedulers = cls.schedulers.items()
+
+        return dict([(name, scheduler.stats()) for name, scheduler in schedulers])
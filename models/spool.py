@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import threading
+import time
+
+
+__author__ = 'James Iter'
+__date__ = '2018/10/24'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class Spool(object):
+    """
+    分段的追加写本地暂存区。Redis 不可达时，上行消息按行写入其中，连接恢复后按顺序回放。
+    """
+
+    suffix = '.spool'
+
+    def __init__(self, path=None, segment_size=16 * 1024 ** 2, max_size=1024 ** 3, fsync_interval=1):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        # 批量 fsync 的最大间隔，单位(秒)
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.fd = None
+        self.fd_size = 0
+        self.fsync_ts = 0
+        self.dirty = False
+        self.dropped = 0
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0755)
+
+        # 上次运行遗留的分段，序号延续
+        segments = self.segments()
+        self.serial = int(segments[-1].split('.')[0]) if segments.__len__() > 0 else 0
+        # 是否存在待回放的分段。避免每次推送都扫描目录
+        self.pending = segments.__len__() > 0
+
+    def segments(self):
+        """
+        :return: 按写入顺序排列的分段文件名
+        """
+        return sorted([name for name in os.listdir(self.path) if name.endswith(self.suffix)])
+
+    def size(self):
+        return sum([os.path.getsize(os.path.join(self.path, name)) for name in self.segments()])
+
+    def empty(self):
+        return not self.pending
+
+    def open_segment(self):
+        self.serial += 1
+        name = '%020d%s' % (self.serial, self.suffix)
+        self.fd = os.open(os.path.join(self.path, name), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        self.fd_size = 0
+
+    def close_segment(self):
+        if self.fd is None:
+            return
+
+        if self.dirty:
+            os.fsync(self.fd)
+            self.dirty = False
+
+        os.close(self.fd)
+        self.fd = None
+
+    def enforce_max_size(self):
+        # 超出容量上限时，丢弃最早的分段
+        segments = self.segments()
+        total = self.size()
+
+        while total > self.max_size and segments.__len__() > 1:
+            path = os.path.join(self.path, segments.pop(0))
+            size = os.path.getsize(path)
+
+            with open(path, 'r') as f:
+                self.dropped += sum(1 for _ in f)
+
+            os.remove(path)
+            total -= size
+
+    def append(self, msgs):
+        with self.lock:
+            if self.fd is None:
+                self.open_segment()
+
+            data = ''.join([(msg.encode('utf-8') if isinstance(msg, unicode) else msg) + '\n' for msg in msgs])
+
+            try:
+                written = 0
+                while written < data.__len__():
+                    written += os.write(self.fd, data[written:])
+
+            except (IOError, OSError):
+                # 截去写入了一部分的数据(如磁盘已满)，避免残行与后续消息粘连
+                os.ftruncate(self.fd, self.fd_size)
+                raise
+
+            self.fd_size += data.__len__()
+            self.dirty = True
+            self.pending = True
+
+            if self.fd_size >= self.segment_size:
+                self.close_segment()
+                self.enforce_max_size()
+
+            elif time.time() - self.fsync_ts >= self.fsync_interval:
+                os.fsync(self.fd)
+                self.fsync_ts = time.time()
+                self.dirty = False
+
+    def oldest(self):
+        """
+        :return: (分段文件名, 其中的消息)。若最早的分段仍在写入，则先将其封存
+        """
+        with self.lock:
+            segments = self.segments()
+            if segments.__len__() < 1:
+                self.pending = False
+                return None, list()
+
+            if self.fd is not None and segments.__len__() == 1:
+                self.close_segment()
+
+            name = segments[0]
+            with open(os.path.join(self.path, name), 'r') as f:
+                # 断电等情况下分段末尾可能残留不完整的字符
+                msgs = [line.rstrip('\n').decode('utf-8', 'replace') for line in f if line.strip()]
+
+            return name, msgs
+
+    def remove(self, name):
+        with self.lock:
+            os.remove(os.path.join(self.path, name))
+
+    def sync(self):
+        with self.lock:
+            if self.fd is not None and self.dirty:
+                os.fsync(self.fd)
+                self.fsync_ts = time.time()
+                self.dirty = False
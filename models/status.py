@@ -23,6 +23,13 @@ class StorageMode(IntEnum):
     glusterfs = 3
 
 
+class GuestProvisioningMode(IntEnum):
+    # 完整克隆，复制模板镜像
+    full = 0
+    # 链接克隆，创建以模板镜像为后端的 qcow2 增量磁盘
+    linked = 1
+
+
 class EmitKind(IntEnum):
     log = 0
     guest_event = 1
@@ -4,11 +4,11 @@
 
 import json
 import os
-import shutil
 import threading
 
 from gluster import gfapi
 
+from initialize import file_copier
 from utils import Utils
 from models.status import StorageMode
 from jimvn_exception import CommandExecFailed
@@ -25,6 +25,8 @@ class Storage(object):
     gf = None
     dfs_volume = None
     thread_mutex_lock = threading.Lock()
+    # 经 gfapi 复制时的单次读写大小(字节)
+    gf_copy_chunk_size = 4 * 1024 * 1024
 
     def __init__(self, **kwargs):
         self.set_storage_mode(storage_mode=kwargs.get('storage_mode', None))
@@ -118,14 +120,30 @@ class Storage(object):
             cls.resize_image_by_local(path=path, size=size)
 
     @classmethod
-    def copy_file_by_glusterfs(cls, src=None, dst=None):
+    def copy_file_by_glusterfs(cls, src=None, dst=None, callback=None):
         if not cls.gf.isdir(os.path.dirname(dst)):
             cls.gf.makedirs(os.path.dirname(dst), 0755)
 
-        cls.gf.copyfile(src=src, dst=dst)
+        if callback is None:
+            cls.gf.copyfile(src=src, dst=dst)
+            return
+
+        total = cls.gf.getsize(src)
+        done = 0
+
+        with cls.gf.fopen(src, 'rb') as f_src:
+            with cls.gf.fopen(dst, 'wb') as f_dst:
+                while True:
+                    buf = f_src.read(cls.gf_copy_chunk_size)
+                    if not buf:
+                        break
+
+                    f_dst.write(buf)
+                    done += buf.__len__()
+                    callback(done, total)
 
     @staticmethod
-    def copy_file_by_local_path(src=None, dst=None):
+    def copy_file_by_local_path(src=None, dst=None, callback=None):
         system_image_path_dir = os.path.dirname(dst)
 
         if not os.path.exists(system_image_path_dir):
@@ -135,16 +153,91 @@ class Storage(object):
             os.rename(system_image_path_dir, system_image_path_dir + '.bak')
             os.makedirs(system_image_path_dir, 0755)
 
-        shutil.copyfile(src=src, dst=dst)
+        file_copier.copy(src=src, dst=dst, callback=callback)
 
     @classmethod
-    def copy_file(cls, src=None, dst=None):
+    def copy_file(cls, src=None, dst=None, callback=None):
+        """
+        :param callback: callback(done, total)，复制进度
+        """
         if cls.storage_mode in [StorageMode.ceph.value, StorageMode.glusterfs.value]:
             if cls.storage_mode == StorageMode.glusterfs.value:
-                cls.copy_file_by_glusterfs(src=src, dst=dst)
+                cls.copy_file_by_glusterfs(src=src, dst=dst, callback=callback)
+
+        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            cls.copy_file_by_local_path(src=src, dst=dst, callback=callback)
+
+    @classmethod
+    def make_overlay_by_glusterfs(cls, backing_path=None, path=None):
+        if not cls.gf.isdir(os.path.dirname(path)):
+            cls.gf.makedirs(os.path.dirname(path), 0755)
+
+        backing_format = cls.image_format_by_glusterfs(path=backing_path)
+        backing_path = '/'.join(['gluster://127.0.0.1', cls.dfs_volume, backing_path])
+        path = '/'.join(['gluster://127.0.0.1', cls.dfs_volume, path])
+
+        cmd = ' '.join(['/usr/bin/qemu-img', 'create', '-f', 'qcow2', '-F', backing_format, '-b', backing_path, path])
+        exit_status, output = Utils.shell_cmd(cmd)
+
+        if exit_status != 0:
+            err = u' '.join([u'路径', path, u'创建链接克隆磁盘时，命令执行退出异常：', str(output)])
+            raise CommandExecFailed(err)
+
+    @classmethod
+    def make_overlay_by_local(cls, backing_path=None, path=None):
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0755)
+
+        backing_format = cls.image_format_by_local(path=backing_path)
+        cmd = ' '.join(['/usr/bin/qemu-img', 'create', '-f', 'qcow2', '-F', backing_format, '-b', backing_path, path])
+        exit_status, output = Utils.shell_cmd(cmd)
+
+        if exit_status != 0:
+            err = u' '.join([u'路径', path, u'创建链接克隆磁盘时，命令执行退出异常：', str(output)])
+            raise CommandExecFailed(err)
+
+    @classmethod
+    def make_overlay(cls, backing_path=None, path=None):
+        """
+        创建以 backing_path 为只读后端的 qcow2 增量磁盘。后端文件在增量磁盘被合并(flatten)前不可移动或修改
+        """
+        if cls.storage_mode == StorageMode.glusterfs.value:
+            cls.make_overlay_by_glusterfs(backing_path=backing_path, path=path)
+
+        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            cls.make_overlay_by_local(backing_path=backing_path, path=path)
+
+    @classmethod
+    def flatten_image_by_glusterfs(cls, path=None):
+        path = '/'.join(['gluster://127.0.0.1', cls.dfs_volume, path])
+
+        cmd = ' '.join(['/usr/bin/qemu-img', 'rebase', '-f', 'qcow2', '-b', '""', path])
+        exit_status, output = Utils.shell_cmd(cmd)
+
+        if exit_status != 0:
+            err = u' '.join([u'路径', path, u'合并链接克隆磁盘时，命令执行退出异常：', str(output)])
+            raise CommandExecFailed(err)
+
+    @staticmethod
+    def flatten_image_by_local(path=None):
+        cmd = ' '.join(['/usr/bin/qemu-img', 'rebase', '-f', 'qcow2', '-b', '""', path])
+        exit_status, output = Utils.shell_cmd(cmd)
+
+        if exit_status != 0:
+            err = u' '.join([u'路径', path, u'合并链接克隆磁盘时，命令执行退出异常：', str(output)])
+            raise CommandExecFailed(err)
+
+    @classmethod
+    def flatten_image(cls, path=None):
+        """
+        将后端文件的数据并入未运行 Guest 的增量磁盘，使其脱离后端文件。运行中的 Guest 须经 libvirt 的 blockPull 合并
+        """
+        if cls.storage_mode == StorageMode.glusterfs.value:
+            cls.flatten_image_by_glusterfs(path=path)
 
         elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
-            cls.copy_file_by_local_path(src=src, dst=dst)
+            cls.flatten_image_by_local(path=path)
 
     @classmethod
     def delete_image_by_glusterfs(cls, path=None):
@@ -162,6 +255,55 @@ class Storage(object):
         elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
             cls.delete_image_by_local(path=path)
 
+    @classmethod
+    def rename_image_by_glusterfs(cls, src=None, dst=None):
+        if not cls.gf.isdir(os.path.dirname(dst)):
+            cls.gf.makedirs(os.path.dirname(dst), 0755)
+
+        cls.gf.rename(src, dst)
+
+    @staticmethod
+    def rename_image_by_local(src=None, dst=None):
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst), 0755)
+
+        os.rename(src, dst)
+
+    @classmethod
+    def rename_image(cls, src=None, dst=None):
+        """
+        同一文件系统内的原子改名
+        """
+        if cls.storage_mode == StorageMode.glusterfs.value:
+            cls.rename_image_by_glusterfs(src=src, dst=dst)
+
+        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            cls.rename_image_by_local(src=src, dst=dst)
+
+    @classmethod
+    def listdir_by_glusterfs(cls, path=None):
+        if not cls.gf.isdir(path):
+            return list()
+
+        return cls.gf.listdir(path)
+
+    @staticmethod
+    def listdir_by_local(path=None):
+        if not os.path.isdir(path):
+            return list()
+
+        return os.listdir(path)
+
+    @classmethod
+    def listdir(cls, path=None):
+        if cls.storage_mode == StorageMode.glusterfs.value:
+            return cls.listdir_by_glusterfs(path=path)
+
+        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            return cls.listdir_by_local(path=path)
+
+        return list()
+
     @classmethod
     def image_info_by_glusterfs(cls, path=None):
         path = '/'.join(['gluster://127.0.0.1', cls.dfs_volume, path])
@@ -193,6 +335,40 @@ class Storage(object):
         elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
             return cls.image_info_by_local(path=path)
 
+    @classmethod
+    def image_format_by_glusterfs(cls, path=None):
+        path = '/'.join(['gluster://127.0.0.1', cls.dfs_volume, path])
+        cmd = ' '.join(['/usr/bin/qemu-img', 'info', '--output=json', path, '2>/dev/null'])
+        exit_status, output = Utils.shell_cmd(cmd)
+
+        if exit_status != 0:
+            err = u' '.join([u'路径', path, u'探测镜像格式时，命令执行退出异常：', str(output)])
+            raise CommandExecFailed(err)
+
+        return json.loads(output)['format']
+
+    @staticmethod
+    def image_format_by_local(path=None):
+        cmd = ' '.join(['/usr/bin/qemu-img', 'info', '--output=json', path, '2>/dev/null'])
+        exit_status, output = Utils.shell_cmd(cmd)
+
+        if exit_status != 0:
+            err = u' '.join([u'路径', path, u'探测镜像格式时，命令执行退出异常：', str(output)])
+            raise CommandExecFailed(err)
+
+        return json.loads(output)['format']
+
+    @classmethod
+    def image_format(cls, path=None):
+        """
+        :return: 由 qemu-img 探测的镜像格式，如 qcow2、raw。模板镜像不一定是 qcow2，作为链接克隆的后端时须如实声明
+        """
+        if cls.storage_mode == StorageMode.glusterfs.value:
+            return cls.image_format_by_glusterfs(path=path)
+
+        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            return cls.image_format_by_local(path=path)
+
     @classmethod
     def getsize_by_glusterfs(cls, path=None):
         return cls.gf.getsize(path=path)
@@ -208,3 +384,45 @@ class Storage(object):
 
         elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
             return cls.getsize_by_local(path=path)
+
+    @classmethod
+    def stat_by_glusterfs(cls, path=None):
+        st = cls.gf.stat(path)
+        return st.st_size, st.st_mtime, st.st_ino
+
+    @staticmethod
+    def stat_by_local(path=None):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime, st.st_ino
+
+    @classmethod
+    def stat(cls, path=None):
+        """
+        :return: (大小, 修改时间, inode)。任一改变即视为文件已被替换
+        """
+        if cls.storage_mode == StorageMode.glusterfs.value:
+            return cls.stat_by_glusterfs(path=path)
+
+        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            return cls.stat_by_local(path=path)
+
+    @classmethod
+    def free_space_by_glusterfs(cls, path=None):
+        st = cls.gf.statvfs(path)
+        return st.f_bavail * st.f_frsize
+
+    @staticmethod
+    def free_space_by_local(path=None):
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+
+    @classmethod
+    def free_space(cls, path=None):
+        """
+        :return: path 所在文件系统中，非特权用户可用的字节数
+        """
+        if cls.storage_mode == StorageMode.glusterfs.value:
+            return cls.free_space_by_glusterfs(path=path)
+
+        elif cls.storage_mode in [StorageMode.local.value, StorageMode.shared_mount.value]:
+            return cls.free_space_by_local(path=path)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import array
+import threading
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/03'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class RingTable(object):
+    """
+    一个实体(如某 Guest 的某块磁盘)的定长环形时序表。时间戳及各字段各占一个预分配的 double 数组，写入不产生新对象。
+    """
+
+    def __init__(self, fields, capacity):
+        self.fields = list(fields)
+        self.capacity = capacity
+        self.ts = array.array('d', [0.0]) * capacity
+        self.columns = [array.array('d', [0.0]) * capacity for _ in self.fields]
+        # 下一个写入位置，及已写入的样本数
+        self.head = 0
+        self.count = 0
+
+    def append(self, ts, values):
+        i = self.head
+        self.ts[i] = ts
+
+        for column, value in zip(self.columns, values):
+            column[i] = value
+
+        self.head = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def copy(self):
+        """
+        :return: 当前内容的快照。数组整体复制，供在锁外读取
+        """
+        table = RingTable.__new__(RingTable)
+        table.fields = self.fields
+        table.capacity = self.capacity
+        table.ts = array.array('d', self.ts)
+        table.columns = [array.array('d', column) for column in self.columns]
+        table.head = self.head
+        table.count = self.count
+        return table
+
+    def last_ts(self):
+        if self.count < 1:
+            return 0
+
+        return self.ts[(self.head - 1) % self.capacity]
+
+    def indexes(self, since, until):
+        # 从最早的样本开始，按时间顺序
+        start = (self.head - self.count) % self.capacity
+
+        for n in range(self.count):
+            i = (start + n) % self.capacity
+            if since <= self.ts[i] <= until:
+                yield i
+
+    def window(self, since, until, step=0):
+        """
+        :param step: 降采样的桶宽，单位(秒)。0 表示返回原始样本；否则返回每个桶内的平均值，时间戳为桶的起点
+        :return: {'ts': [...], 字段名: [...]}
+        """
+        ret = dict([(field, list()) for field in self.fields])
+        ret['ts'] = list()
+
+        if step <= 0:
+            for i in self.indexes(since, until):
+                ret['ts'].append(self.ts[i])
+                for field, column in zip(self.fields, self.columns):
+                    ret[field].append(column[i])
+
+            return ret
+
+        bucket = None
+        sums = [0.0] * self.fields.__len__()
+        n = 0
+
+        for i in self.indexes(since, until):
+            b = self.ts[i] - (self.ts[i] - since) % step
+
+            if bucket is not None and b != bucket:
+                ret['ts'].append(bucket)
+                for field, s in zip(self.fields, sums):
+                    ret[field].append(s / n)
+
+                sums = [0.0] * self.fields.__len__()
+                n = 0
+
+            bucket = b
+            n += 1
+            for j, column in enumerate(self.columns):
+                sums[j] += column[i]
+
+        if n > 0:
+            ret['ts'].append(bucket)
+            for field, s in zip(self.fields, sums):
+                ret[field].append(s / n)
+
+        return ret
+
+
+class TimeSeriesStore(object):
+    """
+    本地性能数据的时序存储。按实体名(如 guest:<uuid>:disk:<disk_uuid>)组织，每个实体一个 RingTable，内存占用固定。
+    """
+
+    def __init__(self, capacity=600, max_tables=4096, query_max_tables=256):
+        self.capacity = capacity
+        self.max_tables = max_tables
+        # 单次查询返回的实体数量上限
+        self.query_max_tables = query_max_tables
+        self.lock = threading.Lock()
+        self.tables = dict()
+        # 因表数量达到上限而未能记录的样本数
+        self.dropped = 0
+
+    def record(self, name, ts, data):
+        """
+        :param data: 字段名 -> 数值
+        """
+        fields = sorted(data.keys())
+
+        with self.lock:
+            table = self.tables.get(name)
+
+            # 字段集合变化(如升级后新增字段)时，旧样本无法与之对齐，重建该实体的表
+            if table is not None and table.fields != fields:
+                del self.tables[name]
+                table = None
+
+            if table is None:
+                if self.tables.__len__() >= self.max_tables:
+                    self.dropped += 1
+                    return
+
+                table = RingTable(fields=fields, capacity=self.capacity)
+                self.tables[name] = table
+
+            table.append(ts, [data[field] for field in table.fields])
+
+    def query(self, prefix, since, until, step=0, limit=None):
+        """
+        :param prefix: 实体名前缀，不可为空
+        :param limit: 返回的实体数量上限，不超过 query_max_tables
+        :return: 实体名 -> 窗口数据。按实体名排序，返回以 prefix 开头的前 limit 个实体
+        """
+        if not prefix:
+            raise ValueError('prefix must not be empty')
+
+        limit = min(limit or self.query_max_tables, self.query_max_tables)
+
+        # 锁内仅复制数据，窗口计算及降采样在锁外进行，不阻塞采集线程的写入
+        with self.lock:
+            names = sorted([name for name in self.tables.keys() if name.startswith(prefix)])[:limit]
+            tables = [(name, self.tables[name].copy()) for name in names]
+
+        return dict([(name, table.window(since=since, until=until, step=step)) for name, table in tables])
+
+    def gc(self, before):
+        """
+        删除 before 之后再无写入的实体
+        """
+        with self.lock:
+            for name, table in self.tables.items():
+                if table.last_ts() < before:
+                    del self.tables[name]
+
+    def stats(self):
+        with self.lock:
+            return {'tables': self.tables.__len__(), 'capacity': self.capacity, 'dropped': self.dropped}
+
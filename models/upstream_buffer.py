@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import collections
+import threading
+import time
+import traceback
+
+import jimit as ji
+import redis
+
+from runtime import Runtime
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class UpstreamBuffer(object):
+    """
+    上行消息缓冲区。发射器只负责入队，由 flush_engine 线程经 pipeline 批量 RPUSH 至 upstream_queue。
+    """
+
+    def __init__(self, r=None, upstream_queue=None, max_size=10000, batch_size=500, flush_interval=0.2, spool=None,
+                 retry_interval=5):
+        self.r = r
+        self.upstream_queue = upstream_queue
+        # 指定暂存区后，Redis 不可达期间的消息写入本地暂存区，连接恢复后按序回放
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.retry_ts = 0
+        # 消息已写入暂存区、尚待回放的送达回调
+        self.spool_callbacks = list()
+        self.spooled = 0
+        self.replayed = 0
+        self.max_size = max_size
+        self.batch_size = batch_size
+        # 缓冲区中最早的消息，最多等待该时长(秒)即被推送
+        self.flush_interval = flush_interval
+        self.cond = threading.Condition(threading.Lock())
+        self.buffer = collections.deque()
+        # 送达回调单独排队，不占用缓冲区容量。推送时连同其前的全部消息一并取出，故无需记录其在消息中的位置
+        self.callbacks = collections.deque()
+        self.first_ts = None
+        self.dropped = 0
+        self.flushed = 0
+        self.flush_latency_avg = 0.0
+        self.flush_latency_max = 0.0
+
+    def put(self, msg):
+        with self.cond:
+            if self.buffer.__len__() >= self.max_size:
+                self.dropped += 1
+                return False
+
+            if self.first_ts is None:
+                self.first_ts = time.time()
+
+            self.buffer.append(msg)
+
+            if self.buffer.__len__() >= self.batch_size:
+                self.cond.notify()
+
+        return True
+
+    def call_after_delivery(self, callback):
+        """
+        在此前入队的全部消息送达 Redis 后调用 callback。回调于推送线程中执行
+        """
+        with self.cond:
+            if self.first_ts is None:
+                self.first_ts = time.time()
+
+            self.callbacks.append(callback)
+
+    @staticmethod
+    def run_callbacks(callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+
+            except:
+                # 延迟导入，使本模块无需加载配置文件即可导入
+                from initialize import logger
+                logger.error(traceback.format_exc())
+
+    def push(self, msgs):
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(0, msgs.__len__(), self.batch_size):
+            pipe.rpush(self.upstream_queue, *msgs[i:i + self.batch_size])
+
+        pipe.execute()
+
+    def replay(self):
+        """
+        按写入顺序回放暂存区，直至其为空
+        """
+        while not self.spool.empty():
+            name, msgs = self.spool.oldest()
+            if name is None:
+                break
+
+            if msgs.__len__() > 0:
+                self.push(msgs)
+
+            self.spool.remove(name)
+            self.replayed += msgs.__len__()
+
+        callbacks = self.spool_callbacks
+        self.spool_callbacks = list()
+        self.run_callbacks(callbacks)
+
+    def flush(self):
+        """
+        推送缓冲区中的全部消息。每 batch_size 条合并为一个 RPUSH，所有 RPUSH 经由一次 pipeline 往返送出
+        """
+        with self.cond:
+            msgs = list(self.buffer)
+            callbacks = list(self.callbacks)
+            self.buffer.clear()
+            self.callbacks.clear()
+            self.first_ts = None
+
+        if self.spool is not None:
+            return self.flush_with_spool(msgs, callbacks)
+
+        if msgs.__len__() < 1 and callbacks.__len__() < 1:
+            return 0
+
+        begin = time.time()
+
+        try:
+            if msgs.__len__() > 0:
+                self.push(msgs)
+
+        except:
+            # 不限于连接错误(如键类型错误、响应解析失败)，整批放回，等待下次推送
+            self.requeue(msgs=msgs, callbacks=callbacks, first_ts=begin)
+            raise
+
+        self.update_flush_latency(latency=time.time() - begin, count=msgs.__len__())
+        self.run_callbacks(callbacks)
+        return msgs.__len__()
+
+    def requeue(self, msgs, callbacks, first_ts):
+        """
+        将推送失败的一批消息及其送达回调放回队列头部。超出容量时丢弃最新的消息
+        """
+        with self.cond:
+            self.buffer.extendleft(reversed(msgs))
+            self.callbacks.extendleft(reversed(callbacks))
+            self.first_ts = first_ts
+
+            while self.buffer.__len__() > self.max_size:
+                self.buffer.pop()
+                self.dropped += 1
+
+    def flush_with_spool(self, msgs, callbacks=None):
+        callbacks = callbacks or list()
+
+        # Redis 不可达期间直接写入暂存区，不在网络上等待
+        if time.time() < self.retry_ts:
+            self.spool_batch(msgs=msgs, callbacks=callbacks, first_ts=time.time())
+            return 0
+
+        if msgs.__len__() < 1 and self.spool.empty():
+            self.run_callbacks(callbacks)
+            return 0
+
+        begin = time.time()
+
+        try:
+            # 先回放暂存区，保证消息顺序
+            self.replay()
+
+            if msgs.__len__() > 0:
+                self.push(msgs)
+
+        except:
+            # 不限于连接错误(如键类型错误、暂存区分段读取失败)，本批消息写入暂存区，退避后连同暂存区一并重试
+            self.retry_ts = time.time() + self.retry_interval
+            self.spool_batch(msgs=msgs, callbacks=callbacks, first_ts=begin)
+            raise
+
+        self.update_flush_latency(latency=time.time() - begin, count=msgs.__len__())
+        self.run_callbacks(callbacks)
+        return msgs.__len__()
+
+    def spool_batch(self, msgs, callbacks, first_ts):
+        """
+        将一批消息写入暂存区，其送达回调待回放完成后调用。暂存区不可写(如磁盘已满)时，整批放回缓冲区并抛出异常
+        """
+        if msgs.__len__() > 0:
+            try:
+                self.spool.append(msgs)
+
+            except (IOError, OSError):
+                self.requeue(msgs=msgs, callbacks=callbacks, first_ts=first_ts)
+                raise
+
+            self.spooled += msgs.__len__()
+
+        self.spool_callbacks.extend(callbacks)
+
+    def update_flush_latency(self, latency, count):
+        self.flush_latency_avg = self.flush_latency_avg * 0.9 + latency * 0.1
+        self.flush_latency_max = max(self.flush_latency_max, latency)
+        self.flushed += count
+
+    def close(self):
+        try:
+            self.flush()
+
+        finally:
+            if self.spool is not None:
+                self.spool.sync()
+
+    def timeout(self, now=None):
+        """
+        :return: 距下次推送的秒数。积攒满 batch_size 条，或最早的消息已等待 flush_interval 秒时为 0。须持有 self.cond
+        """
+        if self.buffer.__len__() >= self.batch_size:
+            return 0
+
+        if self.first_ts is None:
+            return self.flush_interval
+
+        return max(0, self.first_ts + self.flush_interval - (now or time.time()))
+
+    def flush_engine(self):
+        from initialize import logger, threads_status
+
+        while True:
+            threads_status['upstream_flush_engine'] = {'timestamp': ji.Common.ts()}
+
+            with self.cond:
+                timeout = self.timeout()
+                if timeout > 0 and not Runtime.exit_flag:
+                    self.cond.wait(timeout)
+
+            try:
+                self.flush()
+
+            except redis.exceptions.ConnectionError:
+                logger.error(traceback.format_exc())
+
+                if self.spool is None:
+                    # 防止循环线程，在redis连接断开时，混水写入日志
+                    time.sleep(5)
+
+            except:
+                # 任何异常都不可终止推送线程，否则此后的上行消息只进不出
+                logger.error(traceback.format_exc())
+                time.sleep(self.retry_interval)
+
+            if Runtime.exit_flag:
+                msg = 'Thread upstream_flush_engine say bye-bye'
+                print msg
+                logger.info(msg=msg)
+                return
+
+    def stats(self):
+        with self.cond:
+            ret = {
+                'depth': self.buffer.__len__(),
+                'callbacks': self.callbacks.__len__(),
+                'dropped': self.dropped,
+                'flushed': self.flushed,
+                'flush_latency_avg': round(self.flush_latency_avg, 4),
+                'flush_latency_max': round(self.flush_latency_max, 4)
+            }
+
+            if self.spool is not None:
+                ret.update({'spooled': self.spooled, 'replayed': self.replayed, 'spool_dropped': self.spool.dropped,
+                            'spool_pending': self.spool.pending})
+
+            # 最大推送耗时按上报周期统计
+            self.flush_latency_max = 0.0
+
+        return ret
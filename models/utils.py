@@ -3,6 +3,7 @@
 
 
 import commands
+import threading
 import traceback
 
 import jimit as ji
@@ -18,6 +19,7 @@ import libvirt_qemu
 
 from models import LogLevel, EmitKind, GuestState, ResponseState, HostEvent
 from models import GuestCollectionPerformanceDataKind, HostCollectionPerformanceDataKind
+from models.runtime import Runtime
 
 
 __author__ = 'James Iter'
@@ -26,9 +28,8 @@ __contact__ = 'james.iter.cn@gmail.com'
 __copyright__ = '(c) 2017 by James Iter.'
 
 
-class Utils(object):
+class Utils(Runtime):
 
-    exit_flag = False
     thread_counter = 0
 
     @staticmethod
@@ -43,7 +44,8 @@ class Utils(object):
 
     @classmethod
     def signal_handle(cls, signum=0, frame=None):
-        cls.exit_flag = True
+        # 置于基类，不依赖 Utils 的组件同样可见
+        Runtime.exit_flag = True
 
     @staticmethod
     def md5(_str):
@@ -82,56 +84,124 @@ class Utils(object):
 
 
 class QGA(object):
+    # 每个 Guest 同时在途的 guest-exec 数量上限
+    exec_max_concurrent = 2
+    # 轮询 guest-exec-status 的初始及最大间隔，单位(秒)
+    exec_poll_initial = 0.01
+    exec_poll_max = 1
+    # uuid -> 在途的 guest-exec 数量。归零即移除，已关机或已删除的 Guest 不会残留
+    exec_inflight = dict()
+    exec_cond = threading.Condition(threading.Lock())
 
-    @staticmethod
-    def get_guest_exec_status(dom=None, pid=None):
+    @classmethod
+    def exec_acquire(cls, uuid=None, deadline=None):
+        """
+        :return: 在 deadline 之前取得执行名额时返回 True
+        """
+        with cls.exec_cond:
+            while cls.exec_inflight.get(uuid, 0) >= cls.exec_max_concurrent:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+
+                cls.exec_cond.wait(remaining)
+
+            cls.exec_inflight[uuid] = cls.exec_inflight.get(uuid, 0) + 1
+            return True
+
+    @classmethod
+    def exec_release(cls, uuid=None):
+        with cls.exec_cond:
+            cls.exec_inflight[uuid] -= 1
+            if cls.exec_inflight[uuid] < 1:
+                del cls.exec_inflight[uuid]
+
+            cls.exec_cond.notify_all()
+
+    @classmethod
+    def get_guest_exec_status(cls, dom=None, pid=None, deadline=None):
+        """
+        以指数退避的间隔轮询 guest-exec-status，直至进程退出或到达 deadline
+        :return: guest-exec-status 的 return 部分。到达 deadline 时，其 exited 为 False
+        """
         assert isinstance(dom, libvirt.virDomain)
 
-        ret = '{"return":{"exited":false}}'
+        interval = cls.exec_poll_initial
 
-        i = 0
-        while not json.loads(ret)['return']['exited'] and i < 1000:
-            ret = libvirt_qemu.qemuAgentCommand(dom, json.dumps({
+        while True:
+            ret = json.loads(libvirt_qemu.qemuAgentCommand(dom, json.dumps({
                       'execute': 'guest-exec-status',
                       'arguments': {
                           'pid': pid
                       }
                       }),
                       3,
-                      libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT)
+                      libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT))['return']
 
-            i += 1
-            time.sleep(0.001)
+            remaining = deadline - time.time()
+            if ret['exited'] or remaining <= 0:
+                return ret
 
-        return ret
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, cls.exec_poll_max)
 
-    @staticmethod
-    def get_guest_memory_info(dom=None):
+    @classmethod
+    def guest_exec(cls, dom=None, path=None, args=None, capture_output=True, timeout=30):
+        """
+        在 Guest 中执行命令，并等待其结束
+        :param timeout: 含排队等待在内的总时限，单位(秒)
+        :return: {'exitcode': 退出码, 'signal': 终止信号, 'stdout': 标准输出, 'stderr': 标准错误, 'timeout': 是否超时}。
+                 超时时 exitcode 为 None
+        """
         assert isinstance(dom, libvirt.virDomain)
 
-        memory_info = dict()
+        deadline = time.time() + timeout
+        result = {'exitcode': None, 'signal': None, 'stdout': '', 'stderr': '', 'timeout': True}
+
+        uuid = dom.UUIDString()
+
+        # 同一 Guest 的 agent 通道是串行的，限制在途数量，避免调用者堆积在同一个 Guest 上
+        if not cls.exec_acquire(uuid=uuid, deadline=deadline):
+            return result
 
         try:
-            exec_ret = libvirt_qemu.qemuAgentCommand(dom, json.dumps({
+            exec_ret = json.loads(libvirt_qemu.qemuAgentCommand(dom, json.dumps({
                            'execute': 'guest-exec',
                            'arguments': {
-                               'path': 'cat',
-                               'capture-output': True,
-                               'arg': [
-                                   '/proc/meminfo'
-                               ]
+                               'path': path,
+                               'capture-output': capture_output,
+                               'arg': args or list()
                            }
                            }),
                            3,
-                           libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT)
+                           libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT))
+
+            status = cls.get_guest_exec_status(dom=dom, pid=exec_ret['return']['pid'], deadline=deadline)
+
+        finally:
+            cls.exec_release(uuid=uuid)
+
+        if not status['exited']:
+            return result
 
-            exec_ret = json.loads(exec_ret)
+        result['timeout'] = False
+        result['exitcode'] = status.get('exitcode')
+        result['signal'] = status.get('signal')
+        result['stdout'] = base64.b64decode(status.get('out-data', ''))
+        result['stderr'] = base64.b64decode(status.get('err-data', ''))
 
-            status_ret = QGA.get_guest_exec_status(dom=dom, pid=exec_ret['return']['pid'])
+        return result
 
-            memory_info_str = base64.b64decode(json.loads(status_ret)['return']['out-data'])
+    @classmethod
+    def get_guest_memory_info(cls, dom=None):
+        assert isinstance(dom, libvirt.virDomain)
+
+        memory_info = dict()
 
-            for item in memory_info_str.split('\n'):
+        try:
+            ret = cls.guest_exec(dom=dom, path='cat', args=['/proc/meminfo'], timeout=5)
+
+            for item in ret['stdout'].split('\n'):
                 if item.__len__() == 0:
                     continue
 
@@ -158,6 +228,8 @@ class Emit(object):
         self.hostname = ji.Common.get_hostname()
         self.node_id = Utils.get_node_id()
         self.r = None
+        # 指定缓冲区后，消息经由缓冲区批量推送，调用者不再等待 Redis 往返
+        self.buffer = None
 
     def emit(self, _kind=None, _type=None, message=None):
         from initialize import logger
@@ -168,6 +240,10 @@ class Emit(object):
 
         msg = json.dumps({'kind': _kind, 'type': _type, 'timestamp': ji.Common.ts(), 'host': self.hostname,
                           'node_id': self.node_id, 'message': message}, ensure_ascii=False)
+
+        if self.buffer is not None:
+            return self.buffer.put(msg)
+
         try:
             return self.r.rpush(self.upstream_queue, msg)
 
@@ -225,10 +301,16 @@ class GuestEventEmit(Emit):
     def __init__(self):
         super(GuestEventEmit, self).__init__()
 
-    def emit2(self, _type=None, uuid=None, os_template_image_id=None, migrating_info=None, xml=None, progress=None):
-        return self.emit(_kind=EmitKind.guest_event.value, _type=_type, message={
-            'uuid': uuid, 'os_template_image_id': os_template_image_id, 'migrating_info': migrating_info, 'xml': xml,
-            'progress': progress})
+    def emit2(self, _type=None, uuid=None, os_template_image_id=None, migrating_info=None, xml=None, progress=None,
+              extend_data=None):
+        message = {'uuid': uuid, 'os_template_image_id': os_template_image_id, 'migrating_info': migrating_info,
+                   'xml': xml, 'progress': progress}
+
+        # 仅个别事件携带的字段
+        if extend_data is not None:
+            message.update(extend_data)
+
+        return self.emit(_kind=EmitKind.guest_event.value, _type=_type, message=message)
 
     def no_state(self, uuid):
         return self.emit2(_type=GuestState.no_state.value, uuid=uuid)
@@ -263,8 +345,13 @@ class GuestEventEmit(Emit):
     def update(self, uuid, xml):
         return self.emit2(_type=GuestState.update.value, uuid=uuid, xml=xml)
 
-    def creating(self, uuid, progress):
-        return self.emit2(_type=GuestState.creating.value, uuid=uuid, progress=progress)
+    def creating(self, uuid, progress, speed=None, eta=None):
+        """
+        :param speed: 系统镜像的复制速度，单位(字节/秒)
+        :param eta: 复制预计剩余时间，单位(秒)
+        """
+        return self.emit2(_type=GuestState.creating.value, uuid=uuid, progress=progress,
+                          extend_data={'speed': speed, 'eta': eta})
 
     def snapshot_converting(self, uuid, os_template_image_id, progress):
         return self.emit2(_type=GuestState.snapshot_converting.value, uuid=uuid,
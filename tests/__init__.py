@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import sys
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+"""
+单元测试。被测组件以顶层模块的方式直接导入，不经 models/__init__.py(其加载 /etc/jimvn.conf 并连接 Redis)，
+开发机上无需配置即可运行。
+用法：python -m unittest discover -s tests -t .
+"""
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models'))
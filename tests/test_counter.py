@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from counter import CounterState
+from runtime import Runtime
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class TestCounterState(unittest.TestCase):
+
+    def setUp(self):
+        self.counter = CounterState(name='test', fields=['rx', 'tx'], capacity=2)
+
+    def tearDown(self):
+        with CounterState.counters_lock:
+            CounterState.counters.pop('test', None)
+
+    @staticmethod
+    def as_dict(ret):
+        return dict([(device_id, (delta.tolist(), rate.tolist())) for device_id, delta, rate in ret])
+
+    def test_first_sample_only_sets_baseline(self):
+        self.assertEqual(self.counter.update(samples=[('a', [10, 20])], now=1), list())
+
+        ret = self.as_dict(self.counter.update(samples=[('a', [30, 60])], now=3))
+        self.assertEqual(ret, {'a': ([20, 40], [10, 20])})
+
+    def test_decrease_is_a_reset(self):
+        self.counter.update(samples=[('a', [100, 100])], now=1)
+
+        # 任一字段减小即视为重置，本次不产生速率，以当前值作为新的基准值
+        self.assertEqual(self.counter.update(samples=[('a', [5, 200])], now=2), list())
+        self.assertEqual(self.counter.stats(), {'devices': 1, 'resets': 1})
+
+        ret = self.as_dict(self.counter.update(samples=[('a', [15, 210])], now=3))
+        self.assertEqual(ret, {'a': ([10, 10], [10, 10])})
+
+    def test_non_positive_interval_is_skipped(self):
+        self.counter.update(samples=[('a', [0, 0])], now=5)
+        self.assertEqual(self.counter.update(samples=[('a', [1, 1])], now=5), list())
+
+    def test_absent_devices_are_evicted_unless_kept(self):
+        self.counter.update(samples=[('a', [0, 0]), ('b', [0, 0])], now=1)
+
+        self.counter.update(samples=[('a', [1, 1])], now=2, keep={'b'})
+        self.assertEqual(sorted(self.counter.index), ['a', 'b'])
+
+        self.counter.update(samples=[('a', [2, 2])], now=3)
+        self.assertEqual(sorted(self.counter.index), ['a'])
+
+        # 再次出现的设备重新建立基准值
+        self.assertEqual(self.as_dict(self.counter.update(samples=[('a', [3, 3]), ('b', [9, 9])], now=4)),
+                         {'a': ([1, 1], [1, 1])})
+
+    def test_rows_grow_beyond_capacity(self):
+        samples = [(i, [i, i]) for i in range(5)]
+        self.counter.update(samples=samples, now=1)
+
+        ret = self.as_dict(self.counter.update(samples=[(i, [i + 2, i + 2]) for i in range(5)], now=2))
+        self.assertEqual(sorted(ret), range(5))
+        self.assertTrue(all([delta == [2, 2] for delta, _ in ret.values()]))
+
+
+class TestCounterStatePersistence(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.counter = CounterState(name='test', fields=['rx', 'tx'])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        with CounterState.counters_lock:
+            CounterState.counters.pop('test', None)
+
+    def test_dump_and_load_round_trip(self):
+        now = Runtime.monotonic()
+        self.counter.update(samples=[('a', [10, 20])], now=now - 5)
+
+        restored = CounterState(name='test', fields=['rx', 'tx'])
+        self.assertEqual(restored.load(self.counter.dump(), max_age=60), 1)
+
+        # 载入的基准值可直接用于计算速率
+        ret = restored.update(samples=[('a', [60, 70])], now=now)
+        self.assertEqual(ret.__len__(), 1)
+        self.assertEqual(ret[0][1].tolist(), [50, 50])
+        self.assertAlmostEqual(ret[0][2][0], 10, places=1)
+
+    def test_load_ignores_stale_future_and_mismatched_snapshots(self):
+        now = time.time()
+        snapshot = {'fields': ['rx', 'tx'], 'devices': {
+            'stale': {'values': [1, 1], 'ts': now - 120},
+            'future': {'values': [1, 1], 'ts': now + 120},
+            'fresh': {'values': [1, 1], 'ts': now - 1}}}
+
+        self.assertEqual(self.counter.load(snapshot, max_age=60), 1)
+        self.assertEqual(self.counter.index.keys(), ['fresh'])
+
+        self.assertEqual(self.counter.load({'fields': ['rx'], 'devices': snapshot['devices']}, max_age=60), 0)
+        self.assertEqual(self.counter.load(None, max_age=60), 0)
+
+    def test_save_all_and_load_all(self):
+        self.counter.update(samples=[('a', [1, 2])], now=Runtime.monotonic())
+        path = os.path.join(self.path, 'state', 'counters.json')
+
+        CounterState.save_all(path)
+
+        self.assertFalse(os.path.exists(path + '.tmp'))
+        snapshots = CounterState.load_all(path)
+        self.assertEqual(snapshots['test']['fields'], ['rx', 'tx'])
+        self.assertEqual(snapshots['test']['devices']['a']['values'], [1, 2])
+
+    def test_load_all_tolerates_missing_and_corrupt_files(self):
+        path = os.path.join(self.path, 'counters.json')
+        self.assertEqual(CounterState.load_all(path), dict())
+
+        with open(path, 'w') as f:
+            f.write('{"test": ')
+
+        self.assertEqual(CounterState.load_all(path), dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import threading
+import time
+import unittest
+
+from dispatcher import Dispatcher
+from runtime import Runtime
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher(name='test', workers=4, max_pending=64)
+        self.dispatcher.start()
+
+    def tearDown(self):
+        # 工作线程每秒检查一次退出标志
+        Runtime.exit_flag = True
+        for t in self.dispatcher.threads:
+            t.join(5)
+
+        Runtime.exit_flag = False
+
+    def wait_idle(self, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.dispatcher.stats()['queue_depth'] == 0 and self.dispatcher.busy == 0:
+                return
+
+            time.sleep(0.01)
+
+        self.fail('dispatcher not idle')
+
+    def test_same_lane_runs_serially_in_order(self):
+        order = list()
+        active = {'n': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def task(i):
+            with lock:
+                active['n'] += 1
+                active['max'] = max(active['max'], active['n'])
+
+            time.sleep(0.005)
+            order.append(i)
+
+            with lock:
+                active['n'] -= 1
+
+        for i in range(20):
+            self.assertTrue(self.dispatcher.submit('guest-a', task, i))
+
+        self.wait_idle()
+        self.assertEqual(order, list(range(20)))
+        self.assertEqual(active['max'], 1)
+
+    def test_different_lanes_run_in_parallel(self):
+        started = list()
+        release = threading.Event()
+
+        def task(lane):
+            started.append(lane)
+            release.wait(5)
+
+        self.dispatcher.submit('guest-a', task, 'guest-a')
+        self.dispatcher.submit('guest-b', task, 'guest-b')
+
+        deadline = time.time() + 5
+        while started.__len__() < 2 and time.time() < deadline:
+            time.sleep(0.01)
+
+        release.set()
+        self.assertEqual(sorted(started), ['guest-a', 'guest-b'])
+        self.wait_idle()
+
+    def test_offer_rejects_when_full(self):
+        # 不启动工作线程，任务只进不出
+        dispatcher = Dispatcher(name='full', workers=1, max_pending=2)
+
+        self.assertTrue(dispatcher.offer('a', lambda: None))
+        self.assertTrue(dispatcher.offer('b', lambda: None))
+        self.assertFalse(dispatcher.offer('c', lambda: None))
+        self.assertEqual(dispatcher.stats()['rejected'], 1)
+        self.assertEqual(dispatcher.stats()['lanes']['a']['depth'], 1)
+
+    def test_gather_drops_late_results_and_skips_busy_lane(self):
+        release = threading.Event()
+
+        def slow():
+            release.wait(5)
+            return 'slow'
+
+        calls = {'fast': ('guest-a', lambda: 'fast', ()), 'slow': ('guest-b', slow, ())}
+        results = self.dispatcher.gather(calls=calls, timeout=0.2)
+
+        self.assertEqual(results, {'fast': 'fast'})
+        self.assertEqual(self.dispatcher.stats()['late'], 1)
+
+        # guest-b 的上一批任务仍未结束，不再为其提交
+        results = self.dispatcher.gather(calls={'slow': ('guest-b', slow, ())}, timeout=0.1)
+        self.assertEqual(results, dict())
+        self.assertEqual(self.dispatcher.stats()['skipped'], 1)
+
+        release.set()
+        self.wait_idle()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import unittest
+
+try:
+    import libvirt
+    from domain_cache import DomainCache
+
+except ImportError:
+    libvirt = None
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+if libvirt is not None:
+    class FakeDom(libvirt.virDomain):
+
+        def __init__(self, uuid, conn):
+            self.uuid = uuid
+            self.conn = conn
+
+        def UUIDString(self):
+            return self.uuid
+
+
+class FakeConn(object):
+
+    def __init__(self, uuids):
+        self.alive = True
+        self.doms = [FakeDom(uuid, self) for uuid in uuids]
+        self.lookups = 0
+
+    def isAlive(self):
+        return self.alive
+
+    def listAllDomains(self):
+        return list(self.doms)
+
+    def lookupByUUIDString(self, uuidstr):
+        self.lookups += 1
+        return [dom for dom in self.doms if dom.uuid == uuidstr][0]
+
+
+@unittest.skipIf(libvirt is None, 'libvirt-python is not installed')
+class TestDomainCache(unittest.TestCase):
+
+    def setUp(self):
+        self.conns = list()
+        self.uuids = ['a', 'b']
+        self.cache = DomainCache(reconcile_interval=60)
+
+        # 以 FakeConn 代替 libvirtd 连接
+        self.open = libvirt.__dict__.get('open')
+        libvirt.open = self.new_conn
+
+    def tearDown(self):
+        libvirt.open = self.open
+
+    def new_conn(self, name=None):
+        self.conns.append(FakeConn(self.uuids))
+        return self.conns[-1]
+
+    def test_first_access_loads_all_domains(self):
+        self.assertEqual(sorted(self.cache.mapping()), ['a', 'b'])
+        self.assertIs(self.cache.get('a').conn, self.conns[0])
+        self.assertEqual(self.conns[0].lookups, 0)
+
+    def test_miss_falls_back_to_lookup_and_is_cached(self):
+        self.cache.mapping()
+        self.conns[0].doms.append(FakeDom('c', self.conns[0]))
+
+        self.assertEqual(self.cache.get('c').uuid, 'c')
+        self.cache.get('c')
+        self.assertEqual(self.conns[0].lookups, 1)
+
+    def test_add_and_remove(self):
+        self.cache.mapping()
+        self.cache.add(FakeDom('c', self.conns[0]))
+        self.cache.remove('a')
+
+        self.assertEqual(sorted(self.cache.mapping()), ['b', 'c'])
+
+    def test_dead_connection_drops_cached_domains(self):
+        self.cache.get('a')
+
+        # libvirtd 重启，旧连接及其 virDomain 均已失效
+        self.conns[0].alive = False
+        self.uuids = ['a']
+
+        dom = self.cache.get('a')
+        self.assertEqual(self.conns.__len__(), 2)
+        self.assertIs(dom.conn, self.conns[1])
+        self.assertEqual(sorted(self.cache.mapping()), ['a'])
+
+    def test_is_alive_error_counts_as_dead(self):
+        self.cache.mapping()
+
+        def is_alive():
+            raise libvirt.libvirtError('connection closed')
+
+        self.conns[0].isAlive = is_alive
+        self.cache.check_conn()
+
+        self.assertIsNone(self.cache.conn)
+        self.assertEqual(self.cache.dom_mapping_by_uuid, dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
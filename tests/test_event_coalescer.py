@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import time
+import unittest
+
+from event_coalescer import EventCoalescer
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class FakeDom(object):
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+    def UUIDString(self):
+        return self.uuid
+
+
+class TestEventCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.coalescer = EventCoalescer(window=0.5, max_delay=2)
+
+    def test_burst_is_merged_into_one_entry(self):
+        dom = FakeDom('a')
+        self.coalescer.touch(dom, state=True)
+        self.coalescer.touch(dom, xml=True)
+        self.coalescer.touch(dom)
+
+        entries, _ = self.coalescer.expired(time.time() + 1)
+
+        self.assertEqual(entries.__len__(), 1)
+        self.assertTrue(entries[0]['state'])
+        self.assertTrue(entries[0]['xml'])
+        self.assertEqual(self.coalescer.stats(), {'received': 3, 'absorbed': 2, 'flushed': 0, 'pending': 0})
+
+    def test_entry_waits_for_quiet_window(self):
+        self.coalescer.touch(FakeDom('a'), state=True)
+        now = time.time()
+
+        entries, timeout = self.coalescer.expired(now)
+        self.assertEqual(entries, list())
+        self.assertTrue(0 < timeout <= 0.5)
+
+        entries, _ = self.coalescer.expired(now + 0.6)
+        self.assertEqual(entries.__len__(), 1)
+
+    def test_steady_events_flush_by_max_delay(self):
+        dom = FakeDom('a')
+        self.coalescer.touch(dom, state=True)
+        entry = self.coalescer.pending['a']
+
+        # 事件持续到达，静默窗口不断后移
+        entry['last_ts'] = entry['first_ts'] + 1.9
+        self.assertEqual(self.coalescer.deadline(entry), entry['first_ts'] + 2)
+
+        entries, _ = self.coalescer.expired(entry['first_ts'] + 2)
+        self.assertEqual(entries.__len__(), 1)
+
+    def test_guests_are_tracked_separately(self):
+        self.coalescer.touch(FakeDom('a'), state=True)
+        self.coalescer.touch(FakeDom('b'), xml=True)
+
+        entries, _ = self.coalescer.expired(time.time() + 1)
+
+        self.assertEqual(sorted([entry['dom'].UUIDString() for entry in entries]), ['a', 'b'])
+        self.assertEqual(self.coalescer.stats()['absorbed'], 0)
+
+    def test_latest_dom_object_is_kept(self):
+        first = FakeDom('a')
+        second = FakeDom('a')
+        self.coalescer.touch(first, state=True)
+        self.coalescer.touch(second)
+
+        entries, _ = self.coalescer.expired(time.time() + 1)
+        self.assertIs(entries[0]['dom'], second)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import unittest
+
+try:
+    import libvirt
+    from event_loop import VirEventLoopPoll
+
+except ImportError:
+    libvirt = None
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+@unittest.skipIf(libvirt is None, 'libvirt-python is not installed')
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = VirEventLoopPoll()
+        self.fds = list()
+        self.fired = list()
+
+    def tearDown(self):
+        for fd in self.fds:
+            try:
+                os.close(fd)
+
+            except OSError:
+                pass
+
+    def pipe(self):
+        rfd, wfd = os.pipe()
+        self.fds.extend([rfd, wfd])
+        return rfd, wfd
+
+    def on_handle(self, handle_id, fd, events, opaque):
+        os.read(fd, 1)
+        self.fired.append(('handle', handle_id))
+
+    def on_timer(self, timer_id, opaque):
+        self.fired.append(('timer', timer_id))
+
+    def test_readable_handle_is_dispatched(self):
+        rfd, wfd = self.pipe()
+        handle_id = self.loop.add_handle(rfd, libvirt.VIR_EVENT_HANDLE_READABLE, self.on_handle, None)
+
+        os.write(wfd, 'c')
+        self.loop.run_once()
+
+        self.assertEqual(self.fired, [('handle', handle_id)])
+
+    def test_zero_interval_timer_fires_once_per_iteration(self):
+        timer_id = self.loop.add_timer(0, self.on_timer, None)
+        self.loop.run_once()
+        self.loop.run_once()
+
+        self.assertEqual(self.fired, [('timer', timer_id)] * 2)
+
+    def test_disabled_and_removed_timers_do_not_fire(self):
+        disabled = self.loop.add_timer(-1, self.on_timer, None)
+        removed = self.loop.add_timer(0, self.on_timer, None)
+        self.loop.remove_timer(removed)
+
+        rfd, wfd = self.pipe()
+        self.loop.add_handle(rfd, libvirt.VIR_EVENT_HANDLE_READABLE, self.on_handle, None)
+        os.write(wfd, 'c')
+        self.loop.run_once()
+
+        self.assertNotIn(('timer', disabled), self.fired)
+        self.assertNotIn(('timer', removed), self.fired)
+
+    def test_reused_fd_is_registered_again(self):
+        rfd, wfd = self.pipe()
+        self.loop.add_handle(rfd, libvirt.VIR_EVENT_HANDLE_READABLE, self.on_handle, None)
+
+        # 句柄未移除即再次注册同一 fd(epoll 返回 EEXIST)
+        handle_id = self.loop.add_handle(rfd, libvirt.VIR_EVENT_HANDLE_READABLE, self.on_handle, None)
+        os.write(wfd, 'c')
+        self.loop.run_once()
+
+        self.assertEqual(self.fired, [('handle', handle_id)])
+
+    def test_update_and_remove_after_close(self):
+        rfd, wfd = self.pipe()
+        handle_id = self.loop.add_handle(rfd, libvirt.VIR_EVENT_HANDLE_READABLE, self.on_handle, None)
+
+        os.close(rfd)
+        os.close(wfd)
+
+        # fd 已关闭(EBADF)时不抛出异常
+        self.loop.update_handle(handle_id, libvirt.VIR_EVENT_HANDLE_WRITABLE)
+        self.loop.remove_handle(handle_id)
+
+        self.assertEqual(self.loop.stats()['handles'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
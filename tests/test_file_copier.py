@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+
+from file_copier import FileCopier
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+MiB = 1024 * 1024
+
+
+class TestFileCopier(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.src = os.path.join(self.path, 'src.img')
+        self.dst = os.path.join(self.path, 'dst.img')
+        # 以较小的块复制，使一个区段经多次调用完成
+        self.copier = FileCopier(chunk_size=256 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_sparse(self, size, data):
+        """
+        :param data: [(偏移, 长度), ...]。其余部分为空洞
+        """
+        with open(self.src, 'wb') as f:
+            f.truncate(size)
+
+            for offset, length in data:
+                f.seek(offset)
+                f.write(os.urandom(length))
+
+    def extents(self, size):
+        fd = os.open(self.src, os.O_RDONLY)
+
+        try:
+            return self.copier.extents(fd, size)
+
+        finally:
+            os.close(fd)
+
+    def assertSameContent(self):
+        with open(self.src, 'rb') as f_src, open(self.dst, 'rb') as f_dst:
+            self.assertEqual(f_src.read(), f_dst.read())
+
+    def test_extents_skip_holes_at_start_and_end(self):
+        self.make_sparse(4 * MiB, [(1 * MiB, 2 * MiB)])
+
+        ret = self.extents(4 * MiB)
+        if ret == [(0, 4 * MiB)]:
+            self.skipTest('filesystem does not support SEEK_DATA')
+
+        self.assertEqual(ret, [(1 * MiB, 2 * MiB)])
+
+    def test_extents_of_file_without_data(self):
+        self.make_sparse(2 * MiB, list())
+
+        ret = self.extents(2 * MiB)
+        if ret == [(0, 2 * MiB)]:
+            self.skipTest('filesystem does not support SEEK_DATA')
+
+        self.assertEqual(ret, list())
+
+    def test_extents_of_empty_file(self):
+        self.make_sparse(0, list())
+        self.assertEqual(self.extents(0), list())
+
+    def test_falls_back_to_copy_file_range(self):
+        self.make_sparse(3 * MiB, [(0, 1 * MiB), (2 * MiB, 1 * MiB)])
+        self.copier.reflink = lambda src_fd, dst_fd: False
+
+        calls = list()
+
+        def copy_range_by_copy_file_range(src_fd, dst_fd, offset, length):
+            calls.append(length)
+            return self.copier.copy_range_by_sendfile(src_fd, dst_fd, offset, length)
+
+        self.copier.copy_file_range = object()
+        self.copier.copy_range_by_copy_file_range = copy_range_by_copy_file_range
+
+        self.assertEqual(self.copier.copy(self.src, self.dst), 'copy_file_range')
+        self.assertTrue(calls.__len__() > 0)
+        self.assertSameContent()
+
+    def test_falls_back_to_sendfile_when_copy_file_range_is_unsupported(self):
+        self.make_sparse(3 * MiB, [(1 * MiB, 1 * MiB)])
+        self.copier.reflink = lambda src_fd, dst_fd: False
+
+        def copy_range_by_copy_file_range(src_fd, dst_fd, offset, length):
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+        self.copier.copy_file_range = object()
+        self.copier.copy_range_by_copy_file_range = copy_range_by_copy_file_range
+
+        progress = list()
+        self.assertEqual(self.copier.copy(self.src, self.dst, callback=lambda done, total: progress.append(done)),
+                         'sendfile')
+        self.assertSameContent()
+        self.assertEqual(progress[-1], 3 * MiB)
+        self.assertEqual(self.copier.stats()['methods']['sendfile'], 1)
+
+    def test_sendfile_when_copy_file_range_is_missing(self):
+        self.make_sparse(2 * MiB, [(0, 1 * MiB)])
+        self.copier.reflink = lambda src_fd, dst_fd: False
+        self.copier.copy_file_range = None
+
+        self.assertEqual(self.copier.copy(self.src, self.dst), 'sendfile')
+        self.assertSameContent()
+        self.assertEqual(os.path.getsize(self.dst), 2 * MiB)
+
+    def test_other_copy_file_range_errors_are_raised(self):
+        self.make_sparse(1 * MiB, [(0, 1 * MiB)])
+        self.copier.reflink = lambda src_fd, dst_fd: False
+
+        def copy_range_by_copy_file_range(src_fd, dst_fd, offset, length):
+            raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+        self.copier.copy_file_range = object()
+        self.copier.copy_range_by_copy_file_range = copy_range_by_copy_file_range
+
+        self.assertRaises(OSError, self.copier.copy, self.src, self.dst)
+
+    def test_copy_with_kernel_methods(self):
+        self.make_sparse(2 * MiB, [(1 * MiB, 1 * MiB)])
+
+        self.assertIn(self.copier.copy(self.src, self.dst), ['reflink', 'copy_file_range', 'sendfile'])
+        self.assertSameContent()
+
+
+if __name__ == '__main__':
+    unittest.main()
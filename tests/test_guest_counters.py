@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import libvirt
+    import guest_counters
+    from guest_counters import GuestCounterReader
+
+except ImportError:
+    libvirt = None
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class FakeDom(object):
+
+    def __init__(self, name, uuid):
+        self._name = name
+        self.uuid = uuid
+
+    def name(self):
+        return self._name
+
+    def UUIDString(self):
+        return self.uuid
+
+    @staticmethod
+    def getCPUStats(total):
+        return [{'cpu_time': 42}]
+
+    @staticmethod
+    def interfaceStats(dev):
+        return 1, 2, 3, 4, 5, 6, 7, 8
+
+
+class FakeDeviceCache(object):
+
+    def __init__(self, devs):
+        self.devs = devs
+
+    def interfaces(self, dom):
+        return [{'dev': dev, 'alias': 'net' + i.__str__()} for i, dev in enumerate(self.devs)]
+
+
+@unittest.skipIf(libvirt is None, 'libvirt-python is not installed')
+class TestGuestCounterReader(unittest.TestCase):
+
+    scope = 'machine.slice/machine-qemu\\x2d1\\x2dvm.scope'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.reader = GuestCounterReader()
+
+        for name in ['run', 'proc', 'cgroup', 'net']:
+            os.makedirs(os.path.join(self.root, name))
+
+        self.reader.qemu_pid_path = os.path.join(self.root, 'run')
+        self.reader.proc = os.path.join(self.root, 'proc')
+        self.reader.sys_fs_cgroup = os.path.join(self.root, 'cgroup')
+        self.reader.sys_class_net = os.path.join(self.root, 'net')
+
+        self.dom = FakeDom(name='vm', uuid='uuid-1')
+        self.write('run/vm.pid', '1234\n')
+
+        self.device_cache = guest_counters.device_cache
+
+    def tearDown(self):
+        guest_counters.device_cache = self.device_cache
+        shutil.rmtree(self.root)
+
+    def write(self, path, content):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def write_cgroup(self, *lines):
+        self.write('proc/1234/cgroup', '\n'.join(lines) + '\n')
+
+    def test_emulator_cgroup_resolves_to_machine_scope(self):
+        self.write_cgroup('5:memory:/' + self.scope, '4:cpuacct,cpu:/' + self.scope + '/emulator',
+                          '1:name=systemd:/' + self.scope)
+        self.write('cgroup/cpu,cpuacct/' + self.scope + '/cpuacct.usage', '1000\n')
+        self.write('cgroup/cpu,cpuacct/' + self.scope + '/emulator/cpuacct.usage', '10\n')
+
+        self.assertEqual(self.reader.cpuacct_path(self.dom),
+                         os.path.join(self.root, 'cgroup/cpu,cpuacct', self.scope, 'cpuacct.usage'))
+
+    def test_controller_directory_name_as_listed(self):
+        self.write_cgroup('4:cpuacct,cpu:/' + self.scope)
+        self.write('cgroup/cpuacct,cpu/' + self.scope + '/cpuacct.usage', '1000\n')
+
+        self.assertEqual(self.reader.cpuacct_path(self.dom),
+                         os.path.join(self.root, 'cgroup/cpuacct,cpu', self.scope, 'cpuacct.usage'))
+
+    def test_no_cpuacct_controller(self):
+        self.write_cgroup('5:memory:/' + self.scope, '0::/' + self.scope)
+
+        self.assertIsNone(self.reader.cpuacct_path(self.dom))
+
+    def test_read_cpu_from_cgroup_and_fall_back_to_libvirt(self):
+        self.write_cgroup('4:cpu,cpuacct:/' + self.scope + '/emulator')
+        self.write('cgroup/cpu,cpuacct/' + self.scope + '/cpuacct.usage', '123456789\n')
+
+        stats = dict()
+        self.reader.read_cpu(dom=self.dom, stats=stats)
+        self.assertEqual(stats['cpu.time'], 123456789)
+        self.assertEqual(self.reader.stats(), {'mapped': 1, 'fallbacks': 0})
+
+        # 重启后旧的 cgroup 已消失，退回 libvirt 并使映射失效
+        os.remove(os.path.join(self.root, 'cgroup/cpu,cpuacct', self.scope, 'cpuacct.usage'))
+        self.reader.read_cpu(dom=self.dom, stats=stats)
+        self.assertEqual(stats['cpu.time'], 42)
+        self.assertEqual(self.reader.stats(), {'mapped': 0, 'fallbacks': 1})
+
+    def test_read_interfaces_swaps_tap_direction(self):
+        guest_counters.device_cache = FakeDeviceCache(['vnet0'])
+
+        for name, value in [('rx_bytes', 100), ('rx_packets', 10), ('rx_errors', 1), ('rx_dropped', 2),
+                            ('tx_bytes', 200), ('tx_packets', 20), ('tx_errors', 3), ('tx_dropped', 4)]:
+            self.write('net/vnet0/statistics/' + name, value.__str__() + '\n')
+
+        stats = dict()
+        self.reader.read_interfaces(dom=self.dom, stats=stats)
+
+        self.assertEqual(stats, {
+            'net.count': 1, 'net.0.name': 'vnet0',
+            'net.0.rx.bytes': 200, 'net.0.rx.pkts': 20, 'net.0.rx.errs': 3, 'net.0.rx.drop': 4,
+            'net.0.tx.bytes': 100, 'net.0.tx.pkts': 10, 'net.0.tx.errs': 1, 'net.0.tx.drop': 2})
+
+    def test_read_interfaces_falls_back_to_libvirt(self):
+        guest_counters.device_cache = FakeDeviceCache(['macvtap0'])
+
+        stats = dict()
+        self.reader.read_interfaces(dom=self.dom, stats=stats)
+
+        self.assertEqual(stats['net.0.rx.bytes'], 1)
+        self.assertEqual(stats['net.0.tx.drop'], 8)
+        self.assertEqual(self.reader.stats()['fallbacks'], 1)
+
+    def test_read_returns_both_families(self):
+        guest_counters.device_cache = FakeDeviceCache(['macvtap0'])
+        self.write_cgroup('5:memory:/' + self.scope)
+
+        stats = self.reader.read(dom=self.dom)
+
+        self.assertEqual(stats['cpu.time'], 42)
+        self.assertEqual(stats['net.count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from image_pool import ImagePool
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class FakeStorage(object):
+    """
+    以本地文件系统模拟 Storage 中备用镜像池用到的方法
+    """
+
+    free = None
+
+    @staticmethod
+    def stat(path=None):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime, st.st_ino
+
+    @classmethod
+    def free_space(cls, path=None):
+        if cls.free is not None:
+            return cls.free
+
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+
+    @staticmethod
+    def copy_file(src=None, dst=None, callback=None):
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+
+        shutil.copyfile(src, dst)
+
+    @staticmethod
+    def rename_image(src=None, dst=None):
+        os.rename(src, dst)
+
+    @staticmethod
+    def delete_image(path=None):
+        if os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def listdir(path=None):
+        if not os.path.isdir(path):
+            return list()
+
+        return os.listdir(path)
+
+
+class FakeImagePool(ImagePool):
+
+    @staticmethod
+    def storage(key):
+        return FakeStorage()
+
+
+class TestImagePool(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.template_path = os.path.join(self.path, 'template.qcow2')
+        self.write(self.template_path, 'v1')
+
+        self.images = os.path.join(self.path, 'images')
+        os.makedirs(self.images)
+
+        FakeStorage.free = None
+        self.pool = FakeImagePool(node_id='1', depth=1, min_requests=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    @staticmethod
+    def write(path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    @staticmethod
+    def read(path):
+        with open(path) as f:
+            return f.read()
+
+    def take(self, name, directory=None):
+        return self.pool.take(storage_mode=0, dfs_volume=None, template_path=self.template_path,
+                              system_image_path=os.path.join(directory or self.images, name))
+
+    def refill(self):
+        item = self.pool.next_template()
+        self.assertIsNotNone(item)
+        return self.pool.refill(*item)
+
+    def test_take_after_refill(self):
+        self.assertFalse(self.take('a.qcow2'))
+
+        self.assertTrue(self.refill())
+        self.assertIsNone(self.pool.next_template())
+
+        self.assertTrue(self.take('b.qcow2'))
+        self.assertEqual(self.read(os.path.join(self.images, 'b.qcow2')), 'v1')
+        self.assertEqual(os.listdir(os.path.join(self.images, '.pool')), list())
+        self.assertEqual(self.pool.stats()['hits'], 1)
+
+    def test_replaced_template_invalidates_ready_images(self):
+        self.take('a.qcow2')
+        self.refill()
+
+        # 原地替换模板
+        os.remove(self.template_path)
+        self.write(self.template_path, 'v2 rebuilt')
+
+        self.assertFalse(self.take('b.qcow2'))
+        self.assertEqual(os.listdir(os.path.join(self.images, '.pool')), list())
+        self.assertEqual(self.pool.stats()['stale'], 1)
+
+        self.refill()
+        self.assertTrue(self.take('c.qcow2'))
+        self.assertEqual(self.read(os.path.join(self.images, 'c.qcow2')), 'v2 rebuilt')
+
+    def test_refill_checks_free_space(self):
+        self.take('a.qcow2')
+        FakeStorage.free = 1
+
+        self.assertFalse(self.refill())
+        self.assertFalse(os.path.exists(os.path.join(self.images, '.pool')))
+        self.assertEqual(self.pool.stats()['no_space'], 1)
+
+    def test_pool_is_kept_per_directory(self):
+        other = os.path.join(self.path, 'other')
+        os.makedirs(other)
+
+        self.take('a.qcow2')
+        self.take('a.qcow2', directory=other)
+
+        self.refill()
+        self.refill()
+
+        # 备用镜像与系统镜像位于同一目录下，改名不会跨文件系统
+        self.assertEqual(os.listdir(os.path.join(self.images, '.pool')).__len__(), 1)
+        self.assertEqual(os.listdir(os.path.join(other, '.pool')).__len__(), 1)
+        self.assertEqual(self.pool.stats()['templates'], {self.template_path: 2})
+
+    def test_scan_adopts_current_and_removes_obsolete_files(self):
+        pool_dir = os.path.join(self.images, '.pool')
+        os.makedirs(pool_dir)
+
+        template_stat = FakeStorage.stat(self.template_path)
+        current = self.pool.file_prefix(self.template_path, template_stat) + 'a.qcow2'
+        partial = self.pool.file_prefix(self.template_path, template_stat) + 'b.qcow2.tmp'
+        obsolete = self.pool.file_prefix(self.template_path, (0, 0, 0)) + 'c.qcow2'
+        foreign = '2_' + self.pool.file_prefix(self.template_path)[2:] + 'd.qcow2'
+
+        for name in [current, partial, obsolete, foreign]:
+            self.write(os.path.join(pool_dir, name), 'v1')
+
+        self.take('a.qcow2')
+        self.assertIsNone(self.pool.next_template())
+
+        self.assertEqual(sorted(os.listdir(pool_dir)), sorted([current, foreign]))
+        self.assertTrue(self.take('b.qcow2'))
+
+    def test_purge_removes_ready_images(self):
+        self.take('a.qcow2')
+        self.refill()
+
+        self.pool.purge(template_path=self.template_path)
+
+        self.assertEqual(os.listdir(os.path.join(self.images, '.pool')), list())
+        self.assertEqual(self.pool.templates, dict())
+
+    def test_disabled_pool_never_takes(self):
+        self.pool.depth = 0
+        self.assertFalse(self.take('a.qcow2'))
+        self.assertEqual(self.pool.templates, dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
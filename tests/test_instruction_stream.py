@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import json
+import unittest
+
+import redis
+
+from instruction_stream import InstructionStream
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+def parse_id(entry_id):
+    if entry_id == '-':
+        return 0, 0
+
+    if entry_id == '+':
+        return float('inf'), 0
+
+    # 省略序号时，如 '0'
+    if '-' not in entry_id:
+        return int(entry_id), 0
+
+    ms, seq = entry_id.split('-')
+    return int(ms), int(seq)
+
+
+class FakeStreamRedis(object):
+    """
+    以内存模拟单个消费组的 XGROUP、XREADGROUP、XPENDING、XCLAIM 及 XACK
+    """
+
+    def __init__(self):
+        self.entries = list()
+        self.group = None
+        self.last_delivered = (0, 0)
+        # entry_id -> [consumer, idle, deliveries]
+        self.pel = dict()
+        self.commands = list()
+
+    def add(self, entry_id, fields):
+        self.entries.append((entry_id, fields))
+
+    def entry(self, entry_id):
+        return [entry for entry in self.entries if entry[0] == entry_id][0]
+
+    def execute_command(self, *args):
+        self.commands.append(args[0])
+        return getattr(self, args[0].lower())(*args[1:])
+
+    def xgroup(self, sub, stream, group, start, mkstream):
+        if self.group is not None:
+            raise redis.exceptions.ResponseError('BUSYGROUP Consumer Group name already exists')
+
+        self.group = group
+
+    def xreadgroup(self, _, group, consumer, __, count, ___, block, ____, stream, last_id):
+        if last_id == '>':
+            ret = [entry for entry in self.entries if parse_id(entry[0]) > self.last_delivered][:count]
+
+            for entry_id, _ in ret:
+                self.pel[entry_id] = [consumer, 0, 1]
+                self.last_delivered = parse_id(entry_id)
+
+        else:
+            ret = [self.entry(entry_id) for entry_id in sorted(self.pel, key=parse_id)
+                   if self.pel[entry_id][0] == consumer and parse_id(entry_id) > parse_id(last_id)][:count]
+
+        if ret.__len__() < 1:
+            return None
+
+        return [[stream, ret]]
+
+    def xpending(self, stream, group, start, end, count):
+        return [[entry_id] + self.pel[entry_id] for entry_id in sorted(self.pel, key=parse_id)
+                if parse_id(start) <= parse_id(entry_id) <= parse_id(end)][:count]
+
+    def xclaim(self, stream, group, consumer, min_idle, entry_id):
+        self.pel[entry_id] = [consumer, 0, self.pel[entry_id][2] + 1]
+        return [self.entry(entry_id)]
+
+    def xack(self, stream, group, entry_id):
+        self.pel.pop(entry_id, None)
+
+
+class FakeBuffer(object):
+
+    def __init__(self):
+        self.callbacks = list()
+
+    def call_after_delivery(self, callback):
+        self.callbacks.append(callback)
+
+    def deliver(self):
+        callbacks, self.callbacks = self.callbacks, list()
+        for callback in callbacks:
+            callback()
+
+
+class TestInstructionStream(unittest.TestCase):
+
+    def setUp(self):
+        self.r = FakeStreamRedis()
+        self.buffer = FakeBuffer()
+        self.submitted = list()
+        self.stream = self.new_stream(consumer='node-a')
+
+    def new_stream(self, consumer):
+        return InstructionStream(r=self.r, stream='S:Instruction:1', group='JimV-N', consumer=consumer, batch=2,
+                                 block=0, claim_idle=1000, accept=self.accept, submit=self.submit,
+                                 buffer=self.buffer)
+
+    @staticmethod
+    def accept(data):
+        msg = json.loads(data)
+        return None if msg.get('ignore') else msg
+
+    def submit(self, msg, entry_id):
+        self.submitted.append(entry_id)
+
+    def add(self, n, **kwargs):
+        for i in range(1, n + 1):
+            self.r.add('1-' + i.__str__(), ['data', json.dumps(dict(serial=i, **kwargs))])
+
+    def test_init_tolerates_existing_group(self):
+        self.stream.init(replay=False)
+        self.stream.init(replay=False)
+        self.assertEqual(self.r.commands, ['XGROUP', 'XGROUP'])
+
+    def test_init_raises_other_errors(self):
+        def xgroup(*args):
+            raise redis.exceptions.ResponseError('ERR no such key')
+
+        self.r.xgroup = xgroup
+        self.assertRaises(redis.exceptions.ResponseError, self.stream.init, False)
+
+    def test_ack_after_delivery(self):
+        self.stream.init(replay=False)
+        self.add(2)
+
+        self.assertEqual([entry_id for entry_id, _ in self.stream.read()], ['1-1', '1-2'])
+        self.assertEqual(self.submitted, ['1-1', '1-2'])
+
+        self.stream.ack_after_delivery(entry_id='1-1')
+        # 应答送达前不确认
+        self.assertEqual(sorted(self.r.pel), ['1-1', '1-2'])
+
+        self.buffer.deliver()
+        self.assertEqual(self.r.pel.keys(), ['1-2'])
+
+    def test_ignored_and_deleted_entries_are_acked_at_once(self):
+        self.stream.init(replay=False)
+        self.r.add('1-1', ['data', json.dumps({'ignore': True})])
+        self.r.add('1-2', None)
+
+        self.stream.read()
+
+        self.assertEqual(self.submitted, list())
+        self.assertEqual(self.r.pel, dict())
+
+    def test_replay_pages_own_pending_entries(self):
+        self.stream.init(replay=False)
+        self.add(5)
+
+        # 读取后进程退出，未确认
+        while self.stream.read():
+            pass
+
+        self.submitted = list()
+        self.new_stream(consumer='node-a').init(replay=True)
+
+        # 每页 2 条，按条目 ID 向后翻页，不重复、不遗漏
+        self.assertEqual(self.submitted, ['1-1', '1-2', '1-3', '1-4', '1-5'])
+
+    def test_replay_claims_idle_entries_of_other_consumers_across_pages(self):
+        self.stream.init(replay=False)
+        self.add(5)
+
+        while self.new_stream(consumer='old-name').read():
+            pass
+
+        for entry_id in ['1-1', '1-2', '1-3', '1-4', '1-5']:
+            self.r.pel[entry_id][1] = 5000
+
+        # 未超时的不予认领
+        self.r.pel['1-4'][1] = 10
+
+        self.submitted = list()
+        self.stream.init(replay=True)
+
+        self.assertEqual(self.submitted, ['1-1', '1-2', '1-3', '1-5'])
+        self.assertEqual(self.r.pel['1-4'][0], 'old-name')
+        self.assertEqual(self.r.pel['1-5'][0], 'node-a')
+
+    def test_next_id(self):
+        self.assertEqual(InstructionStream.next_id('1541990000000-0'), '1541990000000-1')
+        self.assertEqual(InstructionStream.next_id('1-9'), '1-10')
+
+
+if __name__ == '__main__':
+    unittest.main()
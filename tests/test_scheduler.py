@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import unittest
+
+from runtime import Runtime
+from scheduler import Scheduler
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        # 以可控的时钟代替单调时钟
+        self.now = 1000.0
+        self.monotonic = Runtime.__dict__['monotonic']
+        Runtime.monotonic = classmethod(lambda cls: self.now)
+        self.scheduler = Scheduler(name='test')
+
+    def tearDown(self):
+        Runtime.monotonic = self.monotonic
+        with Scheduler.schedulers_lock:
+            Scheduler.schedulers.pop('test', None)
+
+    def test_job_is_due_immediately_then_every_interval(self):
+        self.scheduler.add('a', 10)
+        self.assertEqual(self.scheduler.due(), ['a'])
+        self.assertEqual(self.scheduler.due(), list())
+
+        self.now += 9.9
+        self.assertEqual(self.scheduler.due(), list())
+        self.assertAlmostEqual(self.scheduler.timeout(), 0.1)
+
+        self.now += 0.1
+        self.assertEqual(self.scheduler.due(), ['a'])
+
+    def test_delay_postpones_first_run(self):
+        self.scheduler.add('a', 10, delay=5)
+        self.assertEqual(self.scheduler.due(), list())
+        self.assertEqual(self.scheduler.timeout(), 5)
+
+        self.now += 5
+        self.assertEqual(self.scheduler.due(), ['a'])
+
+    def test_late_run_keeps_alignment_and_counts_missed(self):
+        self.scheduler.add('a', 10)
+        self.scheduler.due()
+
+        # 截止时间为 1010，实际于 1035 才检查：1020、1030 两个周期被错过
+        self.now += 35
+        self.assertEqual(self.scheduler.due(), ['a'])
+        self.assertEqual(self.scheduler.stats()['a']['missed'], 2)
+
+        # 下一个截止时间仍与首次对齐，而非顺延至 1045
+        self.assertEqual(self.scheduler.timeout(), 5)
+
+    def test_jobs_are_independent(self):
+        self.scheduler.add('fast', 1)
+        self.scheduler.add('slow', 10)
+        self.assertEqual(sorted(self.scheduler.due()), ['fast', 'slow'])
+
+        self.now += 1
+        self.assertEqual(self.scheduler.due(), ['fast'])
+
+        stats = Scheduler.all_stats()['test']
+        self.assertEqual(stats['fast']['runs'], 2)
+        self.assertEqual(stats['slow']['runs'], 1)
+
+    def test_stats_reset_lag_max(self):
+        self.scheduler.add('a', 10)
+        self.now += 3
+        self.scheduler.due()
+
+        self.assertEqual(self.scheduler.stats()['a']['lag_max'], 3)
+        self.assertEqual(self.scheduler.stats()['a']['lag_max'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from spool import Spool
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def new_spool(self, segment_size=64, max_size=1024 ** 2):
+        return Spool(path=self.path, segment_size=segment_size, max_size=max_size, fsync_interval=0)
+
+    @staticmethod
+    def drain(spool):
+        ret = list()
+
+        while not spool.empty():
+            name, msgs = spool.oldest()
+            if name is None:
+                break
+
+            ret.extend(msgs)
+            spool.remove(name)
+
+        return ret
+
+    def test_round_trip_across_segments_in_order(self):
+        spool = self.new_spool()
+        msgs = ['{"serial": %d}' % i for i in range(20)]
+
+        for i in range(0, msgs.__len__(), 3):
+            spool.append(msgs[i:i + 3])
+
+        # 每个分段超过 64 字节即封存
+        self.assertTrue(spool.segments().__len__() > 1)
+        self.assertEqual(self.drain(spool), msgs)
+        self.assertTrue(spool.empty())
+        self.assertEqual(spool.segments(), list())
+
+    def test_unicode_round_trip(self):
+        spool = self.new_spool()
+        spool.append([u'{"message": "磁盘已满"}'])
+
+        self.assertEqual(self.drain(spool), [u'{"message": "磁盘已满"}'])
+
+    def test_open_segment_is_sealed_before_replay(self):
+        spool = self.new_spool(segment_size=1024)
+        spool.append(['a', 'b'])
+
+        name, msgs = spool.oldest()
+        self.assertEqual(msgs, ['a', 'b'])
+        self.assertIsNone(spool.fd)
+
+        spool.remove(name)
+        # 封存后的写入进入新分段
+        spool.append(['c'])
+        self.assertEqual(self.drain(spool), ['c'])
+
+    def test_restart_resumes_serial_and_pending(self):
+        spool = self.new_spool()
+        spool.append(['x' * 80])
+        spool.append(['y'])
+        spool.sync()
+
+        spool = self.new_spool()
+        self.assertFalse(spool.empty())
+
+        spool.append(['z'])
+        self.assertEqual(self.drain(spool), ['x' * 80, 'y', 'z'])
+
+    def test_max_size_drops_oldest_segments(self):
+        spool = self.new_spool(segment_size=10, max_size=30)
+
+        for i in range(10):
+            spool.append(['%010d' % i])
+
+        remaining = self.drain(spool)
+        self.assertEqual(remaining, ['%010d' % i for i in range(10 - remaining.__len__(), 10)])
+        self.assertEqual(spool.dropped + remaining.__len__(), 10)
+        self.assertTrue(spool.dropped > 0)
+
+    def test_failed_write_leaves_no_partial_line(self):
+        spool = self.new_spool(segment_size=1024)
+        spool.append(['a'])
+
+        real_write = os.write
+
+        def short_write(fd, data):
+            real_write(fd, data[:2])
+            raise OSError(28, os.strerror(28))
+
+        os.write = short_write
+        try:
+            self.assertRaises(OSError, spool.append, ['bcdef'])
+
+        finally:
+            os.write = real_write
+
+        spool.append(['g'])
+        self.assertEqual(self.drain(spool), ['a', 'g'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import unittest
+
+from timeseries import RingTable, TimeSeriesStore
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class TestRingTable(unittest.TestCase):
+
+    def test_window_returns_samples_in_time_order_after_wrap(self):
+        table = RingTable(fields=['a'], capacity=3)
+        for ts in range(1, 6):
+            table.append(ts, [ts * 10])
+
+        # 容量为 3，最早的两个样本已被覆盖
+        self.assertEqual(table.window(since=0, until=10), {'ts': [3, 4, 5], 'a': [30, 40, 50]})
+        self.assertEqual(table.window(since=4, until=4), {'ts': [4], 'a': [40]})
+        self.assertEqual(table.last_ts(), 5)
+
+    def test_window_downsamples_by_bucket_average(self):
+        table = RingTable(fields=['a'], capacity=10)
+        for ts in range(0, 6):
+            table.append(ts, [ts])
+
+        self.assertEqual(table.window(since=0, until=10, step=2), {'ts': [0, 2, 4], 'a': [0.5, 2.5, 4.5]})
+
+    def test_copy_is_independent(self):
+        table = RingTable(fields=['a'], capacity=3)
+        table.append(1, [1])
+
+        snapshot = table.copy()
+        table.append(2, [2])
+
+        self.assertEqual(snapshot.window(since=0, until=10), {'ts': [1], 'a': [1]})
+
+
+class TestTimeSeriesStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = TimeSeriesStore(capacity=10, max_tables=3, query_max_tables=2)
+
+    def test_query_filters_by_prefix(self):
+        self.store.record('guest:a:cpu', 1, {'load': 1})
+        self.store.record('guest:b:cpu', 1, {'load': 2})
+
+        ret = self.store.query(prefix='guest:a:', since=0, until=10)
+        self.assertEqual(ret, {'guest:a:cpu': {'ts': [1], 'load': [1]}})
+
+    def test_query_requires_prefix(self):
+        self.assertRaises(ValueError, self.store.query, prefix='', since=0, until=10)
+
+    def test_query_is_limited(self):
+        for name in ['guest:c', 'guest:a', 'guest:b']:
+            self.store.record(name, 1, {'load': 1})
+
+        self.assertEqual(sorted(self.store.query(prefix='guest:', since=0, until=10)), ['guest:a', 'guest:b'])
+        self.assertEqual(sorted(self.store.query(prefix='guest:', since=0, until=10, limit=1)), ['guest:a'])
+        # 请求的上限不可超过 query_max_tables
+        self.assertEqual(self.store.query(prefix='guest:', since=0, until=10, limit=100).__len__(), 2)
+
+    def test_field_set_change_rebuilds_table(self):
+        self.store.record('guest:a', 1, {'load': 1})
+        self.store.record('guest:a', 2, {'load': 2, 'memory': 3})
+
+        ret = self.store.query(prefix='guest:a', since=0, until=10)
+        self.assertEqual(ret, {'guest:a': {'ts': [2], 'load': [2], 'memory': [3]}})
+
+    def test_max_tables_drops_new_entities(self):
+        for name in ['a', 'b', 'c', 'd']:
+            self.store.record(name, 1, {'v': 1})
+
+        self.assertEqual(self.store.stats(), {'tables': 3, 'capacity': 10, 'dropped': 1})
+
+    def test_gc_removes_stale_entities(self):
+        self.store.record('old', 1, {'v': 1})
+        self.store.record('new', 5, {'v': 1})
+
+        self.store.gc(before=3)
+        self.assertEqual(self.store.query(prefix='o', since=0, until=10), dict())
+        self.assertEqual(self.store.query(prefix='n', since=0, until=10).__len__(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
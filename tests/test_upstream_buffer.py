@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import shutil
+import tempfile
+import unittest
+
+import redis
+
+from spool import Spool
+from upstream_buffer import UpstreamBuffer
+
+
+__author__ = 'James Iter'
+__date__ = '2018/11/12'
+__contact__ = 'james.iter.cn@gmail.com'
+__copyright__ = '(c) 2018 by James Iter.'
+
+
+class FakePipeline(object):
+
+    def __init__(self, r):
+        self.r = r
+        self.commands = list()
+
+    def rpush(self, key, *values):
+        self.commands.append((key, values))
+
+    def execute(self):
+        self.r.executes += 1
+
+        if self.r.failures > 0:
+            self.r.failures -= 1
+            raise redis.exceptions.ConnectionError('connection refused')
+
+        for key, values in self.commands:
+            self.r.lists.setdefault(key, list()).extend(values)
+            self.r.rpushes += 1
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.lists = dict()
+        # 此后的 failures 次 pipeline 执行失败
+        self.failures = 0
+        self.executes = 0
+        self.rpushes = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class TestUpstreamBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.r = FakeRedis()
+        self.buffer = UpstreamBuffer(r=self.r, upstream_queue='q', max_size=5, batch_size=2, flush_interval=0.2)
+
+    def delivered(self):
+        return self.r.lists.get('q', list())
+
+    def test_flush_pushes_in_batches_with_one_round_trip(self):
+        for i in range(5):
+            self.buffer.put(i.__str__())
+
+        self.assertEqual(self.buffer.flush(), 5)
+        self.assertEqual(self.delivered(), ['0', '1', '2', '3', '4'])
+        # 每 batch_size 条一个 RPUSH，全部经由一次 pipeline 送出
+        self.assertEqual(self.r.rpushes, 3)
+        self.assertEqual(self.r.executes, 1)
+        self.assertEqual(self.buffer.stats()['depth'], 0)
+
+    def test_timeout_by_size_and_age(self):
+        self.assertEqual(self.buffer.timeout(), 0.2)
+
+        self.buffer.put('a')
+        first_ts = self.buffer.first_ts
+        self.assertAlmostEqual(self.buffer.timeout(now=first_ts + 0.05), 0.15, places=3)
+        self.assertEqual(self.buffer.timeout(now=first_ts + 1), 0)
+
+        # 积攒满 batch_size 条即推送，不等待最早的消息到期
+        self.buffer.put('b')
+        self.assertEqual(self.buffer.timeout(now=first_ts), 0)
+
+    def test_put_drops_when_full(self):
+        for i in range(7):
+            self.buffer.put(i.__str__())
+
+        self.assertEqual(self.buffer.stats()['dropped'], 2)
+        self.buffer.flush()
+        self.assertEqual(self.delivered(), ['0', '1', '2', '3', '4'])
+
+    def test_failed_pipeline_requeues_batch_in_order(self):
+        self.buffer.put('a')
+        self.buffer.put('b')
+        self.r.failures = 1
+
+        self.assertRaises(redis.exceptions.ConnectionError, self.buffer.flush)
+        self.assertEqual(self.delivered(), list())
+
+        # 失败期间新入队的消息排在放回的一批之后
+        self.buffer.put('c')
+        self.assertIsNotNone(self.buffer.first_ts)
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(self.delivered(), ['a', 'b', 'c'])
+
+    def test_requeue_beyond_capacity_drops_newest(self):
+        for i in range(3):
+            self.buffer.put(i.__str__())
+
+        self.r.failures = 1
+        self.assertRaises(redis.exceptions.ConnectionError, self.buffer.flush)
+
+        for i in range(3, 5):
+            self.buffer.put(i.__str__())
+
+        self.r.failures = 1
+        self.assertRaises(redis.exceptions.ConnectionError, self.buffer.flush)
+        self.buffer.requeue(msgs=['x', 'y'], callbacks=list(), first_ts=None)
+
+        self.assertEqual(self.buffer.stats()['dropped'], 2)
+        self.buffer.flush()
+        self.assertEqual(self.delivered(), ['x', 'y', '0', '1', '2'])
+
+    def test_callbacks_run_after_preceding_messages_are_delivered(self):
+        events = list()
+        self.buffer.put('a')
+        self.buffer.call_after_delivery(lambda: events.append(list(self.delivered())))
+        self.buffer.put('b')
+        self.buffer.call_after_delivery(lambda: events.append('second'))
+
+        self.r.failures = 1
+        self.assertRaises(redis.exceptions.ConnectionError, self.buffer.flush)
+        self.assertEqual(events, list())
+
+        self.buffer.flush()
+        self.assertEqual(events, [['a', 'b'], 'second'])
+
+    def test_callbacks_do_not_take_buffer_capacity(self):
+        for _ in range(10):
+            self.buffer.call_after_delivery(lambda: None)
+
+        for i in range(5):
+            self.assertTrue(self.buffer.put(i.__str__()))
+
+        stats = self.buffer.stats()
+        self.assertEqual(stats['depth'], 5)
+        self.assertEqual(stats['callbacks'], 10)
+        self.assertEqual(stats['dropped'], 0)
+
+    def test_requeue_drops_messages_but_keeps_callbacks(self):
+        events = list()
+
+        for i in range(5):
+            self.buffer.put(i.__str__())
+
+        self.buffer.call_after_delivery(lambda: events.append(1))
+        self.r.failures = 1
+        self.assertRaises(redis.exceptions.ConnectionError, self.buffer.flush)
+
+        self.buffer.requeue(msgs=['x'], callbacks=list(), first_ts=None)
+        self.assertEqual(self.buffer.stats()['dropped'], 1)
+        self.assertEqual(self.buffer.stats()['callbacks'], 1)
+
+        self.buffer.flush()
+        self.assertEqual(events, [1])
+
+    def test_callback_without_messages_runs_on_next_flush(self):
+        events = list()
+        self.buffer.call_after_delivery(lambda: events.append(1))
+
+        self.assertIsNotNone(self.buffer.first_ts)
+        self.buffer.flush()
+        self.assertEqual(events, [1])
+        self.assertEqual(self.r.executes, 0)
+
+
+class TestUpstreamBufferWithSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.r = FakeRedis()
+        self.spool = Spool(path=self.path, fsync_interval=0)
+        self.buffer = UpstreamBuffer(r=self.r, upstream_queue='q', max_size=5, batch_size=2, spool=self.spool,
+                                     retry_interval=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_failed_push_is_spooled_and_replayed_first(self):
+        events = list()
+        self.buffer.put('a')
+        self.buffer.call_after_delivery(lambda: events.append('acked'))
+        self.r.failures = 1
+
+        self.assertRaises(redis.exceptions.ConnectionError, self.buffer.flush)
+        self.assertEqual(self.buffer.stats()['spooled'], 1)
+
+        # 退避期间直接写入暂存区，不访问 Redis
+        self.buffer.put('b')
+        self.buffer.flush()
+        self.assertEqual(self.r.executes, 1)
+        self.assertEqual(events, list())
+
+        self.buffer.retry_ts = 0
+        self.buffer.put('c')
+        self.buffer.flush()
+
+        self.assertEqual(self.r.lists['q'], ['a', 'b', 'c'])
+        self.assertEqual(events, ['acked'])
+        self.assertTrue(self.spool.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()